@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import random
+import time
+import urllib.parse
+import uuid
+from pathlib import Path
+import aiohttp
+
+OPS = ["open", "deposit", "withdraw", "transfer", "read"]
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(","):
+        op, weight = item.split("=")
+        if op not in OPS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {op}.")
+        mix[op] = float(weight)
+    return mix
+
+
+class Zipf:
+    # Samples ranks 0..n-1 with P(k) ~ 1 / (k + 1)^s; s = 0 is uniform.
+    def __init__(self, n: int, s: float, rng: random.Random):
+        weights = [1.0 / (k + 1) ** s for k in range(n)]
+        self.cdf = list(itertools.accumulate(weights))
+        self.rng = rng
+
+    def sample(self) -> int:
+        x = self.rng.random() * self.cdf[-1]
+        return min(bisect.bisect_left(self.cdf, x), len(self.cdf) - 1)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(samples, duration: float) -> dict:
+    latencies = sorted(lat for _, _, lat, outcome in samples if outcome == "ok")
+    return {
+        "ops_per_s": len(latencies) / duration if duration > 0 else 0.0,
+        "ok": len(latencies),
+        "rejected": sum(outcome == "rejected" for *_, outcome in samples),
+        "errors": sum(outcome == "error" for *_, outcome in samples),
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "p999_ms": percentile(latencies, 0.999),
+    }
+
+
+def read_events(fpath, start: float, end: float):
+    # Kill/restart events written by the orchestrators' --events-file.
+    if fpath is None or not Path(fpath).exists():
+        return []
+    events = []
+    with open(fpath) as f:
+        for line in f:
+            event = json.loads(line)
+            if start <= event["ts"] <= end:
+                events.append({**event, "t": event["ts"] - start})
+    return events
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--urls", nargs="+", required=True)
+    p.add_argument("--mode", choices=["closed", "open"], default="closed")
+    p.add_argument("--clients", type=int, default=16)
+    p.add_argument("--rate", type=float, default=100.0)
+    p.add_argument("--max-in-flight", type=int, default=1024)
+    p.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="open=1,deposit=4,withdraw=2,transfer=2,read=6",
+    )
+    p.add_argument("--accounts", type=int, default=1000)
+    p.add_argument("--initial-funds", default="1000")
+    p.add_argument("--zipf", type=float, default=0.99)
+    p.add_argument("--duration", type=float, default=30.0)
+    p.add_argument("--interval", type=float, default=1.0)
+    p.add_argument("--timeout", type=float, default=10.0)
+    p.add_argument("--events-file")
+    p.add_argument("--output")
+    p.add_argument("--seed", type=int)
+    # Lets any replica serve the reads (see GET /account/<uid>).
+    p.add_argument("--read-max-lag", type=int)
+    p.add_argument("--read-max-age", type=float)
+    # Writes with a key of their own are safe to send twice, so they can be
+    # hedged like reads: sent again if not answered within --hedge-after.
+    p.add_argument("--idempotency-keys", action="store_true")
+    p.add_argument("--hedge-after", type=float, metavar="MS")
+
+    args = p.parse_args()
+
+    rng = random.Random(args.seed)
+    urls = itertools.cycle(args.urls)
+    ops, weights = zip(*args.mix.items())
+    staleness = {
+        key: value
+        for key, value in [
+            ("max_lag", args.read_max_lag),
+            ("max_age", args.read_max_age),
+        ]
+        if value is not None
+    }
+    read_query = "?" + urllib.parse.urlencode(staleness) if staleness else ""
+    uids = []
+    zipf = None
+    # (op, completion time, latency [ms], outcome)
+    samples = []
+    num_hedged = 0
+
+    async def setup(session):
+        nonlocal zipf
+        # Accounts are created and funded in batches before measuring. The
+        # batches are small enough for a sharded gateway to spread them.
+        for start in range(0, args.accounts, 100):
+            num = min(100, args.accounts - start)
+            batch = {"ops": [{"op": "open_acct"}] * num}
+            async with session.post(f"{next(urls)}/batch", json=batch) as resp:
+                resp.raise_for_status()
+                results = (await resp.json())["results"]
+            created = [res["uid"] for res in results]
+            deposits = [
+                {"op": "deposit", "uid": uid, "amount": args.initial_funds}
+                for uid in created
+            ]
+            async with session.post(
+                f"{next(urls)}/batch", json={"ops": deposits}
+            ) as resp:
+                resp.raise_for_status()
+            uids.extend(created)
+
+        # Hot accounts are spread over the uid space rather than being the
+        # oldest ones.
+        rng.shuffle(uids)
+        zipf = Zipf(len(uids), args.zipf, rng)
+
+    def make_request(op):
+        if op == "open":
+            return "POST", "/account", None
+        uid = uids[zipf.sample()]
+        amount = str(rng.randint(1, 10))
+        if op == "deposit":
+            return "POST", "/deposit", {"uid": uid, "amount": amount}
+        elif op == "withdraw":
+            return "POST", "/withdrawal", {"uid": uid, "amount": amount}
+        elif op == "transfer":
+            to_uid = uids[zipf.sample()]
+            payload = {"from_uid": uid, "to_uid": to_uid, "amount": amount}
+            return "POST", "/transfer", payload
+        else:
+            return "GET", f"/account/{uid}{read_query}", None
+
+    async def send(session, method, path, payload, headers) -> int:
+        url = f"{next(urls)}{path}"
+        async with session.request(method, url, json=payload, headers=headers) as resp:
+            await resp.read()
+            return resp.status
+
+    async def hedged(session, method, path, payload, headers) -> int:
+        # Whichever of the two copies succeeds first; the other is cancelled.
+        nonlocal num_hedged
+        first = asyncio.ensure_future(send(session, method, path, payload, headers))
+        done, _ = await asyncio.wait({first}, timeout=args.hedge_after / 1e3)
+        if done:
+            return first.result()
+        num_hedged += 1
+        second = asyncio.ensure_future(send(session, method, path, payload, headers))
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None and (task.result() < 500 or not pending):
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+        return first.result()
+
+    async def issue(session, op, scheduled: float):
+        # Latency is measured from when the request was due, so an open-loop
+        # run does not hide queueing behind a slow system.
+        method, path, payload = make_request(op)
+        headers = {}
+        if args.idempotency_keys and method == "POST":
+            headers["Idempotency-Key"] = uuid.uuid4().hex
+        try:
+            if args.hedge_after is not None and (method == "GET" or headers):
+                status = await hedged(session, method, path, payload, headers)
+            else:
+                status = await send(session, method, path, payload, headers)
+            if status < 400:
+                outcome = "ok"
+            elif status < 500:
+                outcome = "rejected"
+            else:
+                outcome = "error"
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            outcome = "error"
+        now = time.time()
+        samples.append((op, now, (now - scheduled) * 1e3, outcome))
+
+    async def closed_loop(session, deadline: float):
+        async def client():
+            while time.time() < deadline:
+                op = rng.choices(ops, weights)[0]
+                await issue(session, op, time.time())
+
+        await asyncio.gather(*(client() for _ in range(args.clients)))
+
+    async def open_loop(session, deadline: float):
+        in_flight = asyncio.Semaphore(args.max_in_flight)
+        tasks = set()
+
+        async def run_one(op, scheduled):
+            async with in_flight:
+                await issue(session, op, scheduled)
+
+        scheduled = time.time()
+        while True:
+            scheduled += rng.expovariate(args.rate)
+            if scheduled >= deadline:
+                break
+            delay = scheduled - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            op = rng.choices(ops, weights)[0]
+            task = asyncio.create_task(run_one(op, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    async def run():
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=args.timeout)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout
+        ) as session:
+            await setup(session)
+            start = time.time()
+            deadline = start + args.duration
+            if args.mode == "closed":
+                await closed_loop(session, deadline)
+            else:
+                await open_loop(session, deadline)
+            return start, time.time()
+
+    start, end = asyncio.run(run())
+    events = read_events(args.events_file, start, end)
+
+    intervals = []
+    num_intervals = int(args.duration / args.interval + 0.5)
+    for idx in range(num_intervals):
+        lo = start + idx * args.interval
+        hi = lo + args.interval
+        in_interval = [s for s in samples if lo <= s[1] < hi]
+        intervals.append(
+            {
+                "t": idx * args.interval,
+                **summarize(in_interval, args.interval),
+                "events": [e for e in events if lo <= e["ts"] < hi],
+            }
+        )
+
+    summary = {**summarize(samples, end - start), "hedged": num_hedged}
+    by_op = {
+        op: summarize([s for s in samples if s[0] == op], end - start) for op in ops
+    }
+
+    def fmt(value):
+        return f"{value:>9.2f}" if value is not None else f"{'-':>9}"
+
+    print(
+        f"{'t [s]':>6} {'ops/s':>9} {'p50 [ms]':>9} {'p99 [ms]':>9} "
+        f"{'p999 [ms]':>9} {'errors':>7}  events"
+    )
+    for interval in intervals:
+        marks = " ".join(f"{e['event']}:{e['port']}" for e in interval["events"])
+        print(
+            f"{interval['t']:>6.1f} {interval['ops_per_s']:>9.1f} "
+            f"{fmt(interval['p50_ms'])} {fmt(interval['p99_ms'])} "
+            f"{fmt(interval['p999_ms'])} {interval['errors']:>7}  {marks}"
+        )
+    print(
+        f"{'total':>6} {summary['ops_per_s']:>9.1f} {fmt(summary['p50_ms'])} "
+        f"{fmt(summary['p99_ms'])} {fmt(summary['p999_ms'])} {summary['errors']:>7}"
+    )
+
+    if args.output is not None:
+        results = {
+            "config": vars(args),
+            "started_at": start,
+            "summary": summary,
+            "by_op": by_op,
+            "intervals": intervals,
+            "events": events,
+        }
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
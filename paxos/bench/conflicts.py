@@ -0,0 +1,194 @@
+import argparse
+import random
+import signal
+import subprocess
+from subprocess import DEVNULL
+import tempfile
+import threading
+from threading import Thread
+import time
+from pathlib import Path
+import requests
+from paxos.bench.pipeline import free_ports
+
+# Deposits and transfers sent to every worker of a leaderless deployment,
+# either over many accounts (few conflicts) or mostly over a handful of hot
+# ones. With --consensus multipaxos the writes end up forwarded to one leader;
+# with epaxos each worker commits them itself, on the fast path unless they
+# conflict with a concurrent write to the same accounts.
+
+
+def wait_until_up(urls, timeout: float):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                requests.get(f"{url}/admin/paxos", timeout=1.0).raise_for_status()
+                break
+            except requests.RequestException:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Worker {url} did not start.")
+                time.sleep(0.2)
+
+
+def setup(urls, num_accounts: int):
+    # Retried, since with multipaxos the first write has to elect a leader.
+    deadline = time.monotonic() + 30.0
+    while True:
+        try:
+            resp = requests.post(
+                f"{urls[0]}/batch",
+                json={"ops": [{"op": "open_acct"}] * num_accounts},
+                timeout=10.0,
+            )
+            resp.raise_for_status()
+            break
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+    uids = [res["uid"] for res in resp.json()["results"]]
+    deposits = [{"op": "deposit", "uid": uid, "amount": "1000000"} for uid in uids]
+    resp = requests.post(f"{urls[0]}/batch", json={"ops": deposits}, timeout=10.0)
+    resp.raise_for_status()
+    return uids
+
+
+def run_load(urls, uids, args, workload: str) -> dict:
+    latencies = []
+    errors = 0
+    mtx = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def pick(rng: random.Random):
+        if workload == "hot" and rng.random() < args.hot_fraction:
+            return uids[rng.randrange(args.hot_accounts)]
+        return rng.choice(uids)
+
+    def client_fn(idx: int):
+        nonlocal errors
+        rng = random.Random(args.seed + idx)
+        # Every client sticks to one worker, so all of them propose.
+        url = urls[idx % len(urls)]
+        sess = requests.Session()
+        while time.monotonic() < deadline:
+            if rng.random() < args.transfer_fraction:
+                path = "/transfer"
+                payload = {"from_uid": pick(rng), "to_uid": pick(rng), "amount": "1"}
+            else:
+                path = "/deposit"
+                payload = {"uid": pick(rng), "amount": "1"}
+            start = time.perf_counter()
+            try:
+                resp = sess.post(f"{url}{path}", json=payload, timeout=10.0)
+                ok = resp.status_code == 200
+            except requests.RequestException:
+                ok = False
+            latency = time.perf_counter() - start
+            with mtx:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+
+    clients = [Thread(target=client_fn, args=(idx,)) for idx in range(args.num_clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    latencies.sort()
+
+    def pct(q):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e3
+
+    return {
+        "ops_per_s": len(latencies) / args.duration,
+        "errors": errors,
+        "p50_ms": pct(0.5),
+        "p99_ms": pct(0.99),
+    }
+
+
+def path_counts(urls) -> tuple:
+    fast, slow = 0, 0
+    for url in urls:
+        status = requests.get(f"{url}/admin/paxos", timeout=5.0).json()
+        fast += status.get("fast_path", 0)
+        slow += status.get("slow_path", 0)
+    return fast, slow
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--consensus",
+        nargs="+",
+        choices=["multipaxos", "epaxos"],
+        default=["multipaxos", "epaxos"],
+    )
+    p.add_argument(
+        "--workloads", nargs="+", choices=["uniform", "hot"], default=["uniform", "hot"]
+    )
+    p.add_argument("--num-workers", type=int, default=3)
+    p.add_argument("--num-clients", type=int, default=24)
+    p.add_argument("--duration", type=float, default=10.0)
+    p.add_argument("--accounts", type=int, default=1000)
+    p.add_argument("--hot-accounts", type=int, default=2)
+    p.add_argument("--hot-fraction", type=float, default=0.9)
+    p.add_argument("--transfer-fraction", type=float, default=0.25)
+    p.add_argument("--wal", action="store_true")
+    p.add_argument("--server", choices=["flask", "asyncio"], default="flask")
+    p.add_argument("--seed", type=int, default=0)
+
+    args = p.parse_args()
+
+    print(
+        f"{'workload':>8} {'consensus':>10} {'ops/s':>10} {'p50 [ms]':>10} "
+        f"{'p99 [ms]':>10} {'errors':>8} {'fast':>8} {'slow':>8}"
+    )
+    for workload in args.workloads:
+        for consensus in args.consensus:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                worker_ports = free_ports(args.num_workers)
+                urls = [f"http://localhost:{port}" for port in worker_ports]
+                orch_argv = [
+                    "python3",
+                    "-m",
+                    "paxos.leaderless",
+                    "--ledger-file",
+                    str(Path(tmpdir) / "ledger.yml"),
+                    "--worker-ports",
+                    *(str(port) for port in worker_ports),
+                    "--consensus",
+                    consensus,
+                    *(["--wal"] if args.wal else []),
+                    "--server",
+                    args.server,
+                ]
+                orch_proc = subprocess.Popen(orch_argv, stdout=DEVNULL, stderr=DEVNULL)
+
+                try:
+                    wait_until_up(urls, 30.0)
+                    uids = setup(urls, args.accounts)
+                    fast0, slow0 = path_counts(urls)
+                    res = run_load(urls, uids, args, workload)
+                    fast1, slow1 = path_counts(urls)
+                finally:
+                    orch_proc.send_signal(signal.SIGINT)
+                    orch_proc.wait()
+
+            p50, p99 = res["p50_ms"] or 0.0, res["p99_ms"] or 0.0
+            fast, slow = fast1 - fast0, slow1 - slow0
+            print(
+                f"{workload:>8} {consensus:>10} {res['ops_per_s']:>10.1f} "
+                f"{p50:>10.2f} {p99:>10.2f} {res['errors']:>8} "
+                f"{fast if consensus == 'epaxos' else '-':>8} "
+                f"{slow if consensus == 'epaxos' else '-':>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
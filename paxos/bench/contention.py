@@ -0,0 +1,134 @@
+import argparse
+import random
+import tempfile
+import threading
+from threading import Thread
+import time
+from pathlib import Path
+from paxos.worker.ledger import FileLedger, Ledger, LedgerError
+
+# Threads hammering one ledger directly, either each operation under a single
+# lock (how the worker used to call it) or relying on the ledger's per-account
+# locks. The GIL keeps the Python parts serial either way, so the difference
+# shows where operations wait outside of it: on the WAL's fsyncs with --wal.
+
+
+def make_ledger(num_accounts: int, wal_dir) -> Ledger:
+    if wal_dir is None:
+        ledger = Ledger(accounts={}, next_uid=0)
+    else:
+        # Checkpoints would stall every mode alike.
+        ledger = FileLedger(
+            Path(wal_dir) / "ledger.yml", wal=True, checkpoint_every=10**9
+        )
+    ledger.batch([{"op": "open_acct"}] * num_accounts)
+    deposits = [
+        {"op": "deposit", "uid": uid, "amount": "1000000"}
+        for uid in range(num_accounts)
+    ]
+    ledger.batch(deposits)
+    return ledger
+
+
+def run(ledger: Ledger, args, mode: str, workload: str, num_threads: int) -> dict:
+    global_mtx = threading.Lock()
+    latencies = []
+    stats_mtx = threading.Lock()
+    amount = ledger.to_amount("1.00")
+
+    def pick(rng: random.Random) -> int:
+        if workload == "hot" and rng.random() < args.hot_fraction:
+            return rng.randrange(args.hot_accounts)
+        return rng.randrange(args.accounts)
+
+    def op(idx: int, rng: random.Random):
+        uid, other_uid = pick(rng), pick(rng)
+        kind = idx % 4
+        try:
+            if kind == 0:
+                ledger.deposit(uid, amount)
+            elif kind == 1:
+                ledger.withdraw(uid, amount)
+            elif kind == 2:
+                ledger.transfer(uid, other_uid, amount)
+            else:
+                ledger.account(uid)
+        except LedgerError:
+            pass
+
+    def client_fn(seed: int):
+        rng = random.Random(seed)
+        local = []
+        for idx in range(args.ops_per_thread):
+            start = time.perf_counter()
+            if mode == "global":
+                with global_mtx:
+                    op(idx, rng)
+            else:
+                op(idx, rng)
+            local.append(time.perf_counter() - start)
+        with stats_mtx:
+            latencies.extend(local)
+
+    clients = [
+        Thread(target=client_fn, args=(args.seed + idx,)) for idx in range(num_threads)
+    ]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+
+    def pct(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6
+
+    return {
+        "ops_per_s": len(latencies) / duration,
+        "p50_us": pct(0.5),
+        "p99_us": pct(0.99),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    p.add_argument("--accounts", type=int, default=10000)
+    p.add_argument("--ops-per-thread", type=int, default=2000)
+    p.add_argument(
+        "--workloads", nargs="+", choices=["uniform", "hot"], default=["uniform", "hot"]
+    )
+    p.add_argument("--hot-accounts", type=int, default=4)
+    p.add_argument("--hot-fraction", type=float, default=0.9)
+    p.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["global", "accounts"],
+        default=["global", "accounts"],
+    )
+    p.add_argument("--wal", action="store_true")
+    p.add_argument("--seed", type=int, default=0)
+
+    args = p.parse_args()
+
+    print(
+        f"{'workload':>8} {'mode':>8} {'threads':>8} {'ops/s':>10} "
+        f"{'p50 [us]':>10} {'p99 [us]':>10}"
+    )
+    for workload in args.workloads:
+        for mode in args.modes:
+            for num_threads in args.threads:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    ledger = make_ledger(args.accounts, tmpdir if args.wal else None)
+                    res = run(ledger, args, mode, workload, num_threads)
+                print(
+                    f"{workload:>8} {mode:>8} {num_threads:>8} "
+                    f"{res['ops_per_s']:>10.1f} {res['p50_us']:>10.1f} "
+                    f"{res['p99_us']:>10.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import random
+from paxos.failure_detector import PhiAccrualDetector
+
+# Simulates the prober watching one worker that the chaos orchestrator kills
+# every --kill-every seconds and restarts after --restart-after, while live
+# workers occasionally stall (load spikes, GC pauses) long enough for probes
+# to time out. For each detector this reports how long after a crash it fires
+# and how often it fires on a live node.
+
+
+def parse_bounds(bounds):
+    if len(bounds) > 1:
+        avg, max_dev = bounds[:2]
+        return (avg - max_dev, avg + max_dev)
+    return (bounds[0], bounds[0])
+
+
+def timeline(args, rng: random.Random):
+    # Returns the [crash, restart) intervals and the stalls of the live node.
+    crashes, t = [], 0.0
+    while True:
+        t += rng.uniform(*parse_bounds(args.kill_every))
+        if t >= args.duration:
+            break
+        restart = t + rng.uniform(*parse_bounds(args.restart_after))
+        crashes.append((t, restart))
+        t = restart
+
+    stalls, t = [], 0.0
+    while args.stall_rate > 0:
+        t += rng.expovariate(args.stall_rate)
+        if t >= args.duration:
+            break
+        stalls.append((t, t + rng.expovariate(1.0 / args.stall_mean)))
+
+    return crashes, stalls
+
+
+def run(args, crashes, stalls, make_detector, rng: random.Random):
+    period, timeout = args.probe_period, args.probe_timeout
+    detector = make_detector()
+    detect_times, false_positives = [], 0
+    crash_idx, stall_idx = 0, 0
+    suspected, reported = False, False
+
+    num_rounds = int(args.duration / period)
+    for k in range(num_rounds):
+        t = k * period
+        while crash_idx < len(crashes) and crashes[crash_idx][1] <= t:
+            crash_idx += 1
+            reported = False
+        while stall_idx < len(stalls) and stalls[stall_idx][1] <= t:
+            stall_idx += 1
+
+        down = crash_idx < len(crashes) and crashes[crash_idx][0] <= t
+        stalled = stall_idx < len(stalls) and stalls[stall_idx][0] <= t
+        rtt = rng.lognormvariate(0.0, 0.5) * args.rtt_ms / 1e3
+        if not down and not stalled and rtt < timeout:
+            detector.heartbeat(t + rtt)
+
+        now = t + timeout
+        was_suspected, suspected = suspected, detector.suspected(now)
+        if suspected and not was_suspected:
+            if down and not reported:
+                detect_times.append(now - crashes[crash_idx][0])
+                reported = True
+            elif not down:
+                false_positives += 1
+
+    return detect_times, false_positives
+
+
+class NaiveDetector:
+    # What the prober used to do: a single failed probe means dead.
+    def __init__(self, period: float):
+        self.period = period
+        self.last_ok = None
+
+    def heartbeat(self, now):
+        self.last_ok = now
+
+    def suspected(self, now):
+        ok = self.last_ok is not None and now - self.last_ok < 1e-9 + self.period
+        return not ok
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--probe-period", type=float, default=0.1)
+    p.add_argument("--probe-timeout", type=float, default=0.05)
+    p.add_argument("--rtt-ms", type=float, default=5.0)
+    p.add_argument(
+        "--kill-every", type=float, nargs="+", default=[5.0, 1.0], metavar="MEAN"
+    )
+    p.add_argument(
+        "--restart-after", type=float, nargs="+", default=[2.0, 0.5], metavar="MEAN"
+    )
+    p.add_argument("--stall-rate", type=float, default=0.05)
+    p.add_argument("--stall-mean", type=float, default=0.2)
+    p.add_argument("--thresholds", type=float, nargs="+", default=[1, 2, 4, 8, 12, 16])
+    p.add_argument("--min-std", type=float)
+    p.add_argument("--duration", type=float, default=3600.0)
+    p.add_argument("--seed", type=int, default=0)
+
+    args = p.parse_args()
+    min_std = args.min_std or args.probe_period / 2
+
+    crashes, stalls = timeline(args, random.Random(args.seed))
+    hours = args.duration / 3600
+
+    detectors = [("naive", lambda: NaiveDetector(args.probe_period))]
+    for threshold in args.thresholds:
+        detectors.append(
+            (
+                f"phi>{threshold:g}",
+                lambda threshold=threshold: PhiAccrualDetector(
+                    threshold=threshold,
+                    expected_interval=args.probe_period,
+                    min_std=min_std,
+                    now=0.0,
+                ),
+            )
+        )
+
+    print(f"{len(crashes)} crashes, {len(stalls)} stalls over {hours:g} h")
+    print(
+        f"{'detector':>10} {'detected':>9} {'mean [ms]':>10} "
+        f"{'p99 [ms]':>10} {'false pos/h':>12}"
+    )
+    for name, make_detector in detectors:
+        detect_times, false_positives = run(
+            args, crashes, stalls, make_detector, random.Random(args.seed)
+        )
+        detect_times.sort()
+        mean = sum(detect_times) / len(detect_times) if detect_times else 0.0
+        p99 = detect_times[int(0.99 * (len(detect_times) - 1))] if detect_times else 0.0
+        print(
+            f"{name:>10} {len(detect_times):>9} {mean * 1e3:>10.1f} "
+            f"{p99 * 1e3:>10.1f} {false_positives / hours:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
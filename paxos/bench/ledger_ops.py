@@ -0,0 +1,90 @@
+import argparse
+import random
+import time
+import tracemalloc
+from paxos.worker.ledger import Ledger, LedgerError
+from paxos.worker.store import ArrayAccounts
+
+
+def make_ledger(num_accounts: int, store: str = "dict", scale: int = 2) -> Ledger:
+    accounts = ArrayAccounts(scale) if store == "array" else {}
+    ledger = Ledger(accounts=accounts, next_uid=0)
+    for _ in range(num_accounts):
+        ledger.open_acct()
+    # Funded, so that withdrawals and transfers go through instead of being
+    # rolled back.
+    amount = ledger.to_amount("1000000")
+    for uid in range(num_accounts):
+        ledger.deposit(uid, amount)
+    return ledger
+
+
+def measure_memory(num_accounts: int, store: str) -> float:
+    # Bytes allocated per account by a ledger with funded accounts.
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    ledger = make_ledger(num_accounts, store)
+    amount = ledger.to_amount("12.34")
+    for uid in range(num_accounts):
+        ledger.deposit(uid, amount)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del ledger
+    return (after - before) / num_accounts
+
+
+def time_ops(ledger: Ledger, num_ops: int) -> float:
+    uids = [random.randrange(ledger.next_uid) for _ in range(2 * num_ops)]
+    # Converted once, the way Ledger.execute does for each operation.
+    amount = ledger.to_amount("1.00")
+
+    start = time.perf_counter()
+    for idx in range(num_ops):
+        op = idx % 4
+        uid, other_uid = uids[2 * idx], uids[2 * idx + 1]
+        try:
+            if op == 0:
+                ledger.deposit(uid, amount)
+            elif op == 1:
+                ledger.withdraw(uid, amount)
+            elif op == 2:
+                ledger.transfer(uid, other_uid, amount)
+            else:
+                ledger.account(uid)
+        except LedgerError:
+            pass
+    return (time.perf_counter() - start) / num_ops
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--num-accounts",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000, 100000],
+    )
+    p.add_argument("--num-ops", type=int, default=20000)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument(
+        "--store", choices=["dict", "array"], nargs="+", default=["dict", "array"]
+    )
+    p.add_argument("--memory", action="store_true")
+
+    args = p.parse_args()
+    random.seed(args.seed)
+
+    print(f"{'accounts':>10} {'store':>6} {'us/op':>10} {'B/acct':>10}")
+    for num_accounts in args.num_accounts:
+        for store in args.store:
+            ledger = make_ledger(num_accounts, store)
+            per_op = time_ops(ledger, args.num_ops)
+            del ledger
+            # Tracing slows allocations down, so memory is measured apart.
+            per_acct = measure_memory(num_accounts, store) if args.memory else None
+            mem = f"{per_acct:>10.1f}" if per_acct is not None else f"{'-':>10}"
+            print(f"{num_accounts:>10} {store:>6} {per_op * 1e6:>10.2f} {mem}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import socket
+import subprocess
+from subprocess import DEVNULL
+import signal
+import tempfile
+import threading
+from threading import Thread
+import time
+from pathlib import Path
+import requests
+
+
+def free_ports(num: int):
+    socks = [socket.socket() for _ in range(num)]
+    for sock in socks:
+        sock.bind(("", 0))
+    ports = [sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return ports
+
+
+def wait_for_leader(prober_url: str, timeout: float) -> str:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            resp = requests.get(f"{prober_url}/leader", timeout=1.0)
+            resp.raise_for_status()
+            leader = resp.json()["leader"]
+            if leader is not None:
+                return leader
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("No leader was elected.")
+
+
+def run_load(leader: str, num_clients: int, duration: float) -> dict:
+    latencies = []
+    errors = 0
+    mtx = threading.Lock()
+
+    resp = requests.post(f"{leader}/account")
+    resp.raise_for_status()
+    uid = resp.json()["uid"]
+
+    deadline = time.monotonic() + duration
+
+    def client_fn():
+        nonlocal errors
+        sess = requests.Session()
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                resp = sess.post(
+                    f"{leader}/deposit",
+                    json={"uid": uid, "amount": "1"},
+                    timeout=5.0,
+                )
+                ok = resp.status_code == 200
+            except requests.RequestException:
+                ok = False
+            latency = time.perf_counter() - start
+            with mtx:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+
+    clients = [Thread(target=client_fn) for _ in range(num_clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+
+    latencies.sort()
+
+    def pct(q):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e3
+
+    return {
+        "ops_per_s": len(latencies) / duration,
+        "errors": errors,
+        "p50_ms": pct(0.5),
+        "p99_ms": pct(0.99),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--windows", type=int, nargs="+", default=[1, 4, 16, 64])
+    p.add_argument("--num-workers", type=int, default=3)
+    p.add_argument("--num-clients", type=int, default=32)
+    p.add_argument("--duration", type=float, default=10.0)
+    p.add_argument("--wal", action="store_true")
+    p.add_argument("--server", choices=["flask", "asyncio"], default="flask")
+
+    args = p.parse_args()
+
+    print(
+        f"{'window':>8} {'ops/s':>10} {'p50 [ms]':>10} {'p99 [ms]':>10} {'errors':>8}"
+    )
+    for window in args.windows:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            prober_port, *worker_ports = free_ports(1 + args.num_workers)
+            orch_argv = [
+                "python3",
+                "-m",
+                "paxos.with_leader",
+                "--ledger-file",
+                str(Path(tmpdir) / "ledger.yml"),
+                "--worker-ports",
+                *(str(port) for port in worker_ports),
+                "--probe-period",
+                "0.1",
+                "--prober-port",
+                str(prober_port),
+                "--window",
+                str(window),
+                *(["--wal"] if args.wal else []),
+                "--server",
+                args.server,
+            ]
+            orch_proc = subprocess.Popen(orch_argv, stdout=DEVNULL, stderr=DEVNULL)
+
+            try:
+                leader = wait_for_leader(f"http://localhost:{prober_port}", 30.0)
+                res = run_load(leader, args.num_clients, args.duration)
+            finally:
+                orch_proc.send_signal(signal.SIGINT)
+                orch_proc.wait()
+
+        p50, p99 = res["p50_ms"] or 0.0, res["p99_ms"] or 0.0
+        print(
+            f"{window:>8} {res['ops_per_s']:>10.1f} {p50:>10.2f} "
+            f"{p99:>10.2f} {res['errors']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
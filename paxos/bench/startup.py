@@ -0,0 +1,60 @@
+import argparse
+import tempfile
+import time
+from decimal import Decimal
+from pathlib import Path
+from paxos.worker.ledger import Account, FileLedger
+
+
+def time_load(fpath: Path, num_reads: int) -> tuple:
+    start = time.perf_counter()
+    ledger = FileLedger(fpath=fpath)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for idx in range(num_reads):
+        ledger.account(idx % ledger.next_uid)
+    read_time = time.perf_counter() - start
+
+    return load_time, read_time
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "--num-accounts",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+    )
+    p.add_argument("--num-reads", type=int, default=1000)
+
+    args = p.parse_args()
+
+    print(
+        f"{'accounts':>10} {'format':>8} {'size [B]':>12} "
+        f"{'load [ms]':>10} {'reads [ms]':>11}"
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for num_accounts in args.num_accounts:
+            yaml_path = Path(tmpdir) / f"ledger-{num_accounts}.yml"
+            ledger = FileLedger(fpath=yaml_path)
+            for uid in range(num_accounts):
+                ledger.accounts[uid] = Account(uid=uid, funds=Decimal(uid) / 4)
+            ledger.next_uid = num_accounts
+            ledger.export(yaml_path, "yaml")
+
+            bin_path = Path(tmpdir) / f"ledger-{num_accounts}.bin"
+            ledger.export(bin_path, "binary")
+
+            for fmt, fpath in (("yaml", yaml_path), ("binary", bin_path)):
+                load_time, read_time = time_load(fpath, args.num_reads)
+                size = fpath.stat().st_size
+                print(
+                    f"{num_accounts:>10} {fmt:>8} {size:>12} "
+                    f"{load_time * 1e3:>10.2f} {read_time * 1e3:>11.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
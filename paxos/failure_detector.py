@@ -0,0 +1,75 @@
+from __future__ import annotations
+from typing import Optional
+from collections import deque
+import math
+import time
+
+
+# Phi-accrual failure detector (Hayashibara et al.). Rather than a yes/no
+# verdict after a fixed timeout, it reports how unlikely it is, given the
+# inter-arrival times seen so far, that the next heartbeat is merely late:
+# phi = -log10(P(interval > time since the last heartbeat)). A threshold of 8
+# means a 1e-8 chance of the suspicion being wrong under the learned
+# distribution, which adapts as arrivals get more or less regular.
+class PhiAccrualDetector:
+    def __init__(
+        self,
+        threshold: float,
+        expected_interval: float,
+        min_std: float,
+        window: int = 1000,
+        acceptable_pause: float = 0.0,
+        now: Optional[float] = None,
+    ):
+        self.threshold = threshold
+        self.expected_interval = expected_interval
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.intervals = deque(maxlen=window)
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        # A node that never answers is measured from when we started waiting.
+        self.last = time.monotonic() if now is None else now
+
+    def reset(self):
+        self.intervals.clear()
+        self._sum = self._sum_sq = 0.0
+
+    def heartbeat(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        if self.suspected(now):
+            # The node is back after being declared dead; the downtime is not
+            # an inter-arrival sample.
+            self.reset()
+        else:
+            interval = now - self.last
+            if len(self.intervals) == self.intervals.maxlen:
+                evicted = self.intervals[0]
+                self._sum -= evicted
+                self._sum_sq -= evicted * evicted
+            self.intervals.append(interval)
+            self._sum += interval
+            self._sum_sq += interval * interval
+        self.last = now
+
+    def _stats(self):
+        if not self.intervals:
+            return self.expected_interval, self.min_std
+        num = len(self.intervals)
+        mean = self._sum / num
+        var = max(0.0, self._sum_sq / num - mean * mean)
+        return mean, max(math.sqrt(var), self.min_std)
+
+    def phi(self, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        mean, std = self._stats()
+        elapsed = now - self.last
+        # Logistic approximation of the normal CDF, as used by Akka/Cassandra.
+        y = max((elapsed - mean - self.acceptable_pause) / std, -5.0)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(max(e / (1.0 + e), 1e-300))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def suspected(self, now: Optional[float] = None) -> bool:
+        return self.phi(now) > self.threshold
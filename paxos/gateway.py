@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import re
+import random
+import time
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+import aiohttp
+
+# Headers that describe a single hop and must not be passed along.
+HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Workers apply a write carrying this key only once, so it may be retried.
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+KEYED_PATHS = {"/account", "/deposit", "/withdrawal", "/transfer", "/batch"}
+ACCOUNT_PATH = re.compile(r"^/account/(\d+)$")
+# Query parameters that let any replica serve an account read.
+STALENESS_PARAMS = ("max_lag", "max_age")
+
+
+class Shard:
+    # One replica group. With a prober, every request goes to the leader it
+    # reports; without one (leaderless mode), to the worker with the fewest
+    # requests in flight.
+    def __init__(self, workers, prober_url):
+        self.workers = workers
+        self.prober_url = prober_url
+        self.leader = None
+        self.epoch = None
+        self.leader_changed = None
+        self.outstanding = {addr: 0 for addr in workers}
+        self.down_until = {addr: 0.0 for addr in workers}
+
+
+def routing_uid(path: str, body: bytes):
+    # The account a request is about: the one in the path, or else the first
+    # one named in the body (the source of a transfer).
+    match = ACCOUNT_PATH.match(path)
+    if match is not None:
+        return int(match.group(1))
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    for item in [data, *data.get("ops", [])]:
+        for key in ("uid", "from_uid"):
+            if isinstance(item, dict) and isinstance(item.get(key), int):
+                return item[key]
+    return None
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, required=True)
+    # Repeated once per shard, in shard order.
+    p.add_argument("--workers", nargs="+", action="append", required=True)
+    p.add_argument("--prober-url", action="append")
+    p.add_argument("--failover-timeout", type=float, default=5.0)
+    p.add_argument("--upstream-timeout", type=float, default=10.0)
+    p.add_argument("--max-connections", type=int, default=1024)
+    p.add_argument("-v", "--verbose", action="store_true")
+
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
+    logging.getLogger("aiohttp.access").setLevel(logging.WARN)
+
+    prober_urls = args.prober_url or []
+    if prober_urls and len(prober_urls) != len(args.workers):
+        p.error("Pass one --prober-url per --workers group.")
+    shards = [
+        Shard(workers, prober_urls[idx] if prober_urls else None)
+        for idx, workers in enumerate(args.workers)
+    ]
+    # Accounts are opened on each shard in turn.
+    next_shard = itertools.cycle(shards)
+    stats = {"requests": 0, "retries": 0, "failed": 0}
+    session = None
+
+    async def watch_leader(shard: Shard):
+        # Long-polls the prober, which answers as soon as the leader changes.
+        while True:
+            try:
+                params = {}
+                if shard.epoch is not None:
+                    params = {"after": shard.epoch, "timeout": 10.0}
+                async with session.get(
+                    f"{shard.prober_url}/leader",
+                    params=params,
+                    timeout=ClientTimeout(total=15.0),
+                ) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                await asyncio.sleep(0.2)
+                continue
+
+            if data["leader"] is not None and data["epoch"] != shard.epoch:
+                shard.leader, shard.epoch = data["leader"], data["epoch"]
+                logging.info(f"Leader is {shard.leader} (epoch {shard.epoch})")
+                shard.leader_changed.set()
+
+    def pick_shard(request: web.Request, body: bytes) -> Shard:
+        if len(shards) == 1:
+            return shards[0]
+        uid = routing_uid(request.path, body)
+        if uid is not None:
+            return shards[uid % len(shards)]
+        if request.method == "POST" and request.path in ("/account", "/batch"):
+            return next(next_shard)
+        return shards[0]
+
+    def pick_least_outstanding(shard: Shard):
+        now = time.monotonic()
+        up = [addr for addr in shard.workers if shard.down_until[addr] <= now]
+        candidates = up or shard.workers
+        fewest = min(shard.outstanding[addr] for addr in candidates)
+        return random.choice(
+            [addr for addr in candidates if shard.outstanding[addr] == fewest]
+        )
+
+    async def pick_upstream(shard: Shard, deadline: float, any_replica: bool):
+        if shard.prober_url is None or any_replica:
+            return pick_least_outstanding(shard)
+        # Requests that arrive before the first election are held back.
+        while shard.leader is None:
+            shard.leader_changed.clear()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(shard.leader_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+        return shard.leader
+
+    async def wait_for_failover(
+        shard: Shard, upstream: str, deadline: float, any_replica: bool
+    ):
+        if shard.prober_url is None or any_replica:
+            shard.down_until[upstream] = time.monotonic() + 1.0
+            return
+        if shard.leader == upstream:
+            shard.leader_changed.clear()
+            remaining = min(0.1, deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(shard.leader_changed.wait(), max(remaining, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def proxy(request: web.Request):
+        stats["requests"] += 1
+        body = await request.read()
+        headers = {
+            key: value
+            for key, value in request.headers.items()
+            if key.lower() not in HOP_HEADERS
+        }
+        idempotent = request.method in IDEMPOTENT_METHODS
+        # Only writes the client sent a key with are safe to send again once
+        # they may have reached a worker. No key is made up for the others,
+        # which would make them interfere with keyed writes in leaderless
+        # mode.
+        if request.method == "POST" and request.path in KEYED_PATHS:
+            idempotent = IDEMPOTENCY_HEADER in request.headers
+        deadline = time.monotonic() + args.failover_timeout
+        shard = pick_shard(request, body)
+        # Reads with a staleness bound are spread over the whole group; a
+        # replica too far behind refuses them and another one is tried.
+        any_replica = (
+            request.method == "GET"
+            and ACCOUNT_PATH.match(request.path) is not None
+            and any(param in request.query for param in STALENESS_PARAMS)
+        )
+
+        while True:
+            upstream = await pick_upstream(shard, deadline, any_replica)
+            if upstream is None:
+                break
+
+            shard.outstanding[upstream] += 1
+            try:
+                async with session.request(
+                    request.method,
+                    f"{upstream}{request.path_qs}",
+                    data=body,
+                    headers=headers,
+                ) as resp:
+                    content = await resp.read()
+                    retry = idempotent and resp.status == 503
+                    if not retry or time.monotonic() >= deadline:
+                        resp_headers = {
+                            key: value
+                            for key, value in resp.headers.items()
+                            if key.lower() not in HOP_HEADERS
+                        }
+                        return web.Response(
+                            body=content, status=resp.status, headers=resp_headers
+                        )
+            except aiohttp.ClientConnectorError:
+                # The request never reached the worker, so any method can be
+                # sent elsewhere.
+                pass
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not idempotent:
+                    stats["failed"] += 1
+                    raise web.HTTPBadGateway()
+            finally:
+                shard.outstanding[upstream] -= 1
+
+            if time.monotonic() >= deadline:
+                break
+            stats["retries"] += 1
+            await wait_for_failover(shard, upstream, deadline, any_replica)
+
+        stats["failed"] += 1
+        raise web.HTTPServiceUnavailable()
+
+    async def gateway_status(request: web.Request):
+        return web.json_response(
+            {
+                "shards": [
+                    {
+                        "leader": shard.leader,
+                        "epoch": shard.epoch,
+                        "outstanding": shard.outstanding,
+                    }
+                    for shard in shards
+                ],
+                **stats,
+            }
+        )
+
+    async def on_startup(app):
+        nonlocal session
+        # One pool of keep-alive connections to the workers, shared by all
+        # client connections.
+        session = ClientSession(
+            connector=TCPConnector(limit=args.max_connections),
+            timeout=ClientTimeout(total=args.upstream_timeout),
+            auto_decompress=False,
+        )
+        app["watchers"] = []
+        for shard in shards:
+            shard.leader_changed = asyncio.Event()
+            if shard.prober_url is not None:
+                app["watchers"].append(asyncio.create_task(watch_leader(shard)))
+
+    async def on_cleanup(app):
+        for watcher in app["watchers"]:
+            watcher.cancel()
+        await session.close()
+
+    app = web.Application(client_max_size=64 * 1024**2)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_get("/gateway/status", gateway_status)
+    app.router.add_route("*", "/{path:.*}", proxy)
+    web.run_app(app, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
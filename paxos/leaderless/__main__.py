@@ -18,6 +18,8 @@ from urllib.parse import urlparse
 from flask import Flask, request
 from marshmallow import Schema, fields
 import os
+import json
+from paxos.worker.consensus import quorum_sizes
 from multiprocessing import Process
 import sys
 
@@ -59,17 +61,41 @@ def main():
         metavar=("MEAN", "MAX_DEV"),
     )
     p.add_argument("--ledger-file", required=True)
+    p.add_argument("--events-file")
+    p.add_argument("--snapshot-format", choices=["yaml", "binary"])
+    p.add_argument("--store", choices=["dict", "array"])
+    p.add_argument("--window", type=int)
+    p.add_argument("--lease-duration", type=float)
+    p.add_argument("--server", choices=["flask", "asyncio"])
+    p.add_argument("--wal", action="store_true")
+    # EPaxos lets every worker commit writes itself instead of forwarding
+    # them to whichever one got elected.
+    p.add_argument("--consensus", choices=["multipaxos", "epaxos"])
+    # Flexible Paxos quorum sizes within each replica group, for elections
+    # (Q1) and accept rounds (Q2); |Q1| + |Q2| must exceed the group size.
+    p.add_argument("--q1", type=int)
+    p.add_argument("--q2", type=int)
 
     g = p.add_mutually_exclusive_group()
     g.add_argument("--num-workers", type=int)
     g.add_argument("--worker-ports", type=int, nargs="*")
 
     p.add_argument("--gateway-port", type=int)
+    p.add_argument("--gateway", choices=["nginx", "builtin"], default="nginx")
+
+    # Each shard is a replica group of its own.
+    p.add_argument("--num-shards", type=int, default=1)
 
     p.add_argument("-v", "--verbose", action="store_true")
 
     args = p.parse_args()
 
+    if args.num_shards > 1 and args.gateway_port is not None:
+        if args.gateway != "builtin":
+            p.error("Routing requests to shards needs --gateway builtin.")
+    if args.worker_ports and len(args.worker_ports) % args.num_shards != 0:
+        p.error("The worker ports must split evenly into the shards.")
+
     logging.getLogger("werkzeug").setLevel(logging.WARN)
     logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
 
@@ -85,7 +111,7 @@ def main():
             worker_ports = args.worker_ports
         else:
             worker_ports = []
-            for _ in range(args.num_workers):
+            for _ in range(args.num_workers * args.num_shards):
                 worker_sock = get_socket()
                 worker_ports.append(port_of_socket(worker_sock))
                 rsvd.append(worker_sock)
@@ -109,10 +135,31 @@ def main():
     ledger_file = Path(args.ledger_file).absolute()
 
     worker_addrs = [f"http://localhost:{p}" for p in worker_ports]
+    shard_size = len(worker_ports) // args.num_shards
+    if args.q1 is not None or args.q2 is not None:
+        if args.consensus == "epaxos":
+            p.error("--q1/--q2 only apply to --consensus multipaxos.")
+        try:
+            quorum_sizes(shard_size, args.q1, args.q2)
+        except ValueError as e:
+            p.error(str(e))
+    shard_ports = [
+        worker_ports[i * shard_size : (i + 1) * shard_size]
+        for i in range(args.num_shards)
+    ]
+    shard_addrs = [[f"http://localhost:{p}" for p in ports] for ports in shard_ports]
+    shard_of_port = {
+        port: shard_id for shard_id, ports in enumerate(shard_ports) for port in ports
+    }
     other_addrs = {
-        port: {*worker_addrs} - {f"http://localhost:{port}"} for port in worker_ports
+        port: {*shard_addrs[shard_of_port[port]]} - {f"http://localhost:{port}"}
+        for port in worker_ports
     }
 
+    def worker_ledger_file(port: int):
+        # Each replica keeps its own copy of the ledger and its Paxos log.
+        return ledger_file.with_name(f"{ledger_file.stem}.{port}{ledger_file.suffix}")
+
     def spawn_worker(port: int):
         return subprocess.Popen(
             [
@@ -122,8 +169,39 @@ def main():
                 "--port",
                 str(port),
                 "--ledger-file",
-                str(ledger_file),
+                str(worker_ledger_file(port)),
                 *(["-v"] if args.verbose else []),
+                *(
+                    ["--snapshot-format", args.snapshot_format]
+                    if args.snapshot_format is not None
+                    else []
+                ),
+                *(["--store", args.store] if args.store is not None else []),
+                *(["--window", str(args.window)] if args.window is not None else []),
+                *(
+                    ["--lease-duration", str(args.lease_duration)]
+                    if args.lease_duration is not None
+                    else []
+                ),
+                *(["--wal"] if args.wal else []),
+                *(["--server", args.server] if args.server is not None else []),
+                *(["--q1", str(args.q1)] if args.q1 is not None else []),
+                *(["--q2", str(args.q2)] if args.q2 is not None else []),
+                *(
+                    ["--consensus", args.consensus]
+                    if args.consensus is not None
+                    else []
+                ),
+                *(
+                    [
+                        "--shard-id",
+                        str(shard_of_port[port]),
+                        "--shard-groups",
+                        *(",".join(addrs) for addrs in shard_addrs),
+                    ]
+                    if args.num_shards > 1
+                    else []
+                ),
                 "--other-nodes",
                 *other_addrs[port],
             ],
@@ -138,7 +216,17 @@ def main():
 
     logging.info(f"Workers: {worker_addrs}")
 
-    if args.gateway_port is not None:
+    if args.gateway_port is not None and args.gateway == "builtin":
+        gateway_argv = ["python3", "-m", "paxos.gateway"]
+        gateway_argv.extend(["--port", str(args.gateway_port)])
+        for addrs in shard_addrs:
+            gateway_argv.extend(["--workers", *addrs])
+        if args.verbose:
+            gateway_argv.extend(["-v"])
+
+        gateway_proc = subprocess.Popen(gateway_argv, stdout=DEVNULL, stdin=DEVNULL)
+        logging.info(f"Running gateway on http://localhost:{args.gateway_port}")
+    elif args.gateway_port is not None:
         gateway_conf = tempfile.NamedTemporaryFile(mode="w", delete=False)
 
         script_dir = Path(__file__).parent
@@ -165,6 +253,16 @@ def main():
     finishing = threading.Event()
     any_alive_cv = threading.Condition()
 
+    events_mtx = threading.Lock()
+
+    def record_event(event: str, worker: dict):
+        # Lets benchmarks line up latency spikes with kills and restarts.
+        if args.events_file is None:
+            return
+        line = json.dumps({"ts": time.time(), "event": event, "port": worker["port"]})
+        with events_mtx, open(args.events_file, "a") as f:
+            f.write(line + "\n")
+
     def killer_fn():
         timers_mtx = threading.Lock()
         timers = {}
@@ -187,6 +285,7 @@ def main():
             worker["proc"].terminate()
             worker["alive"] = False
             logging.info(f"Terminated worker {worker_info}")
+            record_event("kill", worker)
 
             if restart_after is not None:
                 min_delay, max_delay = restart_after
@@ -204,6 +303,7 @@ def main():
                             "port": worker["port"],
                         }
                         logging.info(f"Restarted worker {worker_info}")
+                        record_event("restart", worker)
 
                         any_alive_cv.notify()
 
@@ -1,29 +1,39 @@
 import threading
 from threading import Thread
 import argparse
-import random
 import time
 import requests
 import jinja2
 from pathlib import Path
 import os
 import signal
-from flask import Flask, request, jsonify, g
-from marshmallow import Schema, fields, ValidationError
+from flask import Flask, Response, request, jsonify, g
+import json
+from marshmallow import Schema, fields, validate, ValidationError
 import http
 import tempfile
 import subprocess
 import atexit
 import logging
 from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
 from urllib.parse import urlparse, urljoin
+from paxos.failure_detector import PhiAccrualDetector
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("--probe-period", type=float, required=True)
+    p.add_argument("--probe-timeout", type=float)
+    p.add_argument("--phi-threshold", type=float, default=8.0)
+    p.add_argument("--phi-min-std", type=float)
     p.add_argument("--port", type=int, required=True)
     p.add_argument("--leader-url")
+    p.add_argument("--lease-duration", type=float, default=1.0)
+    p.add_argument("--election-timeout", type=float, default=2.0)
+    p.add_argument("--leader-wait", type=float, default=2.0)
+    p.add_argument("--max-watch-time", type=float, default=30.0)
     g = p.add_mutually_exclusive_group()
     g.add_argument("--workers", type=str, nargs="*")
     g.add_argument("--worker-ports", type=int, nargs="*")
@@ -41,57 +51,175 @@ def main():
     else:
         workers = []
 
+    # Probes must not outlive the period they belong to.
+    probe_timeout = args.probe_timeout or min(args.probe_period, 0.5)
+
     mtx = threading.RLock()
-    last_probed = None
     leader = None
+    # Bumped on every leader change, so that watchers can ask for anything
+    # newer than what they have.
+    epoch = 0
+    health = {
+        addr: {
+            "alive": None,
+            "phi": 0.0,
+            "rtt_ms": None,
+            "last_ok": None,
+            "failures": 0,
+        }
+        for addr in workers
+    }
+    # A node is declared dead once its phi exceeds the threshold, rather than
+    # on the first failed probe; see paxos.bench.failure_detector for the
+    # detection time vs false positive trade-off.
+    detectors = {
+        addr: PhiAccrualDetector(
+            threshold=args.phi_threshold,
+            expected_interval=args.probe_period,
+            min_std=args.phi_min_std or args.probe_period / 2,
+        )
+        for addr in workers
+    }
+
+    # Elections run in the background: whoever notices that one is needed
+    # just flags it, and /leader answers from the cached leader.
+    leader_cv = threading.Condition(mtx)
+    election_needed = False
+    election = {
+        "in_progress": False,
+        "num_elections": 0,
+        "last_duration_ms": None,
+        "last_rounds": None,
+    }
+    election_pool = ThreadPoolExecutor(max_workers=max(1, len(workers)))
+
+    def request_election():
+        nonlocal election_needed
+        with mtx:
+            election_needed = True
+            leader_cv.notify_all()
+
+    def election_round():
+        # Every live worker is asked at once; if several succeed, the last
+        # one to be elected (highest ballot) is the leader.
+        with mtx:
+            candidates = [
+                addr for addr in workers if health[addr]["alive"] is not False
+            ]
+        futures = [
+            election_pool.submit(
+                requests.post,
+                f"{addr}/admin/elect_leader",
+                timeout=args.election_timeout,
+            )
+            for addr in candidates or workers
+        ]
 
-    def elect_leader():
+        # Workers refuse to elect anyone while the previous leader's lease
+        # may still be valid, and report how long that will take.
+        elected, retry_after = None, args.lease_duration
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                resp = fut.result()
+                data = resp.json()
+            except (requests.RequestException, ValueError):
+                continue
+            if resp.status_code == http.HTTPStatus.SERVICE_UNAVAILABLE:
+                retry_after = min(retry_after, data.get("retry_after", retry_after))
+            elif resp.ok and (elected is None or data["ballot"] > elected["ballot"]):
+                elected = data
+        return elected, retry_after
+
+    def election_thread_fn():
+        nonlocal leader, epoch, election_needed
         while True:
-            for addr in workers:
-                other_nodes = list(workers)
-                other_nodes.remove(addr)
+            with mtx:
+                leader_cv.wait_for(lambda: election_needed)
+                election["in_progress"] = True
 
+            start, rounds = time.monotonic(), 0
+            while True:
+                rounds += 1
+                elected, retry_after = election_round()
+                if elected is not None:
+                    break
+                time.sleep(max(retry_after, 0.05))
+            duration = time.monotonic() - start
+
+            with mtx:
+                if elected["leader"] != leader:
+                    leader = elected["leader"]
+                    epoch += 1
+                election_needed = False
+                election.update(
+                    in_progress=False,
+                    num_elections=election["num_elections"] + 1,
+                    last_duration_ms=duration * 1e3,
+                    last_rounds=rounds,
+                )
+                leader_cv.notify_all()
+            logging.info(f"Elected leader {leader} in {duration * 1e3:.1f}ms")
+
+            if args.leader_url is not None:
                 try:
-                    resp = requests.post(f"{addr}/admin/elect_leader")
-                    resp.raise_for_status()
-
-                    data = resp.json()
-                    with mtx:
-                        nonlocal leader
-                        leader = data["leader"]
-                        logging.info(f"Elected leader {leader}")
-                        if args.leader_url is not None:
-                            requests.put(
-                                args.leader_url,
-                                json={"leader": leader},
-                            )
-                    return
-                except:
-                    pass
-
-            time.sleep(1.0)
-
-    if args.leader_url is not None:
-        elect_leader()
+                    requests.put(
+                        args.leader_url,
+                        json={"leader": leader, "epoch": epoch},
+                        timeout=1.0,
+                    )
+                except requests.RequestException as e:
+                    logging.info(f"Pushing the leader failed: {e}")
+
+    election_thr = Thread(target=election_thread_fn, daemon=True)
+    election_thr.start()
+    request_election()
+
+    # Every worker is probed each period, concurrently and over its own
+    # keep-alive session, so detection time does not grow with the cluster.
+    sessions = {addr: requests.Session() for addr in workers}
+    probe_pool = ThreadPoolExecutor(max_workers=max(1, len(workers)))
+
+    def probe(addr):
+        start = time.perf_counter()
+        try:
+            req_url = urljoin(addr, "/admin/healthcheck")
+            resp = sessions[addr].get(req_url, timeout=probe_timeout)
+            resp.raise_for_status()
+            return time.perf_counter() - start, time.monotonic()
+        except requests.RequestException:
+            return None, None
 
     def probe_thread_fn():
         while True:
-            cur_addr = random.choice(workers)
+            round_start = time.monotonic()
+            futures = {addr: probe_pool.submit(probe, addr) for addr in workers}
+            concurrent.futures.wait(futures.values())
+
+            leader_died = False
             with mtx:
-                nonlocal last_probed
-                last_probed = cur_addr
+                for addr, fut in futures.items():
+                    (rtt, arrival), node = fut.result(), health[addr]
+                    if rtt is not None:
+                        detectors[addr].heartbeat(arrival)
+                        node.update(rtt_ms=rtt * 1e3, last_ok=time.time(), failures=0)
+                    else:
+                        node["failures"] += 1
 
-            try:
-                req_url = urljoin(cur_addr, "/admin/healthcheck")
-                resp = requests.get(req_url)
-                resp.raise_for_status()
-            except:
-                logging.info(f"Node {cur_addr} died [Leader is {leader}]")
-                if cur_addr == leader:
-                    logging.info(f"Leader died")
-                    elect_leader()
+                now = time.monotonic()
+                for addr, node in health.items():
+                    phi = detectors[addr].phi(now)
+                    alive = phi <= args.phi_threshold
+                    if not alive and node["alive"] is not False:
+                        logging.info(f"Node {addr} died [Leader is {leader}]")
+                    node.update(alive=alive, phi=phi)
+                    leader_died |= addr == leader and not alive
+
+            if leader_died:
+                logging.info(f"Leader died")
+                request_election()
 
-            time.sleep(args.probe_period)
+            elapsed = time.monotonic() - round_start
+            time.sleep(max(0.0, args.probe_period - elapsed))
 
     probe_thr = Thread(target=probe_thread_fn)
     probe_thr.start()
@@ -107,14 +235,62 @@ def main():
     @app.get("/status")
     def status():
         with mtx:
-            return {"last_probed": last_probed}
+            nodes = {addr: dict(node) for addr, node in health.items()}
+            return {
+                "leader": leader,
+                "epoch": epoch,
+                "nodes": nodes,
+                "election": dict(election),
+            }
+
+    class LeaderQuerySchema(Schema):
+        after = fields.Int()
+        timeout = fields.Float(validate=validate.Range(min=0))
 
     @app.get("/leader")
     def get_leader():
+        query = LeaderQuerySchema().load(request.args)
         with mtx:
-            if leader is None:
-                elect_leader()
-            return {"leader": leader}
+            if "after" in query:
+                # Long-poll: block until the leader changes from the epoch the
+                # client has. A client that is ahead of us (we restarted) is
+                # answered right away.
+                after = query["after"]
+                timeout = min(
+                    query.get("timeout", args.max_watch_time), args.max_watch_time
+                )
+                leader_cv.wait_for(
+                    lambda: epoch != after and leader is not None, timeout=timeout
+                )
+            elif leader is None:
+                request_election()
+                leader_cv.wait_for(lambda: leader is not None, timeout=args.leader_wait)
+            return {"leader": leader, "epoch": epoch}
+
+    @app.get("/leader/stream")
+    def stream_leader():
+        # Server-sent events: one "leader" event now and one per change, with
+        # comments in between so that dead clients are noticed.
+        def events():
+            last_epoch = None
+            while True:
+                with mtx:
+                    leader_cv.wait_for(
+                        lambda: epoch != last_epoch and leader is not None,
+                        timeout=args.max_watch_time,
+                    )
+                    if epoch == last_epoch or leader is None:
+                        data = None
+                    else:
+                        last_epoch = epoch
+                        data = json.dumps({"leader": leader, "epoch": epoch})
+                if data is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"event: leader\ndata: {data}\n\n"
+
+        headers = {"Cache-Control": "no-cache"}
+        return Response(events(), mimetype="text/event-stream", headers=headers)
 
     app.run(debug=False, port=args.port)
 
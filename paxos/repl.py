@@ -3,9 +3,13 @@ from prompt_toolkit.completion import WordCompleter
 import argparse
 from urllib.parse import urljoin
 import shlex
-import io
 import requests
 import http
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Tuple
 
 
 def main():
@@ -13,6 +17,11 @@ def main():
     p.add_argument("-u", "--url")
     p.add_argument("-p", "--port")
     p.add_argument("-e", "--exec")
+    # Runs the commands of a script, one per line ("-" or a pipe: stdin).
+    p.add_argument("-f", "--file")
+    p.add_argument("-c", "--concurrency", type=int, default=1)
+    p.add_argument("-b", "--batch-size", type=int, default=1)
+    p.add_argument("-q", "--quiet", action="store_true")
 
     args = p.parse_args()
     if args.url is not None:
@@ -28,7 +37,7 @@ def main():
     help_p.add_argument(
         "command",
         default=None,
-        choices=["account", "withdraw", "deposit", "transfer"],
+        choices=["account", "withdraw", "deposit", "transfer", "batch"],
     )
 
     account_p = opt_sp.add_parser("account")
@@ -49,14 +58,37 @@ def main():
     transfer_p.add_argument("to", type=int)
     transfer_p.add_argument("amount", type=str)
 
-    def on_prompt(text):
-        try:
-            args = opt_p.parse_args(shlex.split(text))
-        except SystemExit as e:
-            return
+    batch_p = opt_sp.add_parser("batch")
+    batch_p.add_argument("--atomic", action="store_true")
+    batch_p.add_argument("commands", nargs="+", metavar="command")
+
+    def batch_op(args):
+        if args.endpoint == "account" and args.create:
+            return {"op": "open_acct"}
+        elif args.endpoint == "withdraw":
+            return {"op": "withdraw", "uid": args.account_id, "amount": args.amount}
+        elif args.endpoint == "deposit":
+            return {"op": "deposit", "uid": args.account_id, "amount": args.amount}
+        elif args.endpoint == "transfer":
+            return {
+                "op": "transfer",
+                "from_uid": args.from_,
+                "to_uid": args.to,
+                "amount": args.amount,
+            }
+
+    def batch_result(result) -> Tuple[bool, str]:
+        if "error" in result:
+            return False, f"[{result['error']}] {result['details']}"
+        elif "uid" in result:
+            return True, f"Created account #{result['uid']}"
+        else:
+            return True, "OK"
 
+    def execute(sess, args) -> Tuple[bool, List[str]]:
+        # Runs a parsed command; returns whether it succeeded and what to print.
+        lines = []
         try:
-            resp = None
             if args.endpoint == "help":
                 if args.command is not None:
                     p = {
@@ -64,34 +96,35 @@ def main():
                         "withdraw": withdraw_p,
                         "deposit": deposit_p,
                         "transfer": transfer_p,
+                        "batch": batch_p,
                     }[args.command]
-                    p.print_help()
+                    lines.append(p.format_help())
                 else:
-                    opt_p.print_help()
+                    lines.append(opt_p.format_help())
             elif args.endpoint == "account":
                 if args.create:
                     req_url = urljoin(url, "/account")
-                    resp = requests.post(req_url)
+                    resp = sess.post(req_url)
                     resp.raise_for_status()
                     data = resp.json()
-                    print(f"Created account #{data['uid']}")
+                    lines.append(f"Created account #{data['uid']}")
                 elif args.status is not None:
                     req_url = urljoin(url, f"/account/{args.status}")
-                    resp = requests.get(req_url)
+                    resp = sess.get(req_url)
                     resp.raise_for_status()
                     data = resp.json()
-                    print(f"Account #{data['uid']}: ${data['funds']}")
+                    lines.append(f"Account #{data['uid']}: ${data['funds']}")
                 else:
-                    account_p.print_help()
+                    lines.append(account_p.format_help())
             elif args.endpoint == "withdraw":
-                req_url = urljoin(url, "/withdraw")
+                req_url = urljoin(url, "/withdrawal")
                 payload = {"uid": args.account_id, "amount": args.amount}
-                resp = requests.post(req_url, json=payload)
+                resp = sess.post(req_url, json=payload)
                 resp.raise_for_status()
             elif args.endpoint == "deposit":
                 req_url = urljoin(url, "/deposit")
                 payload = {"uid": args.account_id, "amount": args.amount}
-                resp = requests.post(req_url, json=payload)
+                resp = sess.post(req_url, json=payload)
                 resp.raise_for_status()
             elif args.endpoint == "transfer":
                 req_url = urljoin(url, "/transfer")
@@ -100,17 +133,167 @@ def main():
                     "to_uid": args.to,
                     "amount": args.amount,
                 }
-                resp = requests.post(req_url, json=payload)
+                resp = sess.post(req_url, json=payload)
                 resp.raise_for_status()
+            elif args.endpoint == "batch":
+                ops = []
+                for command in args.commands:
+                    try:
+                        op = batch_op(opt_p.parse_args(shlex.split(command)))
+                    except SystemExit as e:
+                        return False, lines
+                    if op is None:
+                        return False, [f"Cannot batch {command!r}"]
+                    ops.append(op)
+
+                req_url = urljoin(url, "/batch")
+                payload = {"ops": ops, "atomic": args.atomic}
+                resp = sess.post(req_url, json=payload)
+                resp.raise_for_status()
+                all_ok = True
+                for command, result in zip(args.commands, resp.json()["results"]):
+                    ok, text = batch_result(result)
+                    all_ok = all_ok and ok
+                    lines.append(f"{command}: {text}")
+                return all_ok, lines
         except requests.HTTPError as e:
-            if e.errno == http.HTTPStatus.BAD_REQUEST.value:
-                error_data = resp.json()
-                print(f"[{error_data['error']}] {error_data['details']}")
-            else:
-                print(e)
+            if e.response.status_code == http.HTTPStatus.BAD_REQUEST.value:
+                try:
+                    error_data = e.response.json()
+                    return False, [f"[{error_data['error']}] {error_data['details']}"]
+                except (ValueError, KeyError):
+                    # Not from the worker, e.g. from a proxy in front of it.
+                    pass
+            return False, [str(e)]
+        except requests.RequestException as e:
+            return False, [str(e)]
+        return True, lines
+
+    def on_prompt(text):
+        try:
+            args = opt_p.parse_args(shlex.split(text))
+        except SystemExit as e:
+            return
+
+        _, lines = execute(requests, args)
+        for line in lines:
+            print(line)
+
+    def run_script(f):
+        # Commands that can go in a batch are sent together, up to
+        # --batch-size of them; any other command is sent on its own, after
+        # the ones before it. Past --concurrency 1, commands may run (and
+        # take effect) out of order.
+        sess = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+        sess.mount("http://", adapter)
+        sess.mount("https://", adapter)
+        print_mtx = threading.Lock()
+        in_flight = threading.BoundedSemaphore(2 * args.concurrency)
+        latencies, num_ok, num_errors, num_requests = [], 0, 0, 0
+
+        def report(lineno: int, ok: bool, lines: List[str]):
+            nonlocal num_ok, num_errors
+            with print_mtx:
+                num_ok += ok
+                num_errors += not ok
+                for line in lines:
+                    if not ok or not args.quiet:
+                        print(f"{lineno}: {line}")
+
+        def run_unit(unit):
+            nonlocal num_requests
+            start = time.perf_counter()
+            try:
+                if len(unit) == 1:
+                    lineno, cmd_args = unit[0]
+                    report(lineno, *execute(sess, cmd_args))
+                else:
+                    ops = [batch_op(cmd_args) for _, cmd_args in unit]
+                    req_url = urljoin(url, "/batch")
+                    try:
+                        resp = sess.post(req_url, json={"ops": ops})
+                        resp.raise_for_status()
+                        results = resp.json()["results"]
+                    except requests.RequestException as e:
+                        results = [{"error": type(e).__name__, "details": str(e)}]
+                        results *= len(unit)
+                    for (lineno, _), result in zip(unit, results):
+                        ok, text = batch_result(result)
+                        report(lineno, ok, [] if text == "OK" else [text])
+            finally:
+                with print_mtx:
+                    latencies.append(time.perf_counter() - start)
+                    num_requests += 1
+                in_flight.release()
+
+        def units():
+            pending = []
+            for lineno, text in enumerate(f, start=1):
+                text = text.strip()
+                if not text or text.startswith("#"):
+                    continue
+                try:
+                    cmd_args = opt_p.parse_args(shlex.split(text))
+                except SystemExit as e:
+                    report(lineno, False, [f"Cannot parse {text!r}"])
+                    continue
+                if args.batch_size > 1 and batch_op(cmd_args) is not None:
+                    pending.append((lineno, cmd_args))
+                    if len(pending) >= args.batch_size:
+                        yield pending
+                        pending = []
+                else:
+                    if pending:
+                        yield pending
+                        pending = []
+                    yield [(lineno, cmd_args)]
+            if pending:
+                yield pending
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = set()
+            for unit in units():
+                in_flight.acquire()
+                futures.add(pool.submit(run_unit, unit))
+                # With --concurrency 1, this also keeps a later command from
+                # being sent before an earlier one is done.
+                done, futures = wait(
+                    futures, timeout=0 if args.concurrency > 1 else None
+                )
+                for fut in done:
+                    fut.result()
+            for fut in futures:
+                fut.result()
+        duration = time.perf_counter() - start
+
+        latencies.sort()
+
+        def pct(q):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e3
+
+        num_cmds = num_ok + num_errors
+        print(
+            f"{num_cmds} commands in {duration:.2f} s "
+            f"({num_cmds / duration if duration > 0 else 0.0:.1f}/s), "
+            f"{num_errors} errors; {num_requests} requests, "
+            f"p50 {pct(0.5):.2f} ms, p99 {pct(0.99):.2f} ms",
+            file=sys.stderr,
+        )
+        return num_errors == 0
 
     if args.exec:
         on_prompt(args.exec)
+    elif args.file is not None or not sys.stdin.isatty():
+        if args.file is None or args.file == "-":
+            ok = run_script(sys.stdin)
+        else:
+            with open(args.file) as f:
+                ok = run_script(f)
+        sys.exit(0 if ok else 1)
     else:
         completer = WordCompleter(["help"])
         sess = pt.PromptSession("> ", completer=completer)
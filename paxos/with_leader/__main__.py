@@ -15,11 +15,9 @@ import requests
 import shutil
 import jinja2
 from urllib.parse import urlparse
-from flask import Flask, request
-from marshmallow import Schema, fields
 import os
-from multiprocessing import Process
-import sys
+import json
+from paxos.worker.consensus import quorum_sizes
 
 
 def get_socket(host="", port=0):
@@ -59,6 +57,17 @@ def main():
         metavar=("MEAN", "MAX_DEV"),
     )
     p.add_argument("--ledger-file", required=True)
+    p.add_argument("--events-file")
+    p.add_argument("--snapshot-format", choices=["yaml", "binary"])
+    p.add_argument("--store", choices=["dict", "array"])
+    p.add_argument("--window", type=int)
+    p.add_argument("--lease-duration", type=float)
+    p.add_argument("--server", choices=["flask", "asyncio"])
+    p.add_argument("--wal", action="store_true")
+    # Flexible Paxos quorum sizes within each replica group, for elections
+    # (Q1) and accept rounds (Q2); |Q1| + |Q2| must exceed the group size.
+    p.add_argument("--q1", type=int)
+    p.add_argument("--q2", type=int)
     p.add_argument("--prober-port", type=int)
     p.add_argument("--probe-period", type=float, required=True)
 
@@ -67,11 +76,21 @@ def main():
     g.add_argument("--worker-ports", type=int, nargs="*")
 
     p.add_argument("--gateway-port", type=int)
+    p.add_argument("--gateway", choices=["nginx", "builtin"], default="nginx")
+
+    # Each shard is a replica group of its own, with its own prober.
+    p.add_argument("--num-shards", type=int, default=1)
 
     p.add_argument("-v", "--verbose", action="store_true")
 
     args = p.parse_args()
 
+    if args.num_shards > 1 and args.gateway_port is not None:
+        if args.gateway != "builtin":
+            p.error("Routing requests to shards needs --gateway builtin.")
+    if args.worker_ports and len(args.worker_ports) % args.num_shards != 0:
+        p.error("The worker ports must split evenly into the shards.")
+
     logging.getLogger("werkzeug").setLevel(logging.WARN)
     logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
 
@@ -81,26 +100,29 @@ def main():
             rsvd.append(gateway_sock)
 
         if args.prober_port is not None:
-            prober_sock = get_socket(port=args.prober_port)
-            rsvd.append(prober_sock)
+            # Shard i's prober listens on --prober-port + i.
+            prober_ports = [args.prober_port + i for i in range(args.num_shards)]
+            for prober_port in prober_ports:
+                prober_sock = get_socket(port=prober_port)
+                rsvd.append(prober_sock)
 
         if args.worker_ports is not None:
             for worker_port in args.worker_ports:
                 worker_sock = get_socket(port=worker_port)
                 rsvd.append(worker_sock)
 
-        if args.prober_port is not None:
-            prober_port = args.prober_port
-        else:
-            prober_sock = get_socket()
-            prober_port = port_of_socket(prober_sock)
-            rsvd.append(prober_sock)
+        if args.prober_port is None:
+            prober_ports = []
+            for _ in range(args.num_shards):
+                prober_sock = get_socket()
+                prober_ports.append(port_of_socket(prober_sock))
+                rsvd.append(prober_sock)
 
         if args.worker_ports is not None:
             worker_ports = args.worker_ports
         elif args.num_workers is not None:
             worker_ports = []
-            for _ in range(args.num_workers):
+            for _ in range(args.num_workers * args.num_shards):
                 worker_sock = get_socket()
                 worker_ports.append(port_of_socket(worker_sock))
                 rsvd.append(worker_sock)
@@ -108,10 +130,6 @@ def main():
         else:
             worker_ports = []
 
-        flask_sock = get_socket()
-        flask_port = port_of_socket(flask_sock)
-        rsvd.append(flask_sock)
-
     def parse_bounds(bounds):
         if bounds is not None:
             if len(bounds) > 1:
@@ -130,10 +148,29 @@ def main():
     ledger_file = Path(args.ledger_file).absolute()
 
     worker_addrs = [f"http://localhost:{p}" for p in worker_ports]
+    shard_size = len(worker_ports) // args.num_shards
+    if args.q1 is not None or args.q2 is not None:
+        try:
+            quorum_sizes(shard_size, args.q1, args.q2)
+        except ValueError as e:
+            p.error(str(e))
+    shard_ports = [
+        worker_ports[i * shard_size : (i + 1) * shard_size]
+        for i in range(args.num_shards)
+    ]
+    shard_addrs = [[f"http://localhost:{p}" for p in ports] for ports in shard_ports]
+    shard_of_port = {
+        port: shard_id for shard_id, ports in enumerate(shard_ports) for port in ports
+    }
     other_addrs = {
-        port: {*worker_addrs} - {f"http://localhost:{port}"} for port in worker_ports
+        port: {*shard_addrs[shard_of_port[port]]} - {f"http://localhost:{port}"}
+        for port in worker_ports
     }
 
+    def worker_ledger_file(port: int):
+        # Each replica keeps its own copy of the ledger and its Paxos log.
+        return ledger_file.with_name(f"{ledger_file.stem}.{port}{ledger_file.suffix}")
+
     def spawn_worker(port: int):
         return subprocess.Popen(
             [
@@ -143,8 +180,34 @@ def main():
                 "--port",
                 str(port),
                 "--ledger-file",
-                str(ledger_file),
+                str(worker_ledger_file(port)),
                 *(["-v"] if args.verbose else []),
+                *(
+                    ["--snapshot-format", args.snapshot_format]
+                    if args.snapshot_format is not None
+                    else []
+                ),
+                *(["--store", args.store] if args.store is not None else []),
+                *(["--window", str(args.window)] if args.window is not None else []),
+                *(
+                    ["--lease-duration", str(args.lease_duration)]
+                    if args.lease_duration is not None
+                    else []
+                ),
+                *(["--wal"] if args.wal else []),
+                *(["--server", args.server] if args.server is not None else []),
+                *(["--q1", str(args.q1)] if args.q1 is not None else []),
+                *(["--q2", str(args.q2)] if args.q2 is not None else []),
+                *(
+                    [
+                        "--shard-id",
+                        str(shard_of_port[port]),
+                        "--shard-groups",
+                        *(",".join(addrs) for addrs in shard_addrs),
+                    ]
+                    if args.num_shards > 1
+                    else []
+                ),
                 "--other-nodes",
                 *other_addrs[port],
             ],
@@ -152,7 +215,18 @@ def main():
             stdout=DEVNULL,
         )
 
-    if args.gateway_port is not None:
+    if args.gateway_port is not None and args.gateway == "builtin":
+        gateway_argv = ["python3", "-m", "paxos.gateway"]
+        gateway_argv.extend(["--port", str(args.gateway_port)])
+        for addrs, prober_port in zip(shard_addrs, prober_ports):
+            gateway_argv.extend(["--workers", *addrs])
+            gateway_argv.extend(["--prober-url", f"http://localhost:{prober_port}"])
+        if args.verbose:
+            gateway_argv.extend(["-v"])
+
+        gateway_proc = subprocess.Popen(gateway_argv, stdout=DEVNULL, stdin=DEVNULL)
+        logging.info(f"Running gateway on http://localhost:{args.gateway_port}")
+    elif args.gateway_port is not None:
         gateway_conf = tempfile.NamedTemporaryFile(mode="w", delete=False)
 
         script_dir = Path(__file__).parent
@@ -176,33 +250,16 @@ def main():
         logging.info(f"Running gateway on http://localhost:{args.gateway_port}")
         logging.info(f"Gateway args: {gateway_proc.args}")
 
-    app = Flask(__name__)
-
-    class UpdateLeaderSchema(Schema):
-        leader = fields.Str()
-
-    @app.put("/leader")
-    def update_leader():
-        data = UpdateLeaderSchema().load(request.json)
-
+    def update_gateway(leader: str):
         conf_txt = nginx_conf_j2.render(
             gateway_port=args.gateway_port,
-            leader=data["leader"],
+            leader=leader,
         )
         with open(gateway_conf.name, "w") as conf_f:
             conf_f.write(conf_txt)
 
         os.kill(gateway_proc.pid, signal.SIGHUP)
 
-        return {}
-
-    def flask_fn():
-        sys.stdout = open(os.devnull, "w")
-        app.run(use_reloader=False, debug=False, port=flask_port)
-
-    flask_proc = Process(target=flask_fn)
-    flask_proc.start()
-
     workers = []
     for port in worker_ports:
         proc = spawn_worker(port)
@@ -213,6 +270,16 @@ def main():
     finishing = threading.Event()
     any_alive_cv = threading.Condition()
 
+    events_mtx = threading.Lock()
+
+    def record_event(event: str, worker: dict):
+        # Lets benchmarks line up latency spikes with kills and restarts.
+        if args.events_file is None:
+            return
+        line = json.dumps({"ts": time.time(), "event": event, "port": worker["port"]})
+        with events_mtx, open(args.events_file, "a") as f:
+            f.write(line + "\n")
+
     def killer_fn():
         timers_mtx = threading.Lock()
         timers = {}
@@ -235,6 +302,7 @@ def main():
             worker["proc"].terminate()
             worker["alive"] = False
             logging.info(f"Terminated worker {worker_info}")
+            record_event("kill", worker)
 
             if restart_after is not None:
                 min_delay, max_delay = restart_after
@@ -252,6 +320,7 @@ def main():
                             "port": worker["port"],
                         }
                         logging.info(f"Restarted worker {worker_info}")
+                        record_event("restart", worker)
 
                         any_alive_cv.notify()
 
@@ -280,18 +349,46 @@ def main():
                 timer.cancel()
                 timer.join()
 
-    prober_argv = ["python3", "-m", "paxos.prober"]
-    prober_argv.extend(["--probe-period", str(args.probe_period)])
-    prober_argv.extend(["--port", str(prober_port)])
-    prober_argv.extend(["--worker-ports", *(str(w["port"]) for w in workers)])
-    if args.gateway_port is not None:
-        leader_url = f"http://localhost:{flask_port}/leader"
-        prober_argv.extend(["--leader-url", leader_url])
-    if args.verbose:
-        prober_argv.extend(["-v"])
-
-    prober_proc = subprocess.Popen(prober_argv, stdout=DEVNULL, stdin=DEVNULL)
-    logging.info(f"Running prober on http://localhost:{prober_port}")
+    prober_procs = []
+    for ports, prober_port in zip(shard_ports, prober_ports):
+        prober_argv = ["python3", "-m", "paxos.prober"]
+        prober_argv.extend(["--probe-period", str(args.probe_period)])
+        prober_argv.extend(["--port", str(prober_port)])
+        prober_argv.extend(["--worker-ports", *(str(port) for port in ports)])
+        if args.lease_duration is not None:
+            prober_argv.extend(["--lease-duration", str(args.lease_duration)])
+        if args.verbose:
+            prober_argv.extend(["-v"])
+
+        prober_proc = subprocess.Popen(prober_argv, stdout=DEVNULL, stdin=DEVNULL)
+        prober_procs.append(prober_proc)
+        logging.info(f"Running prober on http://localhost:{prober_port}")
+
+    def watch_leader_fn():
+        # Long-polls the prober, which answers as soon as the leader changes
+        # from the epoch we last saw.
+        sess = requests.Session()
+        prober_url = f"http://localhost:{prober_ports[0]}/leader"
+        epoch = None
+        while not finishing.is_set():
+            try:
+                params = {"after": epoch, "timeout": 1.0} if epoch is not None else {}
+                resp = sess.get(prober_url, params=params, timeout=5.0)
+                resp.raise_for_status()
+                data = resp.json()
+            except (requests.RequestException, ValueError):
+                finishing.wait(0.2)
+                continue
+
+            if data["leader"] is not None and data["epoch"] != epoch:
+                epoch = data["epoch"]
+                logging.info(f"Leader is {data['leader']} (epoch {epoch})")
+                update_gateway(data["leader"])
+
+    watcher = None
+    if args.gateway_port is not None and args.gateway == "nginx":
+        watcher = Thread(target=watch_leader_fn)
+        watcher.start()
 
     killer = None
     if kill_every is not None:
@@ -312,11 +409,12 @@ def main():
         gateway_proc.kill()
         gateway_proc.wait()
 
-    prober_proc.terminate()
-    prober_proc.wait()
+    for prober_proc in prober_procs:
+        prober_proc.terminate()
+        prober_proc.wait()
 
-    flask_proc.terminate()
-    flask_proc.join()
+    if watcher is not None:
+        watcher.join()
 
     if killer is not None:
         with any_alive_cv:
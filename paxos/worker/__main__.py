@@ -1,13 +1,35 @@
 import argparse
 from pathlib import Path
-from flask import Flask, request, jsonify
-from .ledger import FileLedger, LedgerError
+from .ledger import FileLedger, LedgerError, dedup_bucket
+from .wal import WriteAheadLog, GroupCommitLog
+from .consensus import MultiPaxos, ConsensusError, NotLeaderError, quorum_sizes
+from .epaxos import EPaxos
+from .server import Router, Request, run_flask, run_asyncio
+from .metrics import Registry
+from .shards import ShardMap, TransferCoordinator
+from .catchup import encode_snapshot, fetch_snapshot
+from collections.abc import Iterator
 from pathlib import Path
 import http
-from marshmallow import Schema, fields, ValidationError
+from marshmallow import (
+    EXCLUDE,
+    Schema,
+    fields,
+    validate,
+    validates_schema,
+    ValidationError,
+)
 from dataclasses import dataclass
 from pathlib import Path
+import requests
 import logging
+import hashlib
+import json
+import time
+
+FORWARDED_HEADER = "X-Paxos-Forwarded"
+# Lets clients retry writes safely (see Ledger.apply).
+IDEMPOTENCY_HEADER = "Idempotency-Key"
 
 
 def main():
@@ -15,59 +37,399 @@ def main():
     p.add_argument("--port", type=int, required=True)
     p.add_argument("--ledger-file", required=True)
     p.add_argument("--other-nodes", nargs="*")
+    p.add_argument("--addr")
+    p.add_argument("--rpc-timeout", type=float, default=0.5)
+    p.add_argument("--window", type=int, default=16)
+    p.add_argument("--lease-duration", type=float, default=1.0)
+    p.add_argument("--wal", action="store_true")
+    p.add_argument("--checkpoint-every", type=int, default=10000)
+    p.add_argument("--group-commit-window", type=float)
+    p.add_argument("--group-commit-max-batch", type=int, default=128)
+    p.add_argument("--snapshot-format", choices=["yaml", "binary"])
+    p.add_argument("--scale", type=int, default=2)
+    p.add_argument("--store", choices=["dict", "array"], default="dict")
+    p.add_argument("--server", choices=["flask", "asyncio"], default="flask")
+    p.add_argument("--blocking-threads", type=int, default=256)
+    p.add_argument("--peer-threads", type=int, default=32)
+    p.add_argument("--shard-id", type=int, default=0)
+    p.add_argument("--shard-groups", nargs="*", metavar="ADDR[,ADDR...]")
+    p.add_argument("--tx-timeout", type=float, default=10.0)
+    p.add_argument("--log-retention", type=int, default=10000)
+    p.add_argument("--catch-up-timeout", type=float, default=30.0)
+    p.add_argument("--dedup-capacity", type=int, default=100000)
+    p.add_argument("--dedup-ttl", type=float, default=3600.0)
+    p.add_argument(
+        "--consensus", choices=["multipaxos", "epaxos"], default="multipaxos"
+    )
+    # Flexible Paxos quorum sizes for elections (Q1) and accept rounds (Q2);
+    # majorities by default.
+    p.add_argument("--q1", type=int)
+    p.add_argument("--q2", type=int)
     p.add_argument("-v", "--verbose", action="store_true")
 
     args = p.parse_args()
 
-    other_nodes = args.other_nodes
+    other_nodes = args.other_nodes or []
+    addr = args.addr or f"http://localhost:{args.port}"
+    # Without a WAL the ledger file is rewritten after every commit, so the
+    # window would only batch the Paxos log.
+    if args.group_commit_window is not None and not args.wal:
+        p.error("--group-commit-window requires --wal.")
+    if args.q1 is not None or args.q2 is not None:
+        if args.consensus != "multipaxos":
+            p.error("--q1/--q2 only apply to --consensus multipaxos.")
+        try:
+            quorum_sizes(len({addr, *other_nodes}), args.q1, args.q2)
+        except ValueError as e:
+            p.error(str(e))
+    if args.shard_groups:
+        groups = [group.split(",") for group in args.shard_groups]
+    else:
+        groups = [[addr, *other_nodes]]
+    shards = ShardMap(args.shard_id, groups)
+
+    router = Router()
+    registry = Registry()
 
-    app = Flask(__name__)
+    http_requests = registry.counter(
+        "paxos_http_requests_total",
+        "HTTP requests handled, by route, method and status.",
+        ["route", "method", "status"],
+    )
+    http_duration = registry.histogram(
+        "paxos_http_request_duration_seconds",
+        "Time spent handling HTTP requests, by route.",
+        ["route"],
+    )
+    errors = registry.counter(
+        "paxos_errors_total", "Requests that failed, by error type.", ["type"]
+    )
+    commit_duration = registry.histogram(
+        "paxos_ledger_commit_duration_seconds",
+        "Time spent applying a committed log entry to the ledger.",
+    ).labels()
+    fsync_duration = registry.histogram(
+        "paxos_wal_fsync_duration_seconds", "Duration of log fsyncs.", ["log"]
+    )
+    phase_duration = registry.histogram(
+        "paxos_consensus_phase_duration_seconds",
+        "Time proposals spend queued for a slot, in the accept round and "
+        "waiting to be applied.",
+        ["phase"],
+    )
 
     logging.getLogger("werkzeug").setLevel(logging.WARN)
     logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
 
-    ledger = FileLedger(fpath=Path(args.ledger_file))
+    ledger = FileLedger(
+        fpath=Path(args.ledger_file),
+        wal=args.wal,
+        checkpoint_every=args.checkpoint_every,
+        group_window=args.group_commit_window,
+        group_max_batch=args.group_commit_max_batch,
+        snapshot_format=args.snapshot_format,
+        scale=args.scale,
+        store=args.store,
+    )
+    ledger.shard_id, ledger.num_shards = shards.shard_id, shards.num_shards
+    ledger.dedup_capacity, ledger.dedup_ttl = args.dedup_capacity, args.dedup_ttl
+
+    def durably(fn, *fn_args):
+        # The ledger only locks the accounts involved; waiting for the batch
+        # to be fsync'd happens after it lets go, so that others can join it.
+        retval = fn(*fn_args)
+        ledger.sync(ledger.lsn)
+        return retval
+
+    def apply_entry(slot, op):
+        with commit_duration.time():
+            retval = ledger.apply(slot, op)
+            lsn = ledger.lsn
+
+        # The Paxos log is cut back to its last --log-retention entries once
+        # twice as many have piled up; lagging peers that need older ones get
+        # a snapshot instead. The ledger has to be durable up to there first.
+        # EPaxos replicas execute in orders of their own, so they instead drop
+        # the instances every replica has executed, every --log-retention.
+        if leaderless:
+            if slot - paxos.compacted >= args.log_retention:
+                ledger.sync(lsn)
+                paxos.compact(slot)
+            return retval
+        if slot - paxos.compacted >= 2 * args.log_retention:
+            ledger.sync(lsn)
+            paxos.compact(slot - args.log_retention)
+        return retval
+
+    snapshot_session = requests.Session()
+
+    def install_snapshot(node: str):
+        header, accounts, num_bytes = fetch_snapshot(
+            snapshot_session,
+            f"{node}/paxos/snapshot",
+            timeout=(args.rpc_timeout, args.catch_up_timeout),
+        )
+        with ledger.exclusive():
+            if header["applied_slot"] > ledger.applied_slot:
+                ledger.install(header, accounts)
+            return ledger.applied_slot, num_bytes
+
+    if ledger.wal is not None:
+        ledger.wal.on_fsync = fsync_duration.labels("ledger").observe
+
+    def interference(op: dict):
+        structural, uids = ledger.footprint(op)
+        if structural:
+            return None
+        # Keyed commands also change their bucket of the dedup table: a retry
+        # must see the same entries (not yet evicted, or already) on every
+        # replica, so those of a bucket are ordered among themselves.
+        if "key" in op:
+            return [*uids, f"key:{dedup_bucket(op['key'])}"]
+        return uids
+
+    leaderless = args.consensus == "epaxos"
+    ledger_path = Path(args.ledger_file)
+    suffix = ".epaxos" if leaderless else ".paxos"
+    paxos_log_path = ledger_path.with_name(ledger_path.name + suffix)
+    if args.group_commit_window is not None:
+        paxos_log = GroupCommitLog(
+            paxos_log_path, args.group_commit_window, args.group_commit_max_batch
+        )
+    else:
+        paxos_log = WriteAheadLog(paxos_log_path)
+
+    if leaderless:
+        paxos = EPaxos(
+            addr=addr,
+            other_nodes=other_nodes,
+            log=paxos_log,
+            applied_slot=ledger.applied_slot,
+            apply_fn=apply_entry,
+            interference=interference,
+            rpc_timeout=args.rpc_timeout,
+        )
+    else:
+        paxos = MultiPaxos(
+            addr=addr,
+            other_nodes=other_nodes,
+            log=paxos_log,
+            applied_slot=ledger.applied_slot,
+            apply_fn=apply_entry,
+            rpc_timeout=args.rpc_timeout,
+            window=args.window,
+            lease_duration=args.lease_duration,
+            snapshot_fn=install_snapshot,
+            q1=args.q1,
+            q2=args.q2,
+        )
+    paxos_log.on_fsync = fsync_duration.labels("paxos").observe
+    catch_up_duration = registry.histogram(
+        "paxos_catch_up_duration_seconds",
+        "Time taken to catch up with a peer after falling behind.",
+    ).labels()
+    catch_up_bytes = registry.counter(
+        "paxos_catch_up_bytes_total",
+        "Bytes received while catching up, by kind (snapshot or log).",
+        ["kind"],
+    )
+
+    def on_catch_up(stats: dict):
+        catch_up_duration.observe(stats["seconds"])
+        catch_up_bytes.labels("snapshot").inc(stats["snapshot_bytes"])
+        catch_up_bytes.labels("log").inc(stats["log_bytes"])
+
+    if not leaderless:
+        paxos.on_catch_up = on_catch_up
+        paxos.on_phase = lambda phase, seconds: phase_duration.labels(phase).observe(
+            seconds
+        )
+    # Only now, since apply_entry reads `paxos`.
+    paxos.start()
+
+    def file_size(fpath: Path) -> int:
+        return fpath.stat().st_size if fpath.exists() else 0
+
+    registry.gauge_fn(
+        "paxos_snapshot_size_bytes",
+        "Size of the ledger snapshot file.",
+        lambda: file_size(ledger.fpath),
+    )
+    registry.gauge_fn(
+        "paxos_wal_size_bytes",
+        "Size of the ledger write-ahead log.",
+        lambda: file_size(ledger.wal.fpath) if ledger.wal is not None else 0,
+    )
+    # Accounts are never deleted, so the next uid is their number.
+    registry.gauge_fn(
+        "paxos_accounts", "Number of accounts in the ledger.", lambda: ledger.next_uid
+    )
+    registry.gauge_fn(
+        "paxos_applied_slot",
+        "Last log slot applied to the ledger.",
+        lambda: paxos.applied,
+    )
+    registry.gauge_fn(
+        "paxos_dedup_entries",
+        "Outcomes of requests with an idempotency key kept for their retries.",
+        lambda: len(ledger.dedup),
+    )
+    duplicate_requests = registry.counter(
+        "paxos_duplicate_requests_total",
+        "Requests answered with the outcome of an earlier one with their key.",
+    ).labels()
+
+    def txs():
+        with ledger.mtx:
+            return dict(ledger.txs)
 
-    @app.errorhandler(LedgerError)
-    def on_ledger_error(error: LedgerError):
-        code = http.HTTPStatus.BAD_REQUEST
-        resp = jsonify({"error": "LedgerError", "details": str(error)})
-        return resp, code
+    coordinator = TransferCoordinator(
+        shards=shards,
+        propose=paxos.propose,
+        txs=txs,
+        # Without a leader, every replica recovers stalled transfers; the
+        # aborts are ordered like any other command.
+        is_leader=lambda: leaderless or paxos.is_leader,
+        rpc_timeout=args.rpc_timeout,
+        tx_timeout=args.tx_timeout,
+    )
 
-    @app.errorhandler(ValidationError)
-    def on_validation_error(error: ValidationError):
-        code = http.HTTPStatus.BAD_REQUEST
-        resp = jsonify({"error": "ValidationError", "details": error.messages})
-        return resp, code
+    def to_json(body) -> bytes:
+        return json.dumps(body, default=str, sort_keys=True).encode()
 
-    @app.post("/account")
-    def open_account():
-        uid = ledger.open_acct()
-        return {"uid": uid}
+    # The route pattern of each view, filled in once all routes are declared.
+    route_of = {}
 
-    @app.get("/account/<int:uid>")
-    def account(uid):
-        acct = ledger.account(uid)
-        return {"uid": acct.uid, "funds": acct.funds}
+    def dispatch(view, req: Request, params: dict):
+        start = time.perf_counter()
+        status, body, content_type = handle(view, req, params)
+        route = route_of.get(view, req.path)
+        http_duration.labels(route).observe(time.perf_counter() - start)
+        http_requests.labels(route, req.method, int(status)).inc()
+        return status, body, content_type
+
+    def handle(view, req: Request, params: dict):
+        try:
+            body = view(req, **params)
+            status = http.HTTPStatus.OK
+            if isinstance(body, tuple):
+                body, status = body
+            if isinstance(body, Iterator):
+                return status, body, "application/x-ndjson"
+            if isinstance(body, str):
+                return status, body.encode(), "text/plain; version=0.0.4"
+            return status, to_json(body), "application/json"
+        except LedgerError as error:
+            errors.labels("LedgerError").inc()
+            code = http.HTTPStatus.BAD_REQUEST
+            body = {"error": "LedgerError", "details": str(error)}
+        except ValidationError as error:
+            errors.labels("ValidationError").inc()
+            code = http.HTTPStatus.BAD_REQUEST
+            body = {"error": "ValidationError", "details": error.messages}
+        except NotLeaderError as error:
+            errors.labels("NotLeaderError").inc()
+            if error.leader is not None and FORWARDED_HEADER not in req.headers:
+                headers = {FORWARDED_HEADER: addr}
+                if IDEMPOTENCY_HEADER in req.headers:
+                    headers[IDEMPOTENCY_HEADER] = req.headers[IDEMPOTENCY_HEADER]
+                try:
+                    resp = requests.request(
+                        req.method,
+                        f"{error.leader}{req.path}",
+                        json=req.json,
+                        headers=headers,
+                        timeout=args.rpc_timeout,
+                    )
+                    content_type = resp.headers.get("Content-Type", "application/json")
+                    return resp.status_code, resp.content, content_type
+                except requests.RequestException:
+                    paxos.forget_leader(error.leader)
+            code = http.HTTPStatus.SERVICE_UNAVAILABLE
+            body = {"error": type(error).__name__, "details": str(error)}
+        except ConsensusError as error:
+            errors.labels(type(error).__name__).inc()
+            code = http.HTTPStatus.SERVICE_UNAVAILABLE
+            body = {"error": type(error).__name__, "details": str(error)}
+        return code, to_json(body), "application/json"
+
+    def idempotency(req: Request) -> dict:
+        # What a proposal carries for the ledger to recognize retries of the
+        # request: its key, a digest of it and the time it was proposed at.
+        key = req.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return {}
+        content = json.dumps([req.path, req.json], sort_keys=True).encode()
+        digest = hashlib.sha1(content).hexdigest()
+        return {"key": key, "digest": digest, "ts": time.time()}
+
+    def replayed(keyed: dict):
+        # Whether the request was applied already, and its result if so. A
+        # retry still in flight is caught when it is applied instead.
+        entry = ledger.dedup.get(keyed["key"]) if keyed else None
+        if entry is None:
+            return False, None
+        duplicate_requests.inc()
+        return True, ledger.outcome(entry, keyed["digest"])
+
+    def propose(req: Request, op: dict):
+        keyed = idempotency(req)
+        found, retval = replayed(keyed)
+        if found:
+            return retval
+        return paxos.propose({**op, **keyed})
+
+    @router.post("/account")
+    def open_account(req: Request):
+        uid = propose(req, {"op": "open_acct"})
+        return {"uid": shards.to_global(uid)}
+
+    class StalenessSchema(Schema):
+        max_lag = fields.Int(validate=validate.Range(min=0))
+        max_age = fields.Float(validate=validate.Range(min=0))
+
+    @router.get("/account/<int:uid>")
+    def account(req: Request, uid: int):
+        local_uid = shards.to_local(uid)
+        if leaderless:
+            # Any replica can order a read after the writes to the account,
+            # which is as fresh as any staleness bound asks for.
+            paxos.read_barrier([local_uid])
+            acct = durably(ledger.account, local_uid)
+            return {"uid": uid, "funds": acct.funds}
+
+        # With a staleness bound, any replica may answer from its own state
+        # (see MultiPaxos.bounded_read); otherwise, only the leader can.
+        bound = StalenessSchema().load(req.args, unknown=EXCLUDE)
+        if not bound:
+            paxos.read_barrier()
+            acct = durably(ledger.account, local_uid)
+            return {"uid": uid, "funds": acct.funds}
+
+        staleness = paxos.bounded_read(bound.get("max_lag"), bound.get("max_age"))
+        acct = durably(ledger.account, local_uid)
+        return {"uid": uid, "funds": acct.funds, **staleness}
 
     class DepositSchema(Schema):
         uid = fields.Int()
         amount = fields.Decimal()
 
-    @app.post("/deposit")
-    def deposit():
-        data = DepositSchema().load(request.json)
-        ledger.deposit(data["uid"], data["amount"])
+    @router.post("/deposit")
+    def deposit(req: Request):
+        data = DepositSchema().load(req.json)
+        uid = shards.to_local(data["uid"])
+        propose(req, {"op": "deposit", "uid": uid, "amount": str(data["amount"])})
         return {}
 
     class WithdrawalSchema(Schema):
         uid = fields.Int()
         amount = fields.Decimal()
 
-    @app.post("/withdrawal")
-    def withdrawal():
-        data = WithdrawalSchema().load(request.json)
-        ledger.withdraw(data["uid"], data["amount"])
+    @router.post("/withdrawal")
+    def withdrawal(req: Request):
+        data = WithdrawalSchema().load(req.json)
+        uid = shards.to_local(data["uid"])
+        propose(req, {"op": "withdraw", "uid": uid, "amount": str(data["amount"])})
         return {}
 
     class TransferSchema(Schema):
@@ -75,22 +437,234 @@ def main():
         to_uid = fields.Int()
         amount = fields.Decimal()
 
-    @app.post("/transfer")
-    def transfer_funds():
-        data = TransferSchema().load(request.json)
-        ledger.transfer(data["from_uid"], data["to_uid"], data["amount"])
+    @router.post("/transfer")
+    def transfer_funds(req: Request):
+        data = TransferSchema().load(req.json)
+        from_uid = shards.to_local(data["from_uid"])
+        amount = str(data["amount"])
+        if shards.shard_of(data["to_uid"]) != shards.shard_id:
+            keyed = idempotency(req)
+            found, _ = replayed(keyed)
+            if not found:
+                coordinator.transfer(from_uid, data["to_uid"], amount, keyed)
+            return {}
+
+        propose(
+            req,
+            {
+                "op": "transfer",
+                "from_uid": from_uid,
+                "to_uid": shards.to_local(data["to_uid"]),
+                "amount": amount,
+            },
+        )
         return {}
 
-    @app.get("/admin/healthcheck")
-    def healthcheck():
+    # The target side of cross-shard transfers, called by the source shard.
+
+    class TxPrepareSchema(Schema):
+        tx = fields.Str(required=True)
+        uid = fields.Int(required=True)
+        amount = fields.Decimal(required=True)
+        started = fields.Float(required=True)
+        deadline = fields.Float(required=True)
+
+    @router.post("/tx/prepare")
+    def tx_prepare(req: Request):
+        data = TxPrepareSchema().load(req.json)
+        paxos.propose(
+            {
+                "op": "tx_prepare",
+                "tx": data["tx"],
+                "role": "target",
+                "uid": shards.to_local(data["uid"]),
+                "amount": str(data["amount"]),
+                "info": {"ts": data["started"], "deadline": data["deadline"]},
+                # Checked against the deadline when applied, the same way on
+                # every replica.
+                "now": time.time(),
+            }
+        )
+        return {}
+
+    class TxOutcomeSchema(Schema):
+        tx = fields.Str(required=True)
+        started = fields.Float()
+
+    @router.post("/tx/commit")
+    def tx_commit(req: Request):
+        data = TxOutcomeSchema().load(req.json)
+        paxos.propose(
+            {
+                "op": "tx_commit",
+                "tx": data["tx"],
+                "role": "target",
+                "started": data.get("started"),
+            }
+        )
         return {}
 
-    @app.post("/admin/elect_leader")
-    def elect_leader():
-        # TODO Implement this part (Basic Paxos)
-        return {"leader": f"http://{request.host}"}
+    @router.post("/tx/abort")
+    def tx_abort(req: Request):
+        data = TxOutcomeSchema().load(req.json)
+        paxos.propose(
+            {
+                "op": "tx_abort",
+                "tx": data["tx"],
+                "role": "target",
+                "started": data.get("started"),
+            }
+        )
+        return {}
+
+    BATCH_OP_FIELDS = {
+        "open_acct": [],
+        "deposit": ["uid", "amount"],
+        "withdraw": ["uid", "amount"],
+        "transfer": ["from_uid", "to_uid", "amount"],
+    }
+
+    class BatchOpSchema(Schema):
+        op = fields.Str(required=True, validate=validate.OneOf(BATCH_OP_FIELDS))
+        uid = fields.Int()
+        from_uid = fields.Int()
+        to_uid = fields.Int()
+        amount = fields.Decimal()
+
+        @validates_schema
+        def validate_fields(self, data, **kwargs):
+            missing = [name for name in BATCH_OP_FIELDS[data["op"]] if name not in data]
+            if missing:
+                raise ValidationError(
+                    {name: ["Missing data for required field."] for name in missing}
+                )
+
+    class BatchSchema(Schema):
+        ops = fields.List(fields.Nested(BatchOpSchema), required=True)
+        atomic = fields.Bool(load_default=False)
+
+    @router.post("/batch")
+    def batch(req: Request):
+        # The whole batch is a single log entry, applied and made durable at
+        # once. It can only touch accounts on this shard.
+        data = BatchSchema().load(req.json)
+        ops = []
+        for op in data["ops"]:
+            op = {
+                key: shards.to_local(value) if key.endswith("uid") else value
+                for key, value in op.items()
+            }
+            if "amount" in op:
+                op["amount"] = str(op["amount"])
+            ops.append(op)
+        results = propose(req, {"op": "batch", "ops": ops, "atomic": data["atomic"]})
+
+        resp = []
+        for op, (ok, retval) in zip(ops, results):
+            if not ok:
+                resp.append({"error": "LedgerError", "details": retval})
+            elif op["op"] == "open_acct":
+                resp.append({"uid": shards.to_global(retval)})
+            else:
+                resp.append({})
+        return {"results": resp}
+
+    @router.get("/admin/healthcheck")
+    def healthcheck(req: Request):
+        return {}
+
+    @router.get("/admin/group_commit")
+    def group_commit_stats(req: Request):
+        # Writes are durable once both logs are: the consensus log first,
+        # then the ledger's.
+        stats = {}
+        for name, log in (("consensus", paxos_log), ("ledger", ledger.wal)):
+            if isinstance(log, GroupCommitLog):
+                stats[name] = log.stats()
+        return stats
+
+    @router.post("/admin/elect_leader")
+    def elect_leader(req: Request):
+        if leaderless:
+            raise ConsensusError("There is no leader with --consensus epaxos.")
+        if not paxos.elect():
+            code = http.HTTPStatus.SERVICE_UNAVAILABLE
+            details = f"Could not get a quorum of promises (leader: {paxos.leader})."
+            body = {
+                "error": "ElectionFailed",
+                "details": details,
+                "retry_after": paxos.lease_wait,
+            }
+            return body, code
+        return {"leader": addr, "ballot": list(paxos.ballot)}
+
+    @router.get("/admin/metrics")
+    def metrics(req: Request):
+        return registry.render()
+
+    @router.get("/admin/paxos")
+    def paxos_status(req: Request):
+        return paxos.status()
+
+    if leaderless:
+
+        @router.post("/epaxos/preaccept", peer=True)
+        def epaxos_preaccept(req: Request):
+            return paxos.on_preaccept(req.json)
+
+        @router.post("/epaxos/accept", peer=True)
+        def epaxos_accept(req: Request):
+            return paxos.on_accept(req.json)
+
+        @router.post("/epaxos/commit", peer=True)
+        def epaxos_commit(req: Request):
+            return paxos.on_commit(req.json)
+
+        @router.post("/epaxos/prepare", peer=True)
+        def epaxos_prepare(req: Request):
+            return paxos.on_prepare(req.json)
+
+        @router.post("/epaxos/sync", peer=True)
+        def epaxos_sync(req: Request):
+            return paxos.on_sync(req.json)
+
+    else:
+
+        @router.post("/paxos/prepare", peer=True)
+        def paxos_prepare(req: Request):
+            return paxos.on_prepare(req.json)
+
+        @router.post("/paxos/accept", peer=True)
+        def paxos_accept(req: Request):
+            return paxos.on_accept(req.json)
+
+        @router.post("/paxos/commit", peer=True)
+        def paxos_commit(req: Request):
+            return paxos.on_commit(req.json)
+
+        @router.get("/paxos/log")
+        def paxos_log_entries(req: Request):
+            from_slot = int(req.args.get("from", 0))
+            entries = paxos.log_entries(from_slot)
+            return {"entries": entries, "compacted": paxos.compacted}
+
+    @router.get("/paxos/snapshot")
+    def paxos_snapshot(req: Request):
+        # Streamed in chunks, from a view of the ledger taken up front, so
+        # that the ledger stays available while the peer downloads it.
+        with ledger.exclusive():
+            header = ledger.snapshot_header()
+            items = ledger.snapshot_items()
+        return encode_snapshot(header, items)
+
+    route_of.update({view: path for _, path, view in router.routes})
 
-    app.run(debug=False, port=args.port)
+    if args.server == "asyncio":
+        run_asyncio(
+            router, dispatch, args.port, args.blocking_threads, args.peer_threads
+        )
+    else:
+        run_flask(router, dispatch, args.port)
 
 
 if __name__ == "__main__":
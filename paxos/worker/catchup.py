@@ -0,0 +1,56 @@
+from __future__ import annotations
+from typing import Dict, Iterable, Iterator, Tuple
+from decimal import Decimal
+import json
+import requests
+from .ledger import Account
+from .consensus import ConsensusError
+
+# Snapshots are streamed as newline-delimited JSON: a header with the ledger
+# metadata, then the accounts in chunks, then a trailer with their count, so
+# that a stream cut short is not mistaken for a complete one.
+
+
+def _line(msg: dict) -> bytes:
+    return json.dumps(msg, separators=(",", ":")).encode() + b"\n"
+
+
+def encode_snapshot(
+    header: dict, items: Iterable[Tuple[int, Decimal]], chunk_size: int = 1000
+) -> Iterator[bytes]:
+    yield _line(header)
+    chunk, count = [], 0
+    for uid, funds in items:
+        chunk.append([uid, str(funds)])
+        if len(chunk) == chunk_size:
+            yield _line({"a": chunk})
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        yield _line({"a": chunk})
+        count += len(chunk)
+    yield _line({"end": count})
+
+
+def fetch_snapshot(
+    session: requests.Session, url: str, timeout
+) -> Tuple[dict, Dict[int, Account], int]:
+    # Returns the header, the accounts and the number of bytes received.
+    accounts, num_bytes = {}, 0
+    with session.get(url, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        lines = resp.iter_lines()
+        header = None
+        for line in lines:
+            num_bytes += len(line) + 1
+            msg = json.loads(line)
+            if header is None:
+                header = msg
+            elif "a" in msg:
+                for uid, funds in msg["a"]:
+                    accounts[uid] = Account(uid=uid, funds=Decimal(funds))
+            elif "end" in msg:
+                if msg["end"] != len(accounts):
+                    raise ConsensusError("The snapshot is inconsistent.")
+                return header, accounts, num_bytes
+    raise ConsensusError("The snapshot stream was cut short.")
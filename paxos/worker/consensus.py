@@ -0,0 +1,797 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import concurrent.futures
+import threading
+from threading import Thread
+import logging
+import os
+import time
+import uuid
+import requests
+from .ledger import LedgerError
+from .wal import WriteAheadLog
+
+Ballot = Tuple[int, int]
+NO_BALLOT: Ballot = (-1, -1)
+NOOP = {"op": "noop"}
+# The leader counts its lease from when it sent the accept round and gives up
+# this fraction of it as an allowance for clock drift between nodes.
+LEASE_MARGIN = 0.9
+
+
+class ConsensusError(Exception):
+    pass
+
+
+class NotLeaderError(ConsensusError):
+    def __init__(self, leader: Optional[str]):
+        super().__init__(f"This node is not the leader (leader: {leader}).")
+        self.leader = leader
+
+
+class StaleReadError(ConsensusError):
+    pass
+
+
+def fatal_on_error(loop: Callable[[], None]) -> Callable[[], None]:
+    # For threads a replica cannot run without, e.g. the one applying the
+    # log: if it fails (say, with an OSError from the ledger), the process
+    # exits, to be restarted and recover from its logs, rather than keep
+    # answering health checks without applying anything.
+    def run():
+        try:
+            loop()
+        except Exception:
+            logging.exception(f"{loop.__name__} failed, exiting")
+            logging.shutdown()
+            os._exit(1)
+
+    return run
+
+
+def quorum_sizes(
+    num_nodes: int, q1: Optional[int] = None, q2: Optional[int] = None
+) -> Tuple[int, int]:
+    # Flexible Paxos: the prepare (Q1) and accept (Q2) quorums need only
+    # intersect each other, not themselves. A missing size is the smallest
+    # one that does; both missing means majorities.
+    if q1 is None and q2 is None:
+        q1 = q2 = num_nodes // 2 + 1
+    elif q1 is None:
+        q1 = num_nodes - q2 + 1
+    elif q2 is None:
+        q2 = num_nodes - q1 + 1
+    for name, size in [("Q1", q1), ("Q2", q2)]:
+        if not 1 <= size <= num_nodes:
+            raise ValueError(f"|{name}| = {size} is not within 1..{num_nodes}.")
+    if q1 + q2 <= num_nodes:
+        raise ValueError(
+            f"|Q1| + |Q2| = {q1 + q2} must exceed the {num_nodes} nodes, "
+            "or else two leaders could both get their values chosen."
+        )
+    return q1, q2
+
+
+@dataclass
+class Proposal:
+    value: dict
+    slot: Optional[int] = None
+    committed: bool = False
+    done: threading.Event = field(default_factory=threading.Event)
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class MultiPaxos:
+    def __init__(
+        self,
+        addr: str,
+        other_nodes: List[str],
+        log: WriteAheadLog,
+        applied_slot: int,
+        apply_fn: Callable[[int, dict], object],
+        rpc_timeout: float = 0.5,
+        apply_timeout: float = 5.0,
+        window: int = 16,
+        lease_duration: float = 1.0,
+        snapshot_fn: Optional[Callable[[str], Tuple[int, int]]] = None,
+        q1: Optional[int] = None,
+        q2: Optional[int] = None,
+    ):
+        self.addr = addr
+        self.nodes = sorted({addr, *other_nodes})
+        self.idx = self.nodes.index(addr)
+        # Elections wait for `q1` promises, accept rounds for `q2` acceptances;
+        # with a small Q2, steady-state writes skip the slowest nodes.
+        self.q1, self.q2 = quorum_sizes(len(self.nodes), q1, q2)
+        self.apply_fn = apply_fn
+        self.rpc_timeout = rpc_timeout
+        self.apply_timeout = apply_timeout
+        self.lease_duration = lease_duration
+        # Called with (phase, seconds) for the queue, accept and apply phases
+        # of each proposal, e.g. to export them.
+        self.on_phase: Optional[Callable[[str, float], None]] = None
+        # Installs the ledger snapshot of the given node, returning the slot it
+        # covers and its size in bytes; used when a peer has compacted the
+        # entries we miss.
+        self.snapshot_fn = snapshot_fn
+        # Called with the stats of each catch-up, e.g. to export them.
+        self.on_catch_up: Optional[Callable[[dict], None]] = None
+
+        self.mtx = threading.RLock()
+        self.applied_cv = threading.Condition(self.mtx)
+        self.send_cv = threading.Condition(self.mtx)
+        self.commit_cv = threading.Condition(self.mtx)
+        self.elect_mtx = threading.Lock()
+
+        # Acceptor state, made durable in `log` before replying.
+        self.promised = NO_BALLOT
+        self.accepted: Dict[int, Tuple[Ballot, dict]] = {}
+        # Accepting from a leader also grants it a lease: until it expires, we
+        # refuse to promise anyone else. We don't know whom we granted one to
+        # before a restart, so we start out refusing everyone.
+        self.lease_holder: Optional[int] = None
+        self.lease_expiry = time.monotonic() + lease_duration
+
+        # Learner state. Chosen values are logged too (without an fsync of
+        # their own) so that this node can serve them to lagging peers.
+        self.chosen: Dict[int, dict] = {}
+        self.max_chosen = applied_slot
+        self.applied = applied_slot
+        self.waiting: Dict[str, Optional[tuple]] = {}
+        self.catching_up = False
+        self.last_catch_up: Optional[dict] = None
+        # Entries up to this slot may have been dropped from the log, since
+        # the ledger already reflects them.
+        self.compacted = -1
+
+        # Proposer state.
+        self.ballot = NO_BALLOT
+        self.is_leader = False
+        self.leader: Optional[str] = None
+        self.next_slot = applied_slot + 1
+        # Slots may be accepted out of order, but at most `window` of them are
+        # in flight at a time; they are still applied strictly in order.
+        # Proposals queued while the window is full go out together in a
+        # single accept message.
+        self.window = window
+        self.in_flight = 0
+        self.queue: List[Proposal] = []
+        self.unsent_commits: List[int] = []
+        # Lease-based reads are served locally until `lease_until`; past it,
+        # reads have to confirm the leadership with a quorum first.
+        self.lease_until = 0.0
+        self.read_floor = applied_slot
+        self.lease_wait = 0.0
+        self.num_lease_reads = 0
+        self.num_quorum_reads = 0
+        # Follower reads. Commit messages carry the leader's highest chosen
+        # slot; once we have applied up to it, our state is as fresh as the
+        # moment we got the message. Pending (received at, slot) marks are
+        # dropped oldest first, which only makes the age look older.
+        self.leader_chosen = applied_slot
+        self.fresh_at = 0.0
+        self.fresh_marks = deque(maxlen=1024)
+        self.heartbeat_due = False
+        self.num_bounded_reads = 0
+        self.num_stale_reads = 0
+
+        self.log = log
+        for record in self.log.replay():
+            if "p" in record:
+                self.promised = max(self.promised, tuple(record["p"]))
+            elif "a" in record:
+                ballot = tuple(record["b"])
+                self.promised = max(self.promised, ballot)
+                self.accepted[record["a"]] = (ballot, record["v"])
+            elif "c" in record:
+                self.chosen[record["c"]] = record["v"]
+                self.max_chosen = max(self.max_chosen, record["c"])
+            elif "k" in record:
+                self.compacted = max(self.compacted, record["k"])
+
+        self.pool = ThreadPoolExecutor(max_workers=max(16, 4 * len(self.nodes)))
+        self._local = threading.local()
+        self._handlers = {
+            "/paxos/prepare": self.on_prepare,
+            "/paxos/accept": self.on_accept,
+            "/paxos/commit": self.on_commit,
+        }
+
+        self._applier = Thread(target=fatal_on_error(self._apply_loop), daemon=True)
+        self._sender = Thread(target=fatal_on_error(self._send_loop), daemon=True)
+        self._committer = Thread(target=fatal_on_error(self._commit_loop), daemon=True)
+        self._heartbeat = Thread(target=fatal_on_error(self._lease_loop), daemon=True)
+
+    def start(self):
+        # Separate from the constructor, so that apply_fn and the hooks can
+        # refer to this instance even for entries replayed at startup.
+        self._applier.start()
+        self._sender.start()
+        self._committer.start()
+        self._heartbeat.start()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _call(self, node: str, path: str, payload: dict) -> dict:
+        if node == self.addr:
+            return self._handlers[path](payload)
+        resp = self._session().post(
+            f"{node}{path}", json=payload, timeout=self.rpc_timeout
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def _broadcast(self, path: str, payload: dict, quorum: int) -> List[dict]:
+        # Returns as soon as a quorum has accepted; stragglers are ignored.
+        futures = [
+            self.pool.submit(self._call, node, path, payload) for node in self.nodes
+        ]
+        replies, num_ok = [], 0
+        try:
+            for fut in as_completed(futures, timeout=self.rpc_timeout):
+                try:
+                    reply = fut.result()
+                except Exception:
+                    continue
+                replies.append(reply)
+                num_ok += bool(reply["ok"])
+                if num_ok >= quorum:
+                    break
+        except concurrent.futures.TimeoutError:
+            pass
+        return replies
+
+    def _observe(self, ballot: Ballot):
+        self.promised = max(self.promised, ballot)
+        if ballot > self.ballot:
+            if self.is_leader:
+                logging.info(f"Preempted by ballot {ballot}, stepping down")
+            self.is_leader = False
+            self.leader = self.nodes[ballot[1]]
+
+    def on_prepare(self, msg: dict) -> dict:
+        ballot, from_slot = tuple(msg["ballot"]), msg["from_slot"]
+        with self.mtx:
+            if ballot <= self.promised:
+                return {"ok": False, "promised": list(self.promised)}
+
+            lease_remaining = self.lease_expiry - time.monotonic()
+            if self.lease_holder != ballot[1] and lease_remaining > 0:
+                return {
+                    "ok": False,
+                    "promised": list(self.promised),
+                    "lease_remaining": lease_remaining,
+                }
+
+            self._observe(ballot)
+            lsn = self.log.append({"p": list(ballot)})
+            accepted = [
+                [slot, list(b), value]
+                for slot, (b, value) in self.accepted.items()
+                if slot >= from_slot
+            ]
+            chosen = [
+                [slot, value]
+                for slot, value in self.chosen.items()
+                if slot >= from_slot
+            ]
+
+        self.log.sync(lsn)
+        return {
+            "ok": True,
+            "node": self.addr,
+            "accepted": accepted,
+            "chosen": chosen,
+            "compacted": self.compacted,
+        }
+
+    def on_accept(self, msg: dict) -> dict:
+        ballot, entries = tuple(msg["ballot"]), msg["entries"]
+        with self.mtx:
+            if ballot < self.promised:
+                return {"ok": False, "promised": list(self.promised)}
+
+            self._observe(ballot)
+            self.lease_holder = ballot[1]
+            self.lease_expiry = time.monotonic() + self.lease_duration
+            lsn = self.log.lsn
+            for slot, value in entries:
+                self.accepted[slot] = (ballot, value)
+                record = {"a": slot, "b": list(ballot), "v": value}
+                lsn = self.log.append(record, sync=False)
+
+        self.log.sync(lsn)
+        return {"ok": True}
+
+    def on_commit(self, msg: dict) -> dict:
+        ballot, slots = tuple(msg["ballot"]), msg["slots"]
+        with self.mtx:
+            self._observe(ballot)
+            for slot in slots:
+                # Commits only carry slot numbers; the value is the one we
+                # accepted in the same ballot, if we did.
+                if slot in self.accepted and self.accepted[slot][0] == ballot:
+                    self._learn(slot, self.accepted[slot][1])
+
+            top = msg.get("chosen", max(slots, default=-1))
+            if ballot >= self.promised:
+                self._note_chosen(top)
+            has_gap = self.applied + 1 not in self.chosen and top > self.applied
+            if has_gap:
+                self._start_catch_up(self.nodes[ballot[1]])
+
+        return {"ok": True}
+
+    def _note_chosen(self, chosen: int):
+        self.leader_chosen = max(self.leader_chosen, chosen)
+        now = time.monotonic()
+        if chosen <= self.applied:
+            self.fresh_at = now
+            self.applied_cv.notify_all()
+        else:
+            self.fresh_marks.append((now, chosen))
+
+    def _advance_fresh(self):
+        while self.fresh_marks and self.fresh_marks[0][1] <= self.applied:
+            self.fresh_at = self.fresh_marks.popleft()[0]
+
+    def log_entries(self, from_slot: int, limit: int = 1024) -> List[list]:
+        with self.mtx:
+            slots = sorted(slot for slot in self.chosen if slot >= from_slot)
+            return [[slot, self.chosen[slot]] for slot in slots[:limit]]
+
+    def _start_catch_up(self, node: str):
+        with self.mtx:
+            if self.catching_up:
+                return
+            self.catching_up = True
+        self.pool.submit(self._catch_up, node)
+
+    def _catch_up(self, node: str):
+        # Fetches what we miss from `node`: the log entries if it still has
+        # them, or else its ledger snapshot followed by the rest of the log.
+        start = time.monotonic()
+        stats = {"node": node, "snapshot_bytes": 0, "log_bytes": 0, "entries": 0}
+        try:
+            while True:
+                with self.mtx:
+                    from_slot = self.applied + 1
+                    while from_slot in self.chosen:
+                        from_slot += 1
+
+                resp = self._session().get(
+                    f"{node}/paxos/log",
+                    params={"from": from_slot},
+                    timeout=self.rpc_timeout,
+                )
+                resp.raise_for_status()
+                stats["log_bytes"] += len(resp.content)
+                data = resp.json()
+
+                if data["compacted"] >= from_slot and self.snapshot_fn is not None:
+                    slot, num_bytes = self.snapshot_fn(node)
+                    stats["snapshot_bytes"] += num_bytes
+                    if slot < from_slot:
+                        break
+                    self._skip_to(slot)
+                    continue
+
+                entries = data["entries"]
+                if not entries or entries[0][0] != from_slot:
+                    break
+
+                with self.mtx:
+                    for slot, value in entries:
+                        self._learn(slot, value)
+                stats["entries"] += len(entries)
+        except Exception as e:
+            logging.info(f"Catching up from {node} failed: {e}")
+        finally:
+            with self.mtx:
+                self.catching_up = False
+                stats["seconds"] = time.monotonic() - start
+                stats["slot"] = self.max_chosen
+                if stats["entries"] or stats["snapshot_bytes"]:
+                    self.last_catch_up = stats
+
+        if stats["entries"] or stats["snapshot_bytes"]:
+            logging.info(
+                f"Caught up from {node} to slot {stats['slot']} in "
+                f"{stats['seconds']:.3f} s (snapshot: {stats['snapshot_bytes']} B, "
+                f"log: {stats['log_bytes']} B)"
+            )
+            if self.on_catch_up is not None:
+                self.on_catch_up(stats)
+
+    def _skip_to(self, slot: int):
+        # The ledger now reflects every slot up to `slot`.
+        with self.mtx:
+            if slot <= self.applied:
+                return
+            self.applied = slot
+            self.max_chosen = max(self.max_chosen, slot)
+            self.next_slot = max(self.next_slot, slot + 1)
+            for old_slot in [s for s in self.chosen if s <= slot]:
+                del self.chosen[old_slot]
+            for old_slot in [s for s in self.accepted if s <= slot]:
+                del self.accepted[old_slot]
+            self.compacted = max(self.compacted, slot)
+            self.log.append({"k": slot})
+            self._advance_fresh()
+            self.applied_cv.notify_all()
+
+    def compact(self, upto: int):
+        # Drops the log entries up to `upto`, which the caller must have made
+        # durable in the ledger. Peers that still need them get a snapshot.
+        with self.mtx:
+            upto = min(upto, self.applied)
+            if upto <= self.compacted:
+                return
+            self.chosen = {s: v for s, v in self.chosen.items() if s > upto}
+            self.accepted = {s: a for s, a in self.accepted.items() if s > upto}
+            self.compacted = upto
+
+            records = [{"k": upto}, {"p": list(self.promised)}]
+            for slot, (ballot, value) in sorted(self.accepted.items()):
+                records.append({"a": slot, "b": list(ballot), "v": value})
+            for slot, value in sorted(self.chosen.items()):
+                records.append({"c": slot, "v": value})
+            self.log.rewrite(records)
+
+    def _learn(self, slot: int, value: dict):
+        with self.mtx:
+            if slot <= self.applied or slot in self.chosen:
+                return
+            self.chosen[slot] = value
+            self.max_chosen = max(self.max_chosen, slot)
+            self.log.append({"c": slot, "v": value}, sync=False)
+            self.applied_cv.notify_all()
+
+    def _apply_loop(self):
+        while True:
+            with self.applied_cv:
+                self.applied_cv.wait_for(lambda: self.applied + 1 in self.chosen)
+                slot = self.applied + 1
+                value = self.chosen[slot]
+
+            try:
+                outcome = (True, self.apply_fn(slot, value))
+            except LedgerError as e:
+                outcome = (False, str(e))
+
+            with self.applied_cv:
+                # A snapshot may have been installed in the meantime.
+                self.applied = max(self.applied, slot)
+                self._advance_fresh()
+                if value.get("id") in self.waiting:
+                    self.waiting[value["id"]] = outcome
+                self.applied_cv.notify_all()
+
+    def _commit(self, ballot: Ballot, entries: List[Tuple[int, dict]]) -> bool:
+        payload = {"ballot": list(ballot), "entries": entries}
+        sent_at = time.monotonic()
+        replies = self._broadcast("/paxos/accept", payload, self.q2)
+
+        if sum(reply["ok"] for reply in replies) < self.q2:
+            with self.mtx:
+                for reply in replies:
+                    if not reply["ok"]:
+                        self._observe(tuple(reply["promised"]))
+                if self.ballot == ballot and self.is_leader:
+                    logging.info(f"Lost the quorum at ballot {ballot}, stepping down")
+                    self.is_leader = False
+                    self.leader = None
+            return False
+
+        with self.mtx:
+            if self.ballot == ballot and self.is_leader:
+                lease_until = sent_at + LEASE_MARGIN * self.lease_duration
+                self.lease_until = max(self.lease_until, lease_until)
+            for slot, value in entries:
+                self._learn(slot, value)
+            self._note_chosen(self.max_chosen)
+            self.unsent_commits.extend(slot for slot, _ in entries)
+            # Lease renewals are passed on too, to keep followers' reads fresh.
+            self.heartbeat_due = True
+            self.commit_cv.notify_all()
+        return True
+
+    def _commit_loop(self):
+        # Commits that pile up while the previous round is in flight are sent
+        # together in the next one.
+        while True:
+            with self.commit_cv:
+                self.commit_cv.wait_for(
+                    lambda: self.unsent_commits or self.heartbeat_due
+                )
+                slots, self.unsent_commits = self.unsent_commits, []
+                self.heartbeat_due = False
+                payload = {
+                    "ballot": list(self.ballot),
+                    "slots": slots,
+                    "chosen": self.max_chosen,
+                }
+
+            futures = [
+                self.pool.submit(self._call, node, "/paxos/commit", payload)
+                for node in self.nodes
+                if node != self.addr
+            ]
+            concurrent.futures.wait(futures, timeout=self.rpc_timeout)
+
+    def _lease_loop(self):
+        # An idle leader keeps its lease alive with empty accept rounds.
+        while True:
+            time.sleep(self.lease_duration / 4)
+            with self.mtx:
+                remaining = self.lease_until - time.monotonic()
+                renew = self.is_leader and remaining < self.lease_duration / 2
+                ballot = self.ballot
+            if renew:
+                try:
+                    self._commit(ballot, [])
+                except Exception:
+                    logging.exception("Renewing the lease failed")
+
+    def _send_loop(self):
+        while True:
+            with self.send_cv:
+                self.send_cv.wait_for(
+                    lambda: self.queue and self.in_flight < self.window
+                )
+                num = min(len(self.queue), self.window - self.in_flight)
+                batch, self.queue = self.queue[:num], self.queue[num:]
+
+                if not self.is_leader:
+                    for proposal in batch:
+                        proposal.done.set()
+                    continue
+
+                ballot = self.ballot
+                now = time.monotonic()
+                for proposal in batch:
+                    proposal.slot = self.next_slot
+                    self.next_slot += 1
+                    self._phase("queue", now - proposal.queued_at)
+                self.in_flight += len(batch)
+
+            self.pool.submit(self._send_batch, ballot, batch)
+
+    def _send_batch(self, ballot: Ballot, batch: List[Proposal]):
+        try:
+            entries = [(proposal.slot, proposal.value) for proposal in batch]
+            start = time.monotonic()
+            committed = self._commit(ballot, entries)
+            self._phase("accept", time.monotonic() - start)
+        except Exception:
+            logging.exception("Sending the accept batch failed")
+            committed = False
+
+        with self.send_cv:
+            self.in_flight -= len(batch)
+            self.send_cv.notify_all()
+
+        for proposal in batch:
+            proposal.committed = committed
+            proposal.done.set()
+
+    def elect(self, force: bool = True) -> bool:
+        with self.elect_mtx:
+            if not force and self.is_leader:
+                return True
+            return self._elect()
+
+    def _elect(self) -> bool:
+        with self.mtx:
+            ballot = (max(self.promised[0], self.ballot[0]) + 1, self.idx)
+            self.ballot = ballot
+            self.is_leader = False
+            self.lease_until = 0.0
+            from_slot = self.applied + 1
+
+        payload = {"ballot": list(ballot), "from_slot": from_slot}
+        replies = self._broadcast("/paxos/prepare", payload, self.q1)
+        promises = [reply for reply in replies if reply["ok"]]
+        for reply in promises:
+            if reply["compacted"] >= from_slot:
+                # Some of the slots we have yet to apply are only left in this
+                # node's ledger; we can't lead before getting them.
+                self._start_catch_up(reply["node"])
+                return False
+        if len(promises) < self.q1:
+            with self.mtx:
+                for reply in replies:
+                    if not reply["ok"]:
+                        self._observe(tuple(reply["promised"]))
+                self.lease_wait = max(
+                    [0.0, *(reply.get("lease_remaining", 0.0) for reply in replies)]
+                )
+            return False
+
+        recovered = {}
+        for reply in promises:
+            for slot, value in reply["chosen"]:
+                self._learn(slot, value)
+            for slot, b, value in reply["accepted"]:
+                b = tuple(b)
+                if slot not in recovered or b > recovered[slot][0]:
+                    recovered[slot] = (b, value)
+
+        with self.mtx:
+            if self.ballot != ballot or self.promised > ballot:
+                return False
+            last_slot = max([from_slot - 1, *recovered, *self.chosen])
+            self.is_leader = True
+            self.leader = self.addr
+            self.next_slot = last_slot + 1
+            # Writes acknowledged by previous leaders may sit anywhere up to
+            # `last_slot`, so reads must not be served before it is applied.
+            self.read_floor = last_slot
+            self.lease_wait = 0.0
+            self.unsent_commits.clear()
+            unchosen = [
+                slot
+                for slot in range(from_slot, last_slot + 1)
+                if slot not in self.chosen
+            ]
+
+        # Finish whatever the previous leaders left in flight, filling any
+        # holes with no-ops, before taking new requests.
+        entries = [
+            (slot, recovered[slot][1] if slot in recovered else NOOP)
+            for slot in unchosen
+        ]
+        for idx in range(0, len(entries), self.window):
+            if not self._commit(ballot, entries[idx : idx + self.window]):
+                return False
+        if not entries and not self._commit(ballot, []):
+            return False
+
+        logging.info(f"Elected leader with ballot {ballot} at slot {self.next_slot}")
+        return True
+
+    def _ensure_leader(self):
+        if not self.is_leader:
+            if self.leader is not None and self.leader != self.addr:
+                raise NotLeaderError(self.leader)
+            if not self.elect(force=False):
+                raise NotLeaderError(self.leader)
+
+    def read_barrier(self):
+        # Returns once the local state reflects every write acknowledged before
+        # the call. Under a valid lease no other leader can have been elected
+        # in the meantime, so no messages are needed; otherwise we confirm the
+        # leadership with an accept quorum first (read-index), which any newer
+        # leader's prepare quorum would have intersected.
+        self._ensure_leader()
+        with self.mtx:
+            read_index = max(self.max_chosen, self.read_floor)
+            ballot = self.ballot
+            has_lease = self.is_leader and time.monotonic() < self.lease_until
+            if has_lease:
+                self.num_lease_reads += 1
+            else:
+                self.num_quorum_reads += 1
+
+        if not has_lease and not self._commit(ballot, []):
+            raise NotLeaderError(self.leader)
+
+        with self.applied_cv:
+            applied = self.applied_cv.wait_for(
+                lambda: self.applied >= read_index, timeout=self.apply_timeout
+            )
+            if not applied:
+                raise ConsensusError(f"Timed out waiting for slot {read_index}.")
+
+    def bounded_read(
+        self, max_lag: Optional[int] = None, max_age: Optional[float] = None
+    ) -> dict:
+        # Lets any node serve a read, provided its state is at most `max_lag`
+        # slots behind what it knows to be chosen and reflects everything the
+        # leader had chosen `max_age` seconds ago (give or take the delay of
+        # the commit message). Waits up to an RPC timeout for that to hold.
+        def staleness():
+            lag = max(self.max_chosen, self.leader_chosen) - self.applied
+            up_to_date = (
+                self.is_leader
+                and time.monotonic() < self.lease_until
+                and self.applied >= self.max_chosen
+            )
+            age = 0.0 if up_to_date else time.monotonic() - self.fresh_at
+            return lag, age
+
+        def fresh_enough():
+            lag, age = staleness()
+            return (max_lag is None or lag <= max_lag) and (
+                max_age is None or age <= max_age
+            )
+
+        with self.applied_cv:
+            ok = self.applied_cv.wait_for(fresh_enough, timeout=self.rpc_timeout)
+            lag, age = staleness()
+            if not ok:
+                self.num_stale_reads += 1
+                raise StaleReadError(
+                    f"This node is {lag} slots and {age:.3f} s behind."
+                )
+            self.num_bounded_reads += 1
+            return {"applied": self.applied, "lag": lag, "age": age}
+
+    def propose(self, op: dict):
+        self._ensure_leader()
+
+        proposal = Proposal(value={**op, "id": uuid.uuid4().hex})
+        with self.send_cv:
+            if not self.is_leader:
+                raise NotLeaderError(self.leader)
+            self.waiting[proposal.value["id"]] = None
+            self.queue.append(proposal)
+            self.send_cv.notify_all()
+
+        try:
+            if not proposal.done.wait(self.apply_timeout):
+                raise ConsensusError("Timed out waiting for a quorum.")
+            if not proposal.committed:
+                raise NotLeaderError(self.leader)
+
+            committed_at = time.monotonic()
+            with self.applied_cv:
+                applied = self.applied_cv.wait_for(
+                    lambda: self.applied >= proposal.slot, timeout=self.apply_timeout
+                )
+                if not applied:
+                    raise ConsensusError(f"Timed out waiting for slot {proposal.slot}.")
+                outcome = self.waiting[proposal.value["id"]]
+            self._phase("apply", time.monotonic() - committed_at)
+        finally:
+            with self.mtx:
+                self.waiting.pop(proposal.value["id"], None)
+
+        if outcome is None:
+            # Another leader filled our slot with a different value.
+            raise NotLeaderError(self.leader)
+
+        ok, retval = outcome
+        if not ok:
+            raise LedgerError(retval)
+        return retval
+
+    def _phase(self, phase: str, seconds: float):
+        if self.on_phase is not None:
+            self.on_phase(phase, seconds)
+
+    def forget_leader(self, leader: str):
+        with self.mtx:
+            if self.leader == leader and not self.is_leader:
+                self.leader = None
+
+    def status(self) -> dict:
+        with self.mtx:
+            return {
+                "addr": self.addr,
+                "leader": self.leader,
+                "is_leader": self.is_leader,
+                "ballot": list(self.ballot),
+                "promised": list(self.promised),
+                "applied": self.applied,
+                "next_slot": self.next_slot,
+                "q1": self.q1,
+                "q2": self.q2,
+                "window": self.window,
+                "in_flight": self.in_flight,
+                "queued": len(self.queue),
+                "lease_duration": self.lease_duration,
+                "lease_remaining": max(0.0, self.lease_until - time.monotonic()),
+                "lease_reads": self.num_lease_reads,
+                "quorum_reads": self.num_quorum_reads,
+                "bounded_reads": self.num_bounded_reads,
+                "stale_reads": self.num_stale_reads,
+                "compacted": self.compacted,
+                "last_catch_up": self.last_catch_up,
+            }
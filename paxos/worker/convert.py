@@ -0,0 +1,23 @@
+import argparse
+from pathlib import Path
+from .ledger import FileLedger
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("src")
+    p.add_argument("dst")
+    p.add_argument("--to", choices=["yaml", "binary"], required=True)
+    p.add_argument("--scale", type=int)
+    p.add_argument("--wal", action="store_true")
+
+    args = p.parse_args()
+
+    ledger = FileLedger(fpath=Path(args.src), wal=args.wal)
+    if args.scale is not None:
+        ledger.scale = args.scale
+    ledger.export(Path(args.dst), args.to)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,821 @@
+from __future__ import annotations
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import concurrent.futures
+import bisect
+import threading
+from threading import Thread
+import logging
+import random
+import time
+import uuid
+import requests
+from .ledger import LedgerError
+from .wal import WriteAheadLog
+from .consensus import Ballot, ConsensusError, NO_BALLOT, NOOP, fatal_on_error
+
+# Leaderless consensus after EPaxos (Moraru et al., SOSP'13). Any replica
+# leads the commands it receives, each in an instance of its own, named
+# "<replica index>.<number>". Along with the command, the replicas agree on
+# its dependencies: the instances of the commands it interferes with, i.e.
+# that touch some of the same accounts. If a fast quorum reports none that the
+# command leader did not know about, it commits in a single round trip;
+# otherwise, it takes an accept round with all of them. Every replica then
+# executes the commands after their dependencies, and those depending on each
+# other in the order of their sequence numbers, so that interfering commands
+# run in the same order everywhere while the others may not.
+
+# The states of an instance, in the order it goes through them.
+NONE, PREACCEPTED, ACCEPTED, COMMITTED, EXECUTED = range(5)
+
+
+def _split(inst: str) -> Tuple[int, int]:
+    owner, num = inst.split(".")
+    return int(owner), int(num)
+
+
+@dataclass
+class Instance:
+    cmd: Optional[dict] = None
+    seq: int = 0
+    deps: List[str] = field(default_factory=list)
+    # Commands that interfere with all others (e.g. opening an account, which
+    # takes the next uid) depend instead on every instance of each replica up
+    # to the given number.
+    upto: Dict[str, int] = field(default_factory=dict)
+    status: int = NONE
+    # The highest ballot seen for the instance, and the one its attributes
+    # were set at. Command leaders use (0, their index).
+    ballot: Ballot = NO_BALLOT
+    vballot: Ballot = NO_BALLOT
+    # The slot it was ordered at on this replica, once it was.
+    slot: int = -1
+
+    def attrs(self) -> dict:
+        return {"cmd": self.cmd, "seq": self.seq, "deps": self.deps, "upto": self.upto}
+
+
+class EPaxos:
+    def __init__(
+        self,
+        addr: str,
+        other_nodes: List[str],
+        log: WriteAheadLog,
+        applied_slot: int,
+        apply_fn: Callable[[int, dict], object],
+        interference: Callable[[dict], Optional[Sequence[Union[int, str]]]],
+        rpc_timeout: float = 0.5,
+        apply_timeout: float = 5.0,
+        recover_timeout: float = 1.0,
+        sync_period: float = 1.0,
+    ):
+        self.addr = addr
+        self.nodes = sorted({addr, *other_nodes})
+        self.others = [node for node in self.nodes if node != addr]
+        self.idx = self.nodes.index(addr)
+        self.quorum = len(self.nodes) // 2 + 1
+        # With N = 2F + 1 replicas, fast quorums have 2F of them, so that a
+        # majority always holds F of those that took the fast path.
+        self.max_failures = (len(self.nodes) - 1) // 2
+        self.fast_quorum = max(2 * self.max_failures, self.quorum)
+        # Executes a command, as the `slot`-th one on this replica; the order
+        # differs between replicas for commands that do not interfere.
+        self.apply_fn = apply_fn
+        # The uids of the accounts a command touches (and any other names for
+        # state it shares), or None if it interferes with every other command.
+        self.interference = interference
+        self.rpc_timeout = rpc_timeout
+        self.apply_timeout = apply_timeout
+        self.recover_timeout = recover_timeout
+        self.sync_period = sync_period
+
+        self.mtx = threading.RLock()
+        self.exec_cv = threading.Condition(self.mtx)
+        self.instances: Dict[str, Instance] = {}
+        # The latest instance of each replica to touch each account or name
+        # ("*" for those interfering with everything), to compute dependencies.
+        self.index: Dict[Union[int, str], Dict[int, str]] = {}
+        self.max_seq = 0
+        self.max_seen: Dict[int, int] = {}
+        self.next_num = 0
+        # Committed instances yet to execute, and for each replica, the number
+        # up to which all of its instances have executed.
+        self.pending = set()
+        self.frontier: Dict[int, int] = {}
+        # The committed instance numbers of each replica, in order, to serve
+        # anti-entropy syncs from.
+        self.committed: Dict[int, List[int]] = {}
+        # Instances are dropped once every replica has executed them, durably
+        # (see compact): for each replica, up to which number this one has,
+        # each peer has (as last reported), and which were dropped.
+        self.durable: Dict[int, int] = {}
+        self.peer_durable: Dict[str, Dict[int, int]] = {}
+        self.pruned: Dict[int, int] = {}
+        self.compacted = applied_slot
+        self.exec_due = False
+        self.applied = applied_slot
+        self.waiting: Dict[str, Optional[tuple]] = {}
+        self.blocked_since: Dict[str, float] = {}
+        self.recovering = set()
+        self.unreachable = set()
+        self.num_fast = 0
+        self.num_slow = 0
+        self.num_recovered = 0
+
+        # Records: instance state changes ("i"), ballots promised during
+        # recovery ("i" and "b" only), the order instances were executed in
+        # ("x" and the slot "n"), logged before executing them, and up to which
+        # number the instances of each replica were dropped ("f").
+        self.log = log
+        order = []
+        with self.mtx:
+            for record in self.log.replay():
+                if "f" in record:
+                    for owner, num in record["f"].items():
+                        owner = int(owner)
+                        self.pruned[owner] = self.durable[owner] = num
+                        self.frontier[owner] = max(self.frontier.get(owner, -1), num)
+                        self.max_seen[owner] = max(self.max_seen.get(owner, -1), num)
+                    continue
+                if "x" in record:
+                    order.append((record["n"], record["x"]))
+                    continue
+                inst = self._instance(record["i"])
+                inst.ballot = max(inst.ballot, tuple(record["b"]))
+                if "s" in record and inst.status < COMMITTED:
+                    self._update(record["i"], record, record["s"], tuple(record["b"]))
+            for slot, inst in sorted(order):
+                self.instances[inst].slot = slot
+                if slot <= applied_slot:
+                    self._executed(inst)
+                else:
+                    # Ordered, but not executed before the restart.
+                    self.pending.add(inst)
+            self._advance_durable(applied_slot)
+        self.replay_order = [
+            inst for slot, inst in sorted(order) if slot > applied_slot
+        ]
+        self.next_num = self.max_seen.get(self.idx, -1) + 1
+
+        self.pool = ThreadPoolExecutor(max_workers=max(16, 4 * len(self.nodes)))
+        self._local = threading.local()
+        self._handlers = {
+            "/epaxos/preaccept": self.on_preaccept,
+            "/epaxos/accept": self.on_accept,
+            "/epaxos/commit": self.on_commit,
+            "/epaxos/prepare": self.on_prepare,
+        }
+
+        self._executor = Thread(target=fatal_on_error(self._execute_loop), daemon=True)
+        self._syncer = Thread(target=fatal_on_error(self._sync_loop), daemon=True)
+
+    def start(self):
+        # As for MultiPaxos, apply_fn may refer to this instance.
+        self._executor.start()
+        self._syncer.start()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _call(self, node: str, path: str, payload: dict) -> dict:
+        if node == self.addr:
+            return self._handlers[path](payload)
+        resp = self._session().post(
+            f"{node}{path}", json=payload, timeout=self.rpc_timeout
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def _gather(
+        self, nodes: List[str], path: str, payload: dict, need: int, thrifty=False
+    ) -> List[dict]:
+        # Returns once `need` replies are positive, or all came in, or the
+        # RPC timeout ran out. A thrifty call contacts only as many nodes as
+        # it needs, ones that have not failed recently first, and the rest
+        # only if some of those do not answer positively.
+        if need <= 0:
+            return []
+        if thrifty:
+            nodes = sorted(
+                nodes, key=lambda node: (node in self.unreachable, random.random())
+            )
+            first, rest = nodes[:need], nodes[need:]
+            replies = self._gather(first, path, payload, need)
+            num_ok = sum(bool(reply["ok"]) for reply in replies)
+            return replies + self._gather(rest, path, payload, need - num_ok)
+
+        def call(node):
+            try:
+                reply = self._call(node, path, payload)
+            except Exception:
+                self.unreachable.add(node)
+                raise
+            self.unreachable.discard(node)
+            return reply
+
+        futures = [self.pool.submit(call, node) for node in nodes]
+        replies, num_ok = [], 0
+        try:
+            for fut in as_completed(futures, timeout=self.rpc_timeout):
+                try:
+                    reply = fut.result()
+                except Exception:
+                    continue
+                replies.append(reply)
+                num_ok += bool(reply["ok"])
+                if num_ok >= need:
+                    break
+        except concurrent.futures.TimeoutError:
+            for node, fut in zip(nodes, futures):
+                if not fut.done():
+                    self.unreachable.add(node)
+        return replies
+
+    def _forgotten(self, inst: str) -> bool:
+        # Whether the instance was dropped, having executed everywhere.
+        owner, num = _split(inst)
+        return num <= self.pruned.get(owner, -1)
+
+    def _instance(self, inst: str) -> Instance:
+        if inst not in self.instances:
+            self.instances[inst] = Instance()
+        return self.instances[inst]
+
+    def _attributes(self, inst: str, cmd: dict) -> Tuple[int, List[str], dict]:
+        # The sequence number and dependencies of `cmd` as far as we know.
+        uids = self.interference(cmd)
+        if uids is None:
+            upto = {str(owner): num for owner, num in self.max_seen.items()}
+            return self.max_seq + 1, [], upto
+        deps = set()
+        for key in ["*", *uids]:
+            deps.update(self.index.get(key, {}).values())
+        deps.discard(inst)
+        seq = 1 + max((self.instances[dep].seq for dep in deps), default=0)
+        return seq, sorted(deps), {}
+
+    def _update(self, inst: str, attrs: dict, status: int, ballot: Ballot):
+        # Sets the attributes of an instance (from a message or log record)
+        # and indexes it.
+        it = self._instance(inst)
+        it.cmd, it.seq, it.status = attrs["c"], attrs["q"], status
+        it.deps, it.upto = attrs["d"], attrs["u"]
+        it.ballot = max(it.ballot, ballot)
+        it.vballot = ballot
+        owner, num = _split(inst)
+        self.max_seen[owner] = max(self.max_seen.get(owner, -1), num)
+        self.max_seq = max(self.max_seq, it.seq)
+        uids = self.interference(it.cmd)
+        for key in ["*"] if uids is None else uids:
+            latest = self.index.setdefault(key, {})
+            if owner not in latest or _split(latest[owner])[1] < num:
+                latest[owner] = inst
+        if status == COMMITTED:
+            bisect.insort(self.committed.setdefault(owner, []), num)
+            self.pending.add(inst)
+            self.blocked_since.pop(inst, None)
+            self.exec_due = True
+            self.exec_cv.notify_all()
+
+    def _record(
+        self,
+        inst: str,
+        cmd: dict,
+        seq: int,
+        deps: List[str],
+        upto: dict,
+        status: int,
+        ballot: Ballot,
+    ) -> int:
+        record = {
+            "i": inst,
+            "c": cmd,
+            "q": seq,
+            "d": deps,
+            "u": upto,
+            "s": status,
+            "b": list(ballot),
+        }
+        self._update(inst, record, status, ballot)
+        return self.log.append(record, sync=False)
+
+    def on_preaccept(self, msg: dict) -> dict:
+        inst, ballot = msg["inst"], tuple(msg["ballot"])
+        with self.mtx:
+            if self._forgotten(inst):
+                return {"ok": False, "ballot": list(NO_BALLOT)}
+            it = self._instance(inst)
+            if ballot < it.ballot:
+                return {"ok": False, "ballot": list(it.ballot)}
+            if it.status >= COMMITTED:
+                return {"ok": True, "committed": True, **it.attrs()}
+            if it.status == ACCEPTED and ballot == it.vballot:
+                # A late duplicate: the leader has moved on already.
+                return {"ok": True, "seq": it.seq, "deps": it.deps, "upto": it.upto}
+            seq, deps, upto = self._attributes(inst, msg["cmd"])
+            seq = max(seq, msg["seq"])
+            deps = sorted({*deps, *msg["deps"]})
+            for owner, num in msg["upto"].items():
+                upto[owner] = max(upto.get(owner, -1), num)
+            lsn = self._record(inst, msg["cmd"], seq, deps, upto, PREACCEPTED, ballot)
+        self.log.sync(lsn)
+        return {"ok": True, "seq": seq, "deps": deps, "upto": upto}
+
+    def on_accept(self, msg: dict) -> dict:
+        inst, ballot = msg["inst"], tuple(msg["ballot"])
+        with self.mtx:
+            if self._forgotten(inst):
+                return {"ok": False, "ballot": list(NO_BALLOT)}
+            it = self._instance(inst)
+            if ballot < it.ballot:
+                return {"ok": False, "ballot": list(it.ballot)}
+            if it.status >= COMMITTED:
+                return {"ok": True}
+            lsn = self._record(
+                inst, msg["cmd"], msg["seq"], msg["deps"], msg["upto"], ACCEPTED, ballot
+            )
+        self.log.sync(lsn)
+        return {"ok": True}
+
+    def on_commit(self, msg: dict) -> dict:
+        with self.mtx:
+            self._learn(msg)
+        return {"ok": True}
+
+    def _learn(self, msg: dict):
+        # Commits are only logged, not fsync'd: what was committed can always
+        # be recovered from the other replicas.
+        inst = msg["inst"]
+        if self._forgotten(inst):
+            return
+        it = self._instance(inst)
+        if it.status < COMMITTED:
+            self._record(
+                inst,
+                msg["cmd"],
+                msg["seq"],
+                msg["deps"],
+                msg["upto"],
+                COMMITTED,
+                it.ballot,
+            )
+
+    def on_prepare(self, msg: dict) -> dict:
+        inst, ballot = msg["inst"], tuple(msg["ballot"])
+        with self.mtx:
+            if self._forgotten(inst):
+                return {"ok": False, "ballot": list(NO_BALLOT)}
+            it = self._instance(inst)
+            if ballot <= it.ballot:
+                return {"ok": False, "ballot": list(it.ballot)}
+            it.ballot = ballot
+            lsn = self.log.append({"i": inst, "b": list(ballot)}, sync=False)
+            reply = {
+                "ok": True,
+                "node": self.idx,
+                "status": it.status,
+                "vballot": list(it.vballot),
+                **it.attrs(),
+            }
+        self.log.sync(lsn)
+        return reply
+
+    def _commit(self, inst: str, cmd: dict, seq: int, deps: List[str], upto: dict):
+        msg = {"inst": inst, "cmd": cmd, "seq": seq, "deps": deps, "upto": upto}
+        with self.mtx:
+            self._learn(msg)
+        for node in self.others:
+            self.pool.submit(self._call, node, "/epaxos/commit", msg)
+
+    def _accept(
+        self,
+        inst: str,
+        ballot: Ballot,
+        cmd: dict,
+        seq: int,
+        deps: List[str],
+        upto: dict,
+    ):
+        msg = {"inst": inst, "ballot": list(ballot), "cmd": cmd, "seq": seq}
+        msg.update({"deps": deps, "upto": upto})
+        replies = [self.on_accept(msg)]
+        if replies[0]["ok"]:
+            replies += self._gather(
+                self.others, "/epaxos/accept", msg, self.quorum - 1, thrifty=True
+            )
+        if sum(reply["ok"] for reply in replies) < self.quorum:
+            raise ConsensusError(f"Could not get instance {inst} accepted.")
+
+    def _decide(self, inst: str, ballot: Ballot, cmd: dict, fast: bool):
+        # Runs the instance from the pre-accept phase, at `ballot`, through to
+        # its commit.
+        with self.mtx:
+            it = self._instance(inst)
+            if ballot < it.ballot:
+                raise ConsensusError(f"Instance {inst} was taken over.")
+            seq, deps, upto = self._attributes(inst, cmd)
+            lsn = self._record(inst, cmd, seq, deps, upto, PREACCEPTED, ballot)
+        self.log.sync(lsn)
+
+        msg = {"inst": inst, "ballot": list(ballot), "cmd": cmd, "seq": seq}
+        msg.update({"deps": deps, "upto": upto})
+        need = (self.fast_quorum if fast else self.quorum) - 1
+        replies = self._gather(
+            self.others, "/epaxos/preaccept", msg, need, thrifty=True
+        )
+        oks = [reply for reply in replies if reply["ok"]]
+        for reply in oks:
+            if reply.get("committed"):
+                # Recovered by another replica in the meantime.
+                self._commit(
+                    inst, reply["cmd"], reply["seq"], reply["deps"], reply["upto"]
+                )
+                return
+        if len(oks) < self.quorum - 1:
+            raise ConsensusError(f"Could not get instance {inst} pre-accepted.")
+
+        agreed = all(
+            (reply["seq"], reply["deps"], reply["upto"]) == (seq, deps, upto)
+            for reply in oks
+        )
+        if fast and agreed and len(oks) >= self.fast_quorum - 1:
+            with self.mtx:
+                self.num_fast += 1
+        else:
+            # Whatever any replica saw must come first; or else be ordered by
+            # sequence number if it depends on this one too.
+            seq = max([seq, *(reply["seq"] for reply in oks)])
+            deps = sorted({*deps, *(dep for reply in oks for dep in reply["deps"])})
+            for reply in oks:
+                for owner, num in reply["upto"].items():
+                    upto[owner] = max(upto.get(owner, -1), num)
+            self._accept(inst, ballot, cmd, seq, deps, upto)
+            with self.mtx:
+                self.num_slow += 1
+        self._commit(inst, cmd, seq, deps, upto)
+
+    def _recover(self, inst: str):
+        # Takes over an instance whose command leader seems to have failed
+        # (explicit prepare): learns what a majority knows of it and finishes
+        # it the same way, or commits a no-op if it cannot have been chosen.
+        try:
+            with self.mtx:
+                it = self._instance(inst)
+                ballot = (max(it.ballot[0], 0) + 1, self.idx)
+            msg = {"inst": inst, "ballot": list(ballot)}
+            replies = self._gather(self.nodes, "/epaxos/prepare", msg, self.quorum)
+            oks = [reply for reply in replies if reply["ok"]]
+            if len(oks) < self.quorum:
+                return
+
+            def attrs(reply):
+                return reply["cmd"], reply["seq"], reply["deps"], reply["upto"]
+
+            owner = _split(inst)[0]
+            committed = [reply for reply in oks if reply["status"] >= COMMITTED]
+            accepted = [reply for reply in oks if reply["status"] == ACCEPTED]
+            preaccepted = [reply for reply in oks if reply["status"] == PREACCEPTED]
+            # Identical replies to the command leader's own pre-accept, from
+            # other replicas, as left by a fast path that may have succeeded.
+            default = [
+                reply
+                for reply in preaccepted
+                if tuple(reply["vballot"]) == (0, owner) and reply["node"] != owner
+            ]
+            groups = {}
+            for reply in default:
+                key = repr((reply["seq"], reply["deps"], sorted(reply["upto"].items())))
+                groups.setdefault(key, []).append(reply)
+            agreed = [
+                group for group in groups.values() if len(group) >= self.max_failures
+            ]
+
+            if committed:
+                self._commit(inst, *attrs(committed[0]))
+            elif accepted:
+                reply = max(accepted, key=lambda reply: tuple(reply["vballot"]))
+                self._accept(inst, ballot, *attrs(reply))
+                self._commit(inst, *attrs(reply))
+            elif agreed and self.max_failures > 0:
+                self._accept(inst, ballot, *attrs(agreed[0][0]))
+                self._commit(inst, *attrs(agreed[0][0]))
+            elif preaccepted:
+                self._decide(inst, ballot, preaccepted[0]["cmd"], fast=False)
+            else:
+                self._accept(inst, ballot, NOOP, 0, [], {})
+                self._commit(inst, NOOP, 0, [], {})
+            with self.mtx:
+                self.num_recovered += 1
+            logging.info(f"Recovered instance {inst}")
+        except Exception as e:
+            logging.info(f"Recovering instance {inst} failed: {e}")
+        finally:
+            with self.mtx:
+                self.recovering.discard(inst)
+
+    def _successors(self, inst: str) -> Iterator[str]:
+        it = self.instances[inst]
+        yield from it.deps
+        for owner, upto in it.upto.items():
+            owner = int(owner)
+            for num in range(self.frontier.get(owner, -1) + 1, upto + 1):
+                yield f"{owner}.{num}"
+
+    def _components(self, root: str, done: set) -> Union[List[List[str]], str]:
+        # The strongly connected components of the yet unexecuted dependency
+        # graph from `root`, dependencies first (Tarjan's algorithm, without
+        # recursion), or the first dependency that is not committed yet.
+        index, low, stack, on_stack, comps = {root: 0}, {root: 0}, [root], {root}, []
+        work = [(root, self._successors(root))]
+        while work:
+            node, succs = work[-1]
+            for succ in succs:
+                if succ in done or succ == node:
+                    continue
+                owner, num = _split(succ)
+                if num <= self.frontier.get(owner, -1):
+                    continue
+                it = self.instances.get(succ)
+                if it is not None and it.status == EXECUTED:
+                    continue
+                if it is None or it.status < COMMITTED:
+                    return succ
+                if succ not in index:
+                    index[succ] = low[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, self._successors(succ)))
+                    break
+                if succ in on_stack:
+                    low[node] = min(low[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    comp = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        comp.append(member)
+                        if member == node:
+                            break
+                    comps.append(comp)
+        return comps
+
+    def _order(self) -> Tuple[List[str], List[str]]:
+        # What can execute now, in order, and what holds the rest back.
+        order, done, blocked = [], set(), []
+        for inst in sorted(self.pending, key=_split):
+            if inst in done:
+                continue
+            comps = self._components(inst, done)
+            if isinstance(comps, str):
+                blocked.append(comps)
+                continue
+            for comp in comps:
+                comp.sort(
+                    key=lambda member: (self.instances[member].seq, _split(member))
+                )
+                order.extend(comp)
+                done.update(comp)
+        return order, blocked
+
+    def _executed(self, inst: str):
+        self._instance(inst).status = EXECUTED
+        self.pending.discard(inst)
+        owner, _ = _split(inst)
+        frontier = self.frontier.get(owner, -1)
+        while True:
+            it = self.instances.get(f"{owner}.{frontier + 1}")
+            if it is None or it.status != EXECUTED:
+                break
+            frontier += 1
+        self.frontier[owner] = frontier
+
+    def _execute_loop(self):
+        order, lsn = self.replay_order, self.log.lsn
+        while True:
+            if order:
+                # The order is made durable first, so that a restart picks up
+                # from the ledger's last applied slot in the same one.
+                self.log.sync(lsn)
+                for slot, inst in enumerate(order, start=self.applied + 1):
+                    cmd = self.instances[inst].cmd
+                    try:
+                        outcome = (True, self.apply_fn(slot, cmd))
+                    except LedgerError as e:
+                        outcome = (False, str(e))
+                    with self.exec_cv:
+                        self._executed(inst)
+                        self.applied = slot
+                        if inst in self.waiting:
+                            self.waiting[inst] = (cmd.get("id"), outcome)
+                        self.exec_cv.notify_all()
+
+            with self.exec_cv:
+                self.exec_cv.wait_for(
+                    lambda: self.exec_due, timeout=self.recover_timeout / 4
+                )
+                self.exec_due = False
+                order, blocked = self._order()
+                for slot, inst in enumerate(order, start=self.applied + 1):
+                    self.instances[inst].slot = slot
+                    lsn = self.log.append({"x": inst, "n": slot}, sync=False)
+
+                now = time.monotonic()
+                for inst in blocked:
+                    since = self.blocked_since.setdefault(inst, now)
+                    if now - since >= self.recover_timeout:
+                        if inst not in self.recovering:
+                            self.recovering.add(inst)
+                            self.pool.submit(self._recover, inst)
+
+    def _sync_loop(self):
+        # Anti-entropy: commits may be lost along with the messages carrying
+        # them, e.g. while this replica was down. Those that nothing else
+        # depends on would never be recovered otherwise.
+        while True:
+            time.sleep(self.sync_period)
+            if not self.others:
+                continue
+            node = random.choice(self.others)
+            with self.mtx:
+                msg = {
+                    "node": self.addr,
+                    "frontier": {str(o): num for o, num in self.frontier.items()},
+                    "durable": {str(o): num for o, num in self.durable.items()},
+                }
+            try:
+                resp = self._session().post(
+                    f"{node}/epaxos/sync", json=msg, timeout=self.rpc_timeout
+                )
+                resp.raise_for_status()
+                reply = resp.json()
+                with self.mtx:
+                    self._note_durable(node, reply["durable"])
+                    for msg in reply["committed"]:
+                        self._learn(msg)
+            except requests.RequestException as e:
+                logging.info(f"Syncing with {node} failed: {e}")
+
+    def on_sync(self, msg: dict) -> dict:
+        with self.mtx:
+            self._note_durable(msg["node"], msg["durable"])
+            return {
+                "committed": self.committed_since(msg["frontier"]),
+                "durable": {str(o): num for o, num in self.durable.items()},
+            }
+
+    def _note_durable(self, node: str, durable: Dict[str, int]):
+        if node in self.others:
+            self.peer_durable[node] = {int(o): num for o, num in durable.items()}
+
+    def committed_since(
+        self, frontier: Dict[str, int], limit: int = 1024
+    ) -> List[dict]:
+        # The committed instances past the given executed frontier.
+        with self.mtx:
+            msgs = []
+            for owner, nums in self.committed.items():
+                start = bisect.bisect_right(nums, frontier.get(str(owner), -1))
+                for num in nums[start:]:
+                    inst = f"{owner}.{num}"
+                    msgs.append({"inst": inst, **self.instances[inst].attrs()})
+                    if len(msgs) == limit:
+                        return msgs
+            return msgs
+
+    def _advance_durable(self, upto: int):
+        # Instances executed at slots up to `upto` are reflected in a durable
+        # ledger; the durable frontier of each replica moves past them.
+        for owner in self.frontier:
+            num = self.durable.get(owner, -1)
+            while True:
+                it = self.instances.get(f"{owner}.{num + 1}")
+                if it is None or it.status != EXECUTED or it.slot > upto:
+                    break
+                num += 1
+            self.durable[owner] = num
+
+    def compact(self, upto: int):
+        # Drops the instances that every replica has executed, durably: the
+        # caller must have made the ledger durable up to slot `upto`, and the
+        # peers report theirs in anti-entropy syncs. A peer that is down holds
+        # this back until it reports again, since it may need them.
+        with self.mtx:
+            upto = min(upto, self.applied)
+            if upto <= self.compacted:
+                return
+            self.compacted = upto
+            self._advance_durable(upto)
+
+            num_pruned = 0
+            for owner, durable in self.durable.items():
+                floor = min(
+                    [durable]
+                    + [
+                        self.peer_durable.get(node, {}).get(owner, -1)
+                        for node in self.others
+                    ]
+                )
+                for num in range(self.pruned.get(owner, -1) + 1, floor + 1):
+                    self._drop(f"{owner}.{num}")
+                    num_pruned += 1
+                if floor > self.pruned.get(owner, -1):
+                    self.pruned[owner] = floor
+                    nums = self.committed.get(owner, [])
+                    del nums[: bisect.bisect_right(nums, floor)]
+            if num_pruned == 0:
+                return
+
+            records = [{"f": {str(o): num for o, num in self.pruned.items()}}]
+            ordered = []
+            for inst, it in self.instances.items():
+                if it.status != NONE:
+                    records.append(
+                        {
+                            "i": inst,
+                            "c": it.cmd,
+                            "q": it.seq,
+                            "d": it.deps,
+                            "u": it.upto,
+                            "s": min(it.status, COMMITTED),
+                            "b": list(it.vballot),
+                        }
+                    )
+                if it.ballot > it.vballot or it.status == NONE:
+                    records.append({"i": inst, "b": list(it.ballot)})
+                if it.slot >= 0:
+                    ordered.append((it.slot, inst))
+            for slot, inst in sorted(ordered):
+                records.append({"x": inst, "n": slot})
+            self.log.rewrite(records)
+
+    def _drop(self, inst: str):
+        it = self.instances.pop(inst, None)
+        if it is None:
+            return
+        owner, _ = _split(inst)
+        uids = self.interference(it.cmd) if it.cmd is not None else []
+        for key in ["*"] if uids is None else uids:
+            latest = self.index.get(key)
+            if latest is not None and latest.get(owner) == inst:
+                del latest[owner]
+                if not latest:
+                    del self.index[key]
+        self.blocked_since.pop(inst, None)
+
+    def propose(self, op: dict):
+        cmd = {**op, "id": uuid.uuid4().hex}
+        with self.mtx:
+            inst = f"{self.idx}.{self.next_num}"
+            self.next_num += 1
+            self.waiting[inst] = None
+
+        try:
+            self._decide(inst, (0, self.idx), cmd, fast=True)
+            with self.exec_cv:
+                executed = self.exec_cv.wait_for(
+                    lambda: self.waiting[inst] is not None, timeout=self.apply_timeout
+                )
+                if not executed:
+                    raise ConsensusError(f"Timed out waiting for instance {inst}.")
+                cmd_id, outcome = self.waiting[inst]
+        finally:
+            with self.mtx:
+                self.waiting.pop(inst, None)
+
+        if cmd_id != cmd["id"]:
+            # Another replica took the instance over and found nothing to commit.
+            raise ConsensusError(f"Instance {inst} was taken over.")
+        ok, retval = outcome
+        if not ok:
+            raise LedgerError(retval)
+        return retval
+
+    def read_barrier(self, uids: Sequence[int]):
+        # Returns once the local state reflects every write to these accounts
+        # acknowledged before the call: a no-op that interferes with them is
+        # ordered after those writes.
+        self.propose({"op": "noop", "uids": list(uids)})
+
+    def status(self) -> dict:
+        with self.mtx:
+            return {
+                "addr": self.addr,
+                "applied": self.applied,
+                "instances": len(self.instances),
+                "pending": len(self.pending),
+                "fast_quorum": self.fast_quorum,
+                "fast_path": self.num_fast,
+                "slow_path": self.num_slow,
+                "recovered": self.num_recovered,
+                "frontier": {str(owner): num for owner, num in self.frontier.items()},
+                "pruned": {str(owner): num for owner, num in self.pruned.items()},
+                "compacted": self.compacted,
+            }
@@ -1,26 +1,77 @@
 from __future__ import annotations
-from typing import Dict, Union
-from dataclasses import dataclass, asdict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+from dataclasses import dataclass, field
 from dacite.core import from_dict
 from dacite.config import Config
 from ruamel.yaml import YAML
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 from pathlib import Path
-from copy import deepcopy
 from functools import wraps
+import bisect
+from contextlib import contextmanager
+import threading
 import tempfile
+import json
 import os
 import shutil
+import zlib
+from .wal import WriteAheadLog, GroupCommitLog
+from . import snapshot
+from .snapshot import MappedAccounts, SnapshotError
+from .store import ArrayAccounts, MISSING
 
 
 class LedgerError(Exception):
     pass
 
 
-class AtomicMixin:
+# The dedup table is split into buckets by key, each with its share of the
+# capacity, so that a keyed request only ever evicts entries of its own bucket
+# (see Ledger._remember).
+DEDUP_BUCKETS = 64
+
+
+def dedup_bucket(key: str) -> int:
+    # Stable across processes, unlike hash().
+    return zlib.crc32(key.encode()) % DEDUP_BUCKETS
+
+
+class _TxState:
+    # A thread's transaction, so that several can be in progress at once.
     def __init__(self):
         self.in_tx = False
-        self.prev_state = None
+        # Whether it holds the ledger-wide lock (see locking).
+        self.structural = False
+        self.undo_log: Dict[int, Optional[Decimal]] = {}
+        self.undo_txs: Dict[str, Optional[dict]] = {}
+        self.undo_dedup: Dict[str, Optional[dict]] = {}
+        self.undo_next_uid = 0
+        self.undo_applied_slot = -1
+        self.savepoints: List[Tuple[Dict[int, Optional[Decimal]], int, int]] = []
+
+
+class AtomicMixin:
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def _tx(self) -> _TxState:
+        # Looked up once per call, as thread-local attributes are slow.
+        tx = getattr(self._local, "tx", None)
+        if tx is None:
+            tx = self._local.tx = _TxState()
+        return tx
+
+    @property
+    def in_tx(self) -> bool:
+        return self._tx.in_tx
+
+    @in_tx.setter
+    def in_tx(self, value: bool):
+        self._tx.in_tx = value
+
+    def begin(self):
+        pass
 
     def commit(self):
         pass
@@ -29,26 +80,91 @@ class AtomicMixin:
         pass
 
 
-def atomic(method):
-    @wraps(method)
-    def atomic_func(self, *args, **kwargs):
-        nested_tx = self.in_tx
-        if not nested_tx:
-            self.prev_state = deepcopy(self)
-            self.in_tx = True
-
+class AccountLocks:
+    # Striped locks over account uids. A transaction takes the stripes of all
+    # the accounts it touches before it starts, in stripe order, so that ones
+    # on disjoint accounts run in parallel and none waits on another in a
+    # cycle.
+    def __init__(self, num_stripes: int = 256):
+        self.stripes = [threading.Lock() for _ in range(num_stripes)]
+
+    def acquire(self, uids: Sequence[int]) -> Sequence[threading.Lock]:
+        stripes = self.stripes
+        if len(uids) == 1:
+            lock = stripes[hash(uids[0]) % len(stripes)]
+            lock.acquire()
+            return (lock,)
+        idxs = sorted({hash(uid) % len(stripes) for uid in uids})
+        locks = [stripes[idx] for idx in idxs]
+        for lock in locks:
+            lock.acquire()
+        return locks
+
+    @staticmethod
+    def release(locks: Sequence[threading.Lock]):
+        for lock in locks:
+            lock.release()
+
+    @contextmanager
+    def hold_all(self):
+        locks = self.acquire(range(len(self.stripes)))
         try:
-            retval = method(self, *args, **kwargs)
-            if not nested_tx:
-                self.commit()
-                self.in_tx = False
-
+            yield
+        finally:
+            self.release(locks)
+
+
+def locking(footprint):
+    # Makes the method atomic and, outside of a transaction, first takes the
+    # locks of what it touches. `footprint(self, *args)` returns whether it
+    # needs the ledger-wide lock, which guards uid allocation, transfer
+    # records, the dedup table and the applied slot, and the uids of the
+    # accounts. It is evaluated again once that lock is held, as the uids may
+    # depend on what it guards. The lock order is: the ledger-wide lock, then
+    # the stripes.
+    def decorator(method):
+        @wraps(method)
+        def locked_func(self, *args, **kwargs):
+            tx = self._tx
+            if tx.in_tx:
+                # Nested: the outermost call commits or restores.
+                try:
+                    return method(self, *args, **kwargs)
+                except Exception as e:
+                    self.restore()
+                    raise e
+
+            structural, uids = footprint(self, *args, **kwargs)
+            if structural:
+                self.mtx.acquire()
+            try:
+                if structural:
+                    _, uids = footprint(self, *args, **kwargs)
+                locks = self.locks.acquire(uids)
+                tx.in_tx, tx.structural = True, structural
+                try:
+                    self.begin()
+                    retval = method(self, *args, **kwargs)
+                    self.commit()
+                except Exception as e:
+                    self.restore()
+                    raise e
+                finally:
+                    tx.in_tx, tx.structural = False, False
+                    self.locks.release(locks)
+            finally:
+                if structural:
+                    self.mtx.release()
+            self.after_unlock()
             return retval
-        except Exception as e:
-            self.restore()
-            raise e
 
-    return atomic_func
+        return locked_func
+
+    return decorator
+
+
+# An amount in the ledger's own terms (see Ledger.to_amount).
+Amount = Union[int, Decimal]
 
 
 @dataclass
@@ -61,52 +177,560 @@ class Account:
 class Ledger(AtomicMixin):
     accounts: Dict[int, Account]
     next_uid: int
+    applied_slot: int = -1
+    # This shard's side of the cross-shard transfers in progress, by id.
+    txs: Dict[str, dict] = field(default_factory=dict)
+    # The outcomes of requests sent with an idempotency key, by key (see
+    # apply).
+    dedup: Dict[str, dict] = field(default_factory=dict)
 
     def __post_init__(self):
         AtomicMixin.__init__(self)
+        self.locks = AccountLocks()
+        self.mtx = threading.Lock()
+        # Set when this is one shard of many, to report uids the way clients
+        # know them (see ShardMap).
+        self.shard_id, self.num_shards = 0, 1
+        # Bounds of the dedup table. Evictions are part of the replicated
+        # state, so every replica of a group must use the same ones.
+        self.dedup_capacity, self.dedup_ttl = 100000, 3600.0
+        # Decimal places of amounts and funds, whatever the store.
+        if isinstance(self.accounts, ArrayAccounts):
+            self.scale = self.accounts.scale
+        else:
+            self.scale = 2
+        self._reindex_dedup()
+
+    @property
+    def undo_log(self) -> Dict[int, Optional[Decimal]]:
+        return self._tx.undo_log
+
+    @property
+    def undo_txs(self) -> Dict[str, Optional[dict]]:
+        return self._tx.undo_txs
+
+    @property
+    def undo_dedup(self) -> Dict[str, Optional[dict]]:
+        return self._tx.undo_dedup
+
+    @property
+    def savepoints(self) -> List[Tuple[Dict[int, Optional[Decimal]], int, int]]:
+        return self._tx.savepoints
+
+    @contextmanager
+    def exclusive(self):
+        # Keeps every transaction out, e.g. to take a snapshot.
+        with self.mtx, self.locks.hold_all():
+            yield
+
+    def after_unlock(self):
+        pass
+
+    def _saved_funds(self, uid: int):
+        # What the undo log keeps for an account: its funds (in minor units
+        # with an array store), or None if it does not exist.
+        if isinstance(self.accounts, ArrayAccounts):
+            return self.accounts.get_units(uid)
+        acct = self.accounts.get(uid)
+        return acct.funds if acct is not None else None
+
+    def _touch(self, uid: int):
+        # Must be called before the account is first modified in the current
+        # transaction; None marks an account that did not exist before.
+        tx = self._tx
+        if uid not in tx.undo_log:
+            tx.undo_log[uid] = self._saved_funds(uid)
+        if tx.savepoints:
+            changes = tx.savepoints[-1][0]
+            if uid not in changes:
+                changes[uid] = self._saved_funds(uid)
+
+    def _set_tx(self, tx: str, record: Optional[dict]):
+        if tx not in self.undo_txs:
+            self.undo_txs[tx] = self.txs.get(tx)
+        if record is None:
+            del self.txs[tx]
+        else:
+            self.txs[tx] = record
+
+    def _reindex_dedup(self):
+        # The dedup entries of each bucket by (ts, key), oldest first, to
+        # evict them by.
+        self.dedup_order: Dict[int, List[Tuple[float, str]]] = {}
+        for key, entry in self.dedup.items():
+            order = self.dedup_order.setdefault(dedup_bucket(key), [])
+            order.append((entry["ts"], key))
+        for order in self.dedup_order.values():
+            order.sort()
+
+    def _put_dedup(self, key: str, entry: Optional[dict]):
+        bucket = dedup_bucket(key)
+        order = self.dedup_order.setdefault(bucket, [])
+        prev = self.dedup.pop(key, None)
+        if prev is not None:
+            del order[bisect.bisect_left(order, (prev["ts"], key))]
+        if entry is not None:
+            self.dedup[key] = entry
+            bisect.insort(order, (entry["ts"], key))
+        elif not order:
+            del self.dedup_order[bucket]
+
+    def _set_dedup(self, key: str, entry: Optional[dict]):
+        if key not in self.undo_dedup:
+            self.undo_dedup[key] = self.dedup.get(key)
+        self._put_dedup(key, entry)
+
+    def _modified(self) -> bool:
+        tx = self._tx
+        return (
+            bool(tx.undo_log)
+            or bool(tx.undo_txs)
+            or bool(tx.undo_dedup)
+            or tx.structural
+            and (
+                self.next_uid != tx.undo_next_uid
+                or self.applied_slot != tx.undo_applied_slot
+            )
+        )
+
+    def begin(self):
+        tx = self._tx
+        tx.undo_log.clear()
+        tx.undo_txs.clear()
+        tx.undo_dedup.clear()
+        tx.undo_next_uid = self.next_uid
+        tx.undo_applied_slot = self.applied_slot
 
     def commit(self):
-        pass
+        tx = self._tx
+        tx.undo_log.clear()
+        tx.undo_txs.clear()
+        tx.undo_dedup.clear()
 
     def _assign(self, value: Ledger):
         for field in self.__dataclass_fields__:
             prev_value = getattr(value, field)
             setattr(self, field, prev_value)
+        self._reindex_dedup()
 
     def restore(self):
-        if self.prev_state is not None:
-            self._assign(self.prev_state)
-
-    @atomic
+        # Rolls back to the innermost savepoint, or else the whole transaction.
+        tx = self._tx
+        if tx.savepoints:
+            changes, next_uid, applied_slot = tx.savepoints[-1]
+        else:
+            changes = tx.undo_log
+            next_uid, applied_slot = tx.undo_next_uid, tx.undo_applied_slot
+        # Without the ledger-wide lock, these may have moved on since.
+        if tx.structural:
+            self.next_uid, self.applied_slot = next_uid, applied_slot
+
+        for uid, funds in list(changes.items()):
+            if funds is None:
+                del self.accounts[uid]
+                if self.undo_log.get(uid, 0) is None:
+                    del self.undo_log[uid]
+            elif isinstance(self.accounts, ArrayAccounts):
+                self.accounts.set_units(uid, funds)
+            else:
+                self.accounts[uid].funds = funds
+        changes.clear()
+
+        # Transfer records and the dedup table are never changed inside a
+        # batch, so they only need to be rolled back with the whole
+        # transaction.
+        if not self.savepoints:
+            for tx_id, record in self.undo_txs.items():
+                if record is None:
+                    self.txs.pop(tx_id, None)
+                else:
+                    self.txs[tx_id] = record
+            self.undo_txs.clear()
+            for key, entry in self.undo_dedup.items():
+                self._put_dedup(key, entry)
+            self.undo_dedup.clear()
+
+    @contextmanager
+    def savepoint(self):
+        # A failed operation inside only rolls back what it did since here.
+        changes = {}
+        self.savepoints.append((changes, self.next_uid, self.applied_slot))
+        try:
+            yield
+        finally:
+            self.savepoints.pop()
+            if self.savepoints:
+                outer = self.savepoints[-1][0]
+                for uid, funds in changes.items():
+                    outer.setdefault(uid, funds)
+
+    @locking(lambda self: (True, [self.next_uid]))
     def open_acct(self):
-        acct = Account(uid=self.next_uid, funds=Decimal(0))
+        self._touch(self.next_uid)
+        acct = Account(uid=self.next_uid, funds=snapshot.from_units(0, self.scale))
         self.accounts[self.next_uid] = acct
         self.next_uid += 1
         return acct.uid
 
-    @atomic
-    def account(self, uid: int) -> Account:
+    def footprint(self, op: dict) -> Tuple[bool, List[int]]:
+        # What executing `op` needs to lock (see locking). Accounts opened in
+        # a batch get the uids after the current one, in order.
+        structural, uids, opened = False, [], 0
+
+        def visit(op: dict):
+            nonlocal structural, opened
+            kind = op["op"]
+            if kind in ("deposit", "withdraw"):
+                uids.append(op["uid"])
+            elif kind == "transfer":
+                uids.extend((op["from_uid"], op["to_uid"]))
+            elif kind == "batch":
+                for sub_op in op["ops"]:
+                    visit(sub_op)
+            elif kind == "open_acct":
+                structural = True
+                uids.append(self.next_uid + opened)
+                opened += 1
+            elif kind in ("tx_commit", "tx_abort"):
+                structural = True
+                uids.extend(self._tx_uids(op["tx"]))
+            elif kind == "noop":
+                # Orders reads after the writes to these accounts (see EPaxos).
+                uids.extend(op.get("uids", ()))
+            else:
+                structural = True
+                if "uid" in op:
+                    uids.append(op["uid"])
+
+        visit(op)
+        return structural, uids
+
+    def _tx_uids(self, tx: str) -> List[int]:
+        record = self.txs.get(tx)
+        return [record["uid"]] if record is not None and "uid" in record else []
+
+    def _no_account(self, uid: int) -> LedgerError:
+        global_uid = uid * self.num_shards + self.shard_id
+        return LedgerError(f"Account with UID {global_uid} does not exist.")
+
+    def _account(self, uid: int) -> Account:
+        # For operations that hold the account's lock already.
         if uid not in self.accounts:
-            raise LedgerError(f"Account with UID {uid} does not exist.")
+            raise self._no_account(uid)
         return self.accounts[uid]
 
-    @atomic
-    def deposit(self, uid: int, amount: Decimal):
-        acct = self.account(uid)
+    @locking(lambda self, uid: (False, [uid]))
+    def account(self, uid: int) -> Account:
+        return self._account(uid)
+
+    # Amounts are converted once, where operations come in (execute), into
+    # what the store adds up: minor units with the array store, Decimals with
+    # exactly `scale` places otherwise. Both stores thus refuse the same
+    # amounts and report funds the same way.
+
+    def to_amount(self, amount: Union[str, Decimal]) -> Amount:
+        try:
+            units = snapshot.to_units(Decimal(amount), self.scale)
+        except InvalidOperation:
+            raise LedgerError(f"{amount} is not an amount.")
+        except SnapshotError as e:
+            raise LedgerError(str(e))
+        if isinstance(self.accounts, ArrayAccounts):
+            return units
+        return snapshot.from_units(units, self.scale)
+
+    def format_amount(self, amount: Amount) -> str:
+        if isinstance(amount, int):
+            return str(snapshot.from_units(amount, self.scale))
+        return str(amount)
+
+    def _add_units(self, uid: int, delta: int):
+        # The array store's fast path: no Decimal arithmetic, no Account
+        # objects, and the undo log is written directly (see _touch).
+        units = self.accounts.get_units(uid)
+        if units is None:
+            raise self._no_account(uid)
+        if units + delta < 0 and delta < 0:
+            raise LedgerError("Insufficient funds.")
+        if not MISSING < units + delta <= snapshot.INT64_MAX:
+            raise LedgerError("The resulting funds do not fit in a 64-bit record.")
+        tx = self._tx
+        if uid not in tx.undo_log:
+            tx.undo_log[uid] = units
+        if tx.savepoints:
+            tx.savepoints[-1][0].setdefault(uid, units)
+        self.accounts.units[uid] = units + delta
+
+    @locking(lambda self, uid, amount: (False, [uid]))
+    def deposit(self, uid: int, amount: Amount):
+        if isinstance(self.accounts, ArrayAccounts):
+            return self._add_units(uid, amount)
+        acct = self._account(uid)
+        self._touch(uid)
         acct.funds += amount
 
-    @atomic
-    def withdraw(self, uid: int, amount: Decimal):
-        acct = self.account(uid)
+    @locking(lambda self, uid, amount: (False, [uid]))
+    def withdraw(self, uid: int, amount: Amount):
+        if isinstance(self.accounts, ArrayAccounts):
+            return self._add_units(uid, -amount)
+        acct = self._account(uid)
         if acct.funds < amount:
             raise LedgerError("Insufficient funds.")
+        self._touch(uid)
         acct.funds -= amount
 
-    @atomic
-    def transfer(self, from_uid: int, to_uid: int, amount: Decimal):
+    @locking(lambda self, from_uid, to_uid, amount: (False, [from_uid, to_uid]))
+    def transfer(self, from_uid: int, to_uid: int, amount: Amount):
         self.withdraw(from_uid, amount)
         self.deposit(to_uid, amount)
 
+    # A transfer between shards is a two-phase commit driven by the source
+    # shard. Both sides first prepare: the source withdraws the funds, the
+    # target checks that the account exists. The source then logs the outcome
+    # and keeps its record until the target has learned it too. The target
+    # keeps its record past the outcome as well, so that a late message about
+    # the transfer is not taken for a new one, until the source's prepare
+    # deadline is long past (see TransferCoordinator).
+    #
+    # A keyed transfer retried by the client reuses the transaction id. Each
+    # attempt is told apart by when the source started it (`started`, kept as
+    # info["ts"]): a later one resumes the transfer if it is still going or
+    # committed, and starts over if it was aborted.
+
+    @locking(lambda self, tx, role, uid, amount, info, now=None: (True, [uid]))
+    def tx_prepare(
+        self,
+        tx: str,
+        role: str,
+        uid: int,
+        amount: Amount,
+        info: dict,
+        now: Optional[float] = None,
+    ) -> float:
+        # Returns when the attempt that goes on was started.
+        record = self.txs.get(tx)
+        if record is not None:
+            started = _started(record)
+            if info["ts"] < started or (
+                info["ts"] == started and record["state"] == "aborted"
+            ):
+                raise LedgerError(f"Transaction {tx} was aborted.")
+            if info["ts"] == started or record["state"] == "committed":
+                return started
+            if role == "source" and record["state"] == "prepared":
+                return started
+            # Otherwise the earlier attempt was aborted (on the target, maybe
+            # without having heard of it yet).
+        if role == "source":
+            self.withdraw(uid, amount)
+        else:
+            if now is not None and now > info["deadline"]:
+                raise LedgerError(f"Transaction {tx} timed out.")
+            self.account(uid)
+        amount = self.format_amount(amount)
+        record = {"role": role, "uid": uid, "amount": amount, "info": info}
+        self._set_tx(tx, {**record, "state": "prepared"})
+        return info["ts"]
+
+    @locking(lambda self, tx, role, started=None: (True, self._tx_uids(tx)))
+    def tx_commit(self, tx: str, role: str, started: Optional[float] = None):
+        record = self.txs.get(tx)
+        if record is None and role == "target":
+            # Committed already, long ago; the source is retrying.
+            return
+        if (
+            record is None
+            or record["state"] == "aborted"
+            or started not in (None, _started(record))
+        ):
+            raise LedgerError(f"Transaction {tx} is not prepared.")
+        if record["state"] == "committed":
+            return
+        if role == "target":
+            self.deposit(record["uid"], self.to_amount(record["amount"]))
+        self._set_tx(tx, {**record, "state": "committed"})
+
+    @locking(lambda self, tx, role, started=None: (True, self._tx_uids(tx)))
+    def tx_abort(self, tx: str, role: str, started: Optional[float] = None):
+        record = self.txs.get(tx)
+        if record is not None and started not in (None, _started(record)):
+            if role == "source" or started < _started(record):
+                # About another attempt.
+                return
+            # The target never heard of this attempt, so the one it has is
+            # over as well.
+            record = None
+        if record is None:
+            if role == "target":
+                # Makes sure a prepare still on its way gets refused.
+                info = {"ts": started if started is not None else 0.0}
+                self._set_tx(tx, {"role": role, "state": "aborted", "info": info})
+            return
+        if record["state"] == "committed":
+            raise LedgerError(f"Transaction {tx} is already committed.")
+        if record["state"] == "aborted":
+            return
+        if role == "source":
+            self.deposit(record["uid"], self.to_amount(record["amount"]))
+        self._set_tx(tx, {**record, "state": "aborted"})
+
+    @locking(lambda self, tx, started=None: (True, []))
+    def tx_end(self, tx: str, started: Optional[float] = None):
+        # The outcome is no longer needed: on the source, once the target has
+        # learned it; on the target, once no message about it can arrive.
+        record = self.txs.get(tx)
+        if (
+            record is not None
+            and record["state"] != "prepared"
+            and started in (None, _started(record))
+        ):
+            self._set_tx(tx, None)
+
+    @locking(lambda self, op: self.footprint(op))
+    def execute(self, op: dict):
+        kind = op["op"]
+        if kind == "open_acct":
+            return self.open_acct()
+        elif kind == "deposit":
+            self.deposit(op["uid"], self.to_amount(op["amount"]))
+        elif kind == "withdraw":
+            self.withdraw(op["uid"], self.to_amount(op["amount"]))
+        elif kind == "transfer":
+            self.transfer(op["from_uid"], op["to_uid"], self.to_amount(op["amount"]))
+        elif kind == "batch":
+            return self.batch(op["ops"], op.get("atomic", False))
+        elif kind == "tx_prepare":
+            amount = self.to_amount(op["amount"])
+            return self.tx_prepare(
+                op["tx"], op["role"], op["uid"], amount, op["info"], op.get("now")
+            )
+        elif kind == "tx_commit":
+            self.tx_commit(op["tx"], op["role"], op.get("started"))
+        elif kind == "tx_abort":
+            self.tx_abort(op["tx"], op["role"], op.get("started"))
+        elif kind == "tx_end":
+            self.tx_end(op["tx"], op.get("started"))
+        elif kind != "noop":
+            raise LedgerError(f"Unknown operation {kind}.")
+
+    @locking(
+        lambda self, ops, all_or_nothing=False: self.footprint(
+            {"op": "batch", "ops": ops}
+        )
+    )
+    def batch(self, ops: List[dict], all_or_nothing: bool = False):
+        # Returns an (ok, result or error message) pair per operation. Unless
+        # all_or_nothing is set, a failed operation is rolled back on its own
+        # and the rest still go through.
+        results = []
+        for idx, op in enumerate(ops):
+            if all_or_nothing:
+                try:
+                    results.append((True, self.execute(op)))
+                except LedgerError as e:
+                    raise LedgerError(f"Operation #{idx} failed: {e}")
+            else:
+                try:
+                    with self.savepoint():
+                        results.append((True, self.execute(op)))
+                except LedgerError as e:
+                    results.append((False, str(e)))
+        return results
+
+    # Requests may carry an idempotency key, the digest of what the client
+    # sent and the time they were proposed at. The first one with a given
+    # key is executed and its outcome kept; later ones (retries, or hedged
+    # copies proposed meanwhile) get that outcome back instead. Each bucket
+    # keeps its share of dedup_capacity newest entries by (ts, key), and none
+    # older than dedup_ttl before its newest. A request only changes its own
+    # bucket, so replicas that order the requests of each bucket the same
+    # (EPaxos orders them as interfering) keep and evict the same entries,
+    # whatever order they execute the rest in.
+
+    def _remember(self, op: dict, ok: bool, result):
+        key, ts = op["key"], op.get("ts", 0.0)
+        if key in self.dedup:
+            ts = max(ts, self.dedup[key]["ts"])
+        entry = {"ok": ok, "result": result, "digest": op.get("digest"), "ts": ts}
+        self._set_dedup(key, entry)
+        order = self.dedup_order[dedup_bucket(key)]
+        capacity = -(-self.dedup_capacity // DEDUP_BUCKETS)
+        horizon = order[-1][0] - self.dedup_ttl
+        while order and (len(order) > capacity or order[0][0] < horizon):
+            self._set_dedup(order[0][1], None)
+
+    def outcome(self, entry: dict, digest: Optional[str]):
+        # The result kept in a dedup entry; a failure is raised again.
+        if entry["digest"] != digest:
+            raise LedgerError("The idempotency key was used for another request.")
+        if not entry["ok"]:
+            raise LedgerError(entry["result"])
+        return entry["result"]
+
+    @locking(lambda self, slot, op: (True, self.footprint(op)[1]))
+    def _apply(self, slot: int, op: dict):
+        retval = self.execute(op)
+        if "key" in op:
+            self._remember(op, True, retval)
+        self.applied_slot = slot
+        return retval
+
+    @locking(lambda self, slot, op, error: (True, []))
+    def _skip(self, slot: int, op: dict, error: str):
+        if "key" in op:
+            self._remember(op, False, error)
+        self.applied_slot = slot
+
+    @locking(lambda self, slot, op: (True, []))
+    def _repeat(self, slot: int, op: dict) -> dict:
+        entry = self.dedup[op["key"]]
+        if entry["digest"] == op.get("digest"):
+            self._remember(op, entry["ok"], entry["result"])
+        self.applied_slot = slot
+        return entry
+
+    def apply(self, slot: int, op: dict):
+        if slot <= self.applied_slot:
+            # Already covered by an installed snapshot.
+            return None
+        # Only the thread applying the log changes the table.
+        if op.get("key") in self.dedup:
+            return self.outcome(self._repeat(slot, op), op.get("digest"))
+        # A failed operation still consumes its log slot.
+        try:
+            return self._apply(slot, op)
+        except LedgerError as e:
+            self._skip(slot, op, str(e))
+            raise
+
+    def snapshot_header(self) -> dict:
+        return {
+            "next_uid": self.next_uid,
+            "applied_slot": self.applied_slot,
+            "txs": dict(self.txs),
+            "dedup": dict(self.dedup),
+        }
+
+    def snapshot_items(self) -> Iterator[Tuple[int, Decimal]]:
+        # Funds are immutable, so copying the references is enough to keep
+        # the view consistent.
+        return iter([(uid, acct.funds) for uid, acct in self.accounts.items()])
+
+    def install(self, header: dict, accounts: Dict[int, Account]):
+        # Replaces the whole state with a snapshot from another replica.
+        self.accounts = accounts
+        self.next_uid = header["next_uid"]
+        self.applied_slot = header["applied_slot"]
+        self.txs = header["txs"]
+        self.dedup = header.get("dedup", {})
+        self._reindex_dedup()
+
+
+def _started(tx_record: dict) -> float:
+    # When the source started the attempt a transfer record is about; 0 for
+    # targets' records from before it was kept.
+    return tx_record.get("info", {}).get("ts", 0.0)
+
 
 def Decimal_repr(representer, value: Decimal):
     return representer.represent_data(str(value))
@@ -121,23 +745,226 @@ yaml.representer.add_representer(Decimal, Decimal_repr)
 yaml.constructor.add_constructor(Decimal, Decimal_ctor)
 
 
+def txs_file(fpath: Union[str, Path]) -> Path:
+    fpath = Path(fpath)
+    return fpath.with_name(fpath.name + ".txs")
+
+
+def dedup_file(fpath: Union[str, Path]) -> Path:
+    fpath = Path(fpath)
+    return fpath.with_name(fpath.name + ".dedup")
+
+
+def _write_json(fpath: Path, data: dict):
+    # Atomically replaces the file, or removes it when there is no data.
+    if data:
+        tmp_path = fpath.with_name(fpath.name + ".tmp")
+        with open(tmp_path, mode="w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, fpath)
+    elif fpath.exists():
+        fpath.unlink()
+
+
+def _read_json(fpath: Path) -> dict:
+    return json.loads(fpath.read_text()) if fpath.exists() else {}
+
+
 class FileLedger(Ledger):
-    def __init__(self, fpath: Union[str, Path]):
+    def __init__(
+        self,
+        fpath: Union[str, Path],
+        wal: bool = False,
+        checkpoint_every: int = 10000,
+        group_window: Optional[float] = None,
+        group_max_batch: int = 128,
+        snapshot_format: Optional[str] = None,
+        scale: int = 2,
+        store: str = "dict",
+    ):
         super().__init__(accounts={}, next_uid=0)
 
         self.fpath = Path(fpath)
-        if self.fpath.exists():
+        self.scale = scale
+        self.store = store
+        self.snapshot_format = snapshot_format
+        if snapshot.is_binary(self.fpath):
+            self._load_binary()
+        elif self.fpath.exists():
             with open(self.fpath, mode="r") as f:
                 data = yaml.load(f)
                 state = from_dict(Ledger, data, Config(cast=[Decimal]))
                 self._assign(state)
 
+        if self.snapshot_format is None:
+            is_binary = isinstance(self.accounts, MappedAccounts)
+            self.snapshot_format = "binary" if is_binary else "yaml"
+        self._adopt_store()
+
+        self.wal = None
+        self.checkpoint_every = checkpoint_every
+        self.lsn = 0
+        # Commits only ask for checkpoints, which need every lock; see
+        # after_unlock. Appends to the WAL are serialized on their own.
+        self._checkpoint_due = False
+        self._log_mtx = threading.Lock()
+        if wal:
+            wal_path = self.fpath.with_name(self.fpath.name + ".wal")
+            if group_window is not None:
+                self.wal = GroupCommitLog(wal_path, group_window, group_max_batch)
+            else:
+                self.wal = WriteAheadLog(wal_path)
+            for record in self.wal.replay():
+                self._redo(record)
+
+    def _load_binary(self):
+        self.accounts = MappedAccounts(self.fpath, make_account=Account)
+        self.next_uid = self.accounts.next_uid
+        self.applied_slot = self.accounts.applied_slot
+        self.scale = self.accounts.scale
+        self.txs = _read_json(txs_file(self.fpath))
+        self.dedup = _read_json(dedup_file(self.fpath))
+        self._reindex_dedup()
+
+    def _adopt_store(self):
+        if self.store != "array" or isinstance(self.accounts, ArrayAccounts):
+            return
+        if isinstance(self.accounts, MappedAccounts):
+            units = self.accounts.units_array()
+            if units is not None:
+                self.accounts = ArrayAccounts(self.scale, units)
+                return
+        self.accounts = ArrayAccounts.from_items(self.scale, self.snapshot_items())
+
+    def _redo(self, record: dict):
+        for uid, funds in record["a"]:
+            self.accounts[uid] = Account(uid=uid, funds=Decimal(funds))
+        for tx, tx_record in record.get("t", []):
+            if tx_record is None:
+                self.txs.pop(tx, None)
+            else:
+                self.txs[tx] = tx_record
+        for key, entry in record.get("d", []):
+            self._put_dedup(key, entry)
+        self.next_uid = record.get("n", self.next_uid)
+        self.applied_slot = record.get("s", self.applied_slot)
+
+    def _record(self) -> dict:
+        accounts = [[uid, str(self.accounts[uid].funds)] for uid in self.undo_log]
+        if self._tx.structural:
+            record = {"n": self.next_uid, "s": self.applied_slot, "a": accounts}
+        else:
+            # Other transactions may be changing these in the meantime.
+            record = {"a": accounts}
+        if self.undo_txs:
+            record["t"] = [[tx, self.txs.get(tx)] for tx in self.undo_txs]
+        if self.undo_dedup:
+            record["d"] = [[key, self.dedup.get(key)] for key in self.undo_dedup]
+        return record
+
+    def export(self, fpath: Union[str, Path], snapshot_format: str):
+        if snapshot_format == "binary":
+            # Transfer records and the dedup table don't fit the fixed-size
+            # records, so they go to files of their own, written first:
+            # replaying the WAL over newer ones still ends up in the same
+            # state.
+            _write_json(txs_file(fpath), self.txs)
+            _write_json(dedup_file(fpath), self.dedup)
+
+            if isinstance(self.accounts, ArrayAccounts) and len(self.accounts) == len(
+                self.accounts.units
+            ):
+                snapshot.write_binary_units(
+                    fpath,
+                    self.next_uid,
+                    self.applied_slot,
+                    self.accounts.units,
+                    self.accounts.scale,
+                )
+                return
+
+            # Read from the stored records, so that a mapped snapshot isn't
+            # decoded into the overlay account by account.
+            snapshot.write_binary(
+                fpath,
+                self.next_uid,
+                self.applied_slot,
+                self.snapshot_items(),
+                self.scale,
+            )
+        else:
+            accounts = {
+                uid: {"uid": uid, "funds": funds}
+                for uid, funds in self.snapshot_items()
+            }
+            data = {
+                "accounts": accounts,
+                "next_uid": self.next_uid,
+                "applied_slot": self.applied_slot,
+                "txs": self.txs,
+                "dedup": self.dedup,
+            }
+            with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmpfile:
+                yaml.dump(data, tmpfile)
+                tmpfile.flush()
+                os.fsync(tmpfile.fileno())
+                shutil.move(tmpfile.name, fpath)
+
+    def snapshot_items(self) -> Iterator[Tuple[int, Decimal]]:
+        if isinstance(self.accounts, (MappedAccounts, ArrayAccounts)):
+            return self.accounts.frozen_items()
+        return super().snapshot_items()
+
+    def install(self, header: dict, accounts: Dict[int, Account]):
+        super().install(header, accounts)
+        self._adopt_store()
+        self.checkpoint()
+
+    def checkpoint(self):
+        # Must be called under exclusive().
+        self._checkpoint_due = False
+        self.export(self.fpath, self.snapshot_format)
+        # The array already is as compact as the mapped snapshot would be.
+        if self.snapshot_format == "binary" and self.store != "array":
+            self._load_binary()
+
+        if self.wal is not None:
+            self.wal.truncate()
+
     def commit(self):
+        if self.snapshot_format == "binary" and self.store != "array":
+            # Reject funds the fixed-point records cannot hold while the
+            # transaction can still be rolled back.
+            for uid in self.undo_log:
+                try:
+                    snapshot.to_units(self.accounts[uid].funds, self.scale)
+                except SnapshotError as e:
+                    raise LedgerError(str(e))
+
+        if not self._modified():
+            pass
+        elif self.wal is None:
+            self._checkpoint_due = True
+        else:
+            with self._log_mtx:
+                lsn = self.lsn = self.wal.append(self._record(), sync=False)
+                if self.wal.num_records >= self.checkpoint_every:
+                    self._checkpoint_due = True
+            # Concurrent commits share the fsync; with group commit, waiting
+            # for it is up to the caller (see sync).
+            if not isinstance(self.wal, GroupCommitLog):
+                self.wal.sync(lsn)
+
         super().commit()
 
-        data = asdict(self)
-        with tempfile.NamedTemporaryFile(mode="w", delete=False) as tmpfile:
-            yaml.dump(data, tmpfile)
-            tmpfile.flush()
-            os.fsync(tmpfile.fileno())
-            shutil.move(tmpfile.name, self.fpath)
+    def after_unlock(self):
+        if self._checkpoint_due:
+            with self.exclusive():
+                if self._checkpoint_due:
+                    self.checkpoint()
+
+    def sync(self, lsn: int):
+        if self.wal is not None:
+            self.wal.sync(lsn)
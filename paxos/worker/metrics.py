@@ -0,0 +1,186 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Sequence, Tuple
+import bisect
+import threading
+import time
+
+# Metrics cheap enough to leave on under full load. Updates are spread over a
+# fixed number of stripes by thread id, each a plain list with a lock of its
+# own, so threads rarely wait on each other and the memory stays bounded no
+# matter how many threads come and go. Scrapes add the stripes up without
+# stopping writers, so they may be off by the updates racing with them.
+
+NUM_STRIPES = 16
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class _Sharded:
+    def __init__(self, size: int):
+        self.size = size
+        self.shards: List[list] = [[0] * size for _ in range(NUM_STRIPES)]
+        self._locks = [threading.Lock() for _ in range(NUM_STRIPES)]
+
+    def _add(self, idx: int, amount: float):
+        stripe = threading.get_ident() % NUM_STRIPES
+        with self._locks[stripe]:
+            self.shards[stripe][idx] += amount
+
+    def _totals(self) -> list:
+        totals = [0] * self.size
+        for shard in self.shards:
+            for idx, value in enumerate(shard):
+                totals[idx] += value
+        return totals
+
+
+class Counter(_Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount: float = 1):
+        self._add(0, amount)
+
+    def value(self) -> float:
+        return self._totals()[0]
+
+
+class Histogram(_Sharded):
+    def __init__(self, buckets: Sequence[float]):
+        # One slot per bucket, one for +Inf, then the sum.
+        super().__init__(len(buckets) + 2)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float):
+        stripe = threading.get_ident() % NUM_STRIPES
+        with self._locks[stripe]:
+            shard = self.shards[stripe]
+            shard[bisect.bisect_left(self.buckets, value)] += 1
+            shard[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        totals = self._totals()
+        return totals[:-1], totals[-1]
+
+
+class _Timer:
+    def __init__(self, hist: Histogram):
+        self.hist = hist
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start)
+
+
+class Family:
+    def __init__(self, name: str, help: str, kind: str, labels: Sequence[str], make):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(labels)
+        self.make = make
+        self.children: Dict[tuple, object] = {}
+        self._mtx = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._mtx:
+                child = self.children.setdefault(values, self.make())
+        return child
+
+    def _label_str(self, values, extra=()) -> str:
+        pairs = [*zip(self.label_names, values), *extra]
+        if not pairs:
+            return ""
+        inner = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+        return "{" + inner + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children.items()):
+            if self.kind == "counter":
+                lines.append(f"{self.name}{self._label_str(values)} {child.value()}")
+                continue
+
+            counts, total = child.snapshot()
+            cumulative = 0
+            bounds = [*(repr(b) for b in child.buckets), "+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = self._label_str(values, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = self._label_str(values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class GaugeFn:
+    # Gauges are read when scraped rather than kept up to date.
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.fn()}",
+        ]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Family:
+        family = Family(name, help, "counter", labels, Counter)
+        self.metrics.append(family)
+        return family
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Family:
+        family = Family(name, help, "histogram", labels, lambda: Histogram(buckets))
+        self.metrics.append(family)
+        return family
+
+    def gauge_fn(self, name: str, help: str, fn: Callable[[], float]):
+        self.metrics.append(GaugeFn(name, help, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
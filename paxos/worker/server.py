@@ -0,0 +1,142 @@
+from __future__ import annotations
+from typing import Callable, Iterator, List, Mapping, Optional, Set, Tuple, Union
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import re
+from flask import Flask, request
+from werkzeug.serving import WSGIRequestHandler
+
+# Routes are declared once, with Flask's path syntax, and served by either
+# Flask or aiohttp. Views take a Request and the path parameters and return a
+# JSON-able body; `dispatch` turns that (or the exception it raised) into a
+# (status, body, content type) triple. A body can also be an iterator of
+# chunks, which are streamed as they are produced.
+
+INT_PARAM = re.compile(r"<int:(\w+)>")
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    json: Optional[object]
+    args: Mapping[str, str]
+    headers: Mapping[str, str]
+
+
+Response = Tuple[int, Union[bytes, Iterator[bytes]], str]
+Dispatch = Callable[[Callable, Request, dict], Response]
+
+
+class Router:
+    def __init__(self):
+        self.routes: List[Tuple[str, str, Callable]] = []
+        # The consensus RPCs between replicas, which client requests wait on.
+        self.peer_views: Set[Callable] = set()
+
+    def route(self, method: str, path: str, peer: bool = False):
+        def decorator(view):
+            self.routes.append((method, path, view))
+            if peer:
+                self.peer_views.add(view)
+            return view
+
+        return decorator
+
+    def get(self, path: str, peer: bool = False):
+        return self.route("GET", path, peer)
+
+    def post(self, path: str, peer: bool = False):
+        return self.route("POST", path, peer)
+
+
+def run_flask(router: Router, dispatch: Dispatch, port: int):
+    app = Flask(__name__)
+
+    for method, path, view in router.routes:
+
+        def flask_view(view=view, **params):
+            req = Request(
+                method=request.method,
+                path=request.path,
+                json=request.get_json(silent=True),
+                args=request.args,
+                headers=request.headers,
+            )
+            status, body, content_type = dispatch(view, req, params)
+            return body, status, {"Content-Type": content_type}
+
+        app.add_url_rule(
+            path, endpoint=view.__name__, view_func=flask_view, methods=[method]
+        )
+
+    # Keep-alive matters for the peer-to-peer Paxos traffic; Werkzeug closes
+    # the connection after every HTTP/1.0 response.
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    app.run(debug=False, port=port)
+
+
+def run_asyncio(
+    router: Router,
+    dispatch: Dispatch,
+    port: int,
+    num_threads: int,
+    num_peer_threads: int,
+):
+    from aiohttp import web
+
+    # Connections, keep-alive and request parsing live on the event loop. The
+    # views block (on consensus rounds, the ledger lock and fsyncs), so they
+    # run on a bounded pool instead. Peer RPCs get a pool of their own: client
+    # requests blocked on consensus must not keep out the rounds they wait on.
+    client_pool = ThreadPoolExecutor(max_workers=num_threads)
+    peer_pool = ThreadPoolExecutor(max_workers=num_peer_threads)
+    app = web.Application()
+
+    for method, path, view in router.routes:
+        int_params = INT_PARAM.findall(path)
+        aio_path = INT_PARAM.sub(r"{\1:\\d+}", path)
+
+        pool = peer_pool if view in router.peer_views else client_pool
+
+        async def aio_view(request, view=view, int_params=int_params, pool=pool):
+            json = None
+            if request.can_read_body:
+                try:
+                    json = await request.json()
+                except ValueError:
+                    pass
+            req = Request(
+                method=request.method,
+                path=request.path,
+                json=json,
+                args=request.query,
+                headers=request.headers,
+            )
+            params = {name: int(request.match_info[name]) for name in int_params}
+
+            loop = asyncio.get_running_loop()
+            status, body, content_type = await loop.run_in_executor(
+                pool, dispatch, view, req, params
+            )
+            headers = {"Content-Type": content_type}
+            if isinstance(body, bytes):
+                return web.Response(body=body, status=status, headers=headers)
+
+            resp = web.StreamResponse(status=status, headers=headers)
+            resp.enable_chunked_encoding()
+            await resp.prepare(request)
+            while True:
+                chunk = await loop.run_in_executor(pool, next, body, None)
+                if chunk is None:
+                    break
+                await resp.write(chunk)
+            await resp.write_eof()
+            return resp
+
+        app.router.add_route(method, aio_path, aio_view)
+
+    logging.getLogger("aiohttp.access").setLevel(logging.WARN)
+    web.run_app(app, port=port, print=None)
@@ -0,0 +1,188 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional
+import threading
+from threading import Thread
+import logging
+import random
+import time
+import uuid
+import requests
+from .ledger import LedgerError
+from .consensus import ConsensusError
+
+# How many transfer timeouts the target keeps the outcome of an attempt for.
+TARGET_RECORD_TIMEOUTS = 10
+
+
+def _details(resp: requests.Response) -> Optional[str]:
+    # The error a worker refused a request with, if that is what answered.
+    try:
+        return resp.json().get("details")
+    except ValueError:
+        return None
+
+
+class ShardMap:
+    # Account uids are interleaved over the shards: shard `s` owns the uids
+    # equal to `s` modulo the number of shards and keeps them in its ledger
+    # as `uid // num_shards`. With a single shard both are the same.
+    def __init__(self, shard_id: int, groups: List[List[str]]):
+        self.shard_id = shard_id
+        self.groups = groups
+        self.num_shards = len(groups)
+
+    def shard_of(self, uid: int) -> int:
+        return uid % self.num_shards
+
+    def to_local(self, uid: int) -> int:
+        if self.shard_of(uid) != self.shard_id:
+            raise LedgerError(
+                f"Account with UID {uid} is not on shard {self.shard_id}."
+            )
+        return uid // self.num_shards
+
+    def to_global(self, uid: int) -> int:
+        return uid * self.num_shards + self.shard_id
+
+
+class TransferCoordinator:
+    # Runs the source side of cross-shard transfers (see Ledger.tx_prepare).
+    # Every step is a proposal in this shard's log, so if the leader dies
+    # halfway, the next one finds the record and finishes the transfer:
+    # aborting it if no outcome was logged, or else telling the target again.
+    # The target refuses prepares after the attempt's deadline, so it drops its
+    # records some time after that.
+    def __init__(
+        self,
+        shards: ShardMap,
+        propose: Callable[[dict], object],
+        txs: Callable[[], Dict[str, dict]],
+        is_leader: Callable[[], bool],
+        rpc_timeout: float = 0.5,
+        tx_timeout: float = 10.0,
+    ):
+        self.shards = shards
+        self.propose = propose
+        self.txs = txs
+        self.is_leader = is_leader
+        self.rpc_timeout = rpc_timeout
+        self.tx_timeout = tx_timeout
+        self._local = threading.local()
+
+        self._recoverer = Thread(target=self._recover_loop, daemon=True)
+        self._recoverer.start()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _call(
+        self, shard: int, path: str, payload: dict
+    ) -> Optional[requests.Response]:
+        # Any node of the group will do, since followers forward to the leader.
+        # None means that we don't know whether the request went through.
+        nodes = list(self.shards.groups[shard])
+        random.shuffle(nodes)
+        for node in nodes:
+            try:
+                resp = self._session().post(
+                    f"{node}{path}", json=payload, timeout=self.rpc_timeout
+                )
+            except requests.RequestException:
+                continue
+            if resp.status_code < 500:
+                return resp
+        return None
+
+    def _finish(self, tx: str, started: float, target: int, outcome: str):
+        resp = self._call(target, f"/tx/{outcome}", {"tx": tx, "started": started})
+        if resp is not None and resp.ok:
+            self.propose({"op": "tx_end", "tx": tx, "started": started})
+
+    def transfer(
+        self, from_uid: int, to_uid: int, amount: str, keyed: Optional[dict] = None
+    ):
+        # With an idempotency key (see Ledger.apply), a retry resumes the same
+        # transfer, and the outcome is kept along with the commit.
+        keyed = keyed or {}
+        if keyed:
+            tx = uuid.uuid5(uuid.NAMESPACE_URL, keyed["key"]).hex
+        else:
+            tx = uuid.uuid4().hex
+        target = self.shards.shard_of(to_uid)
+        info = {"target": target, "to_uid": to_uid, "ts": time.time()}
+        # An attempt of the same keyed transfer may be going on already, or
+        # be committed; this one then carries on with it.
+        started = self.propose(
+            {
+                "op": "tx_prepare",
+                "tx": tx,
+                "role": "source",
+                "uid": from_uid,
+                "amount": amount,
+                "info": info,
+            }
+        )
+
+        payload = {
+            "tx": tx,
+            "uid": to_uid,
+            "amount": amount,
+            "started": started,
+            "deadline": started + self.tx_timeout,
+        }
+        resp = self._call(target, "/tx/prepare", payload)
+        if resp is not None and resp.ok:
+            try:
+                self.propose(
+                    {
+                        "op": "tx_commit",
+                        "tx": tx,
+                        "role": "source",
+                        "started": started,
+                        **keyed,
+                    }
+                )
+            except LedgerError:
+                # Recovery gave up on the transfer in the meantime.
+                pass
+            else:
+                self._finish(tx, started, target, "commit")
+                return
+
+        self.propose({"op": "tx_abort", "tx": tx, "role": "source", "started": started})
+        self._finish(tx, started, target, "abort")
+        if resp is None:
+            raise ConsensusError(f"Shard {target} is unavailable.")
+        raise LedgerError(_details(resp) or f"Shard {target} refused the transfer.")
+
+    def _recover(self, tx: str, record: dict):
+        started, state = record["info"]["ts"], record["state"]
+        if state == "prepared":
+            self.propose(
+                {"op": "tx_abort", "tx": tx, "role": "source", "started": started}
+            )
+            state = "aborted"
+        outcome = "commit" if state == "committed" else "abort"
+        self._finish(tx, started, record["info"]["target"], outcome)
+
+    def _recover_loop(self):
+        while True:
+            time.sleep(self.tx_timeout / 2)
+            if not self.is_leader():
+                continue
+            now = time.time()
+            for tx, record in self.txs().items():
+                started = record.get("info", {}).get("ts", 0.0)
+                try:
+                    if record["role"] == "source":
+                        if now - started >= self.tx_timeout:
+                            self._recover(tx, record)
+                    elif record["state"] != "prepared":
+                        # Well past the deadline of the attempt, with room
+                        # for clock skew and proposals that were held up.
+                        if now - started >= TARGET_RECORD_TIMEOUTS * self.tx_timeout:
+                            self.propose({"op": "tx_end", "tx": tx, "started": started})
+                except (LedgerError, ConsensusError) as e:
+                    logging.info(f"Recovering transaction {tx} failed: {e}")
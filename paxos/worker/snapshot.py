@@ -0,0 +1,228 @@
+from __future__ import annotations
+from typing import Callable, Iterable, Iterator, Optional, Tuple, Union
+from array import array
+from collections.abc import MutableMapping
+from decimal import Decimal
+from pathlib import Path
+import struct
+import mmap
+import sys
+import os
+
+# Layout (little-endian): a fixed header followed by `count` fixed-width
+# (uid, units) records sorted by uid, where funds == units * 10^-scale.
+# Version 1 headers lack the applied log slot.
+MAGIC = b"PXLB"
+VERSION = 2
+HEADER_V1 = struct.Struct("<4sHHqq")
+HEADER = struct.Struct("<4sHHqqq")
+RECORD = struct.Struct("<qq")
+
+INT64_MIN, INT64_MAX = -(2**63), 2**63 - 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def is_binary(fpath: Union[str, Path]) -> bool:
+    try:
+        with open(fpath, mode="rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def to_units(funds: Decimal, scale: int) -> int:
+    try:
+        num, den = funds.as_integer_ratio()
+    except (ValueError, OverflowError):
+        raise SnapshotError(f"{funds} is not a finite amount.")
+    units, rem = divmod(num * 10**scale, den)
+    if rem:
+        raise SnapshotError(f"{funds} has more than {scale} decimal places.")
+    if not INT64_MIN <= units <= INT64_MAX:
+        raise SnapshotError(f"{funds} does not fit in a 64-bit snapshot record.")
+    return units
+
+
+def from_units(units: int, scale: int) -> Decimal:
+    return Decimal(units).scaleb(-scale)
+
+
+def write_binary(
+    fpath: Union[str, Path],
+    next_uid: int,
+    applied_slot: int,
+    accounts: Iterable[Tuple[int, Decimal]],
+    scale: int,
+):
+    records = sorted((uid, to_units(funds, scale)) for uid, funds in accounts)
+    buf = bytearray(RECORD.size * len(records))
+    for idx, (uid, units) in enumerate(records):
+        RECORD.pack_into(buf, idx * RECORD.size, uid, units)
+    _write_records(fpath, next_uid, applied_slot, scale, len(records), buf)
+
+
+def write_binary_units(
+    fpath: Union[str, Path],
+    next_uid: int,
+    applied_slot: int,
+    units: array,
+    scale: int,
+):
+    # The same, for the balances of uids 0..len(units)-1 as an int64 array:
+    # the records are interleaved in bulk instead of packed one by one.
+    records = array("q", bytes(2 * units.itemsize * len(units)))
+    records[0::2] = array("q", range(len(units)))
+    records[1::2] = units
+    if sys.byteorder != "little":
+        records.byteswap()
+    _write_records(fpath, next_uid, applied_slot, scale, len(units), records)
+
+
+def _write_records(fpath, next_uid, applied_slot, scale, count, buf):
+    fpath = Path(fpath)
+    tmp_path = fpath.with_name(fpath.name + ".tmp")
+    with open(tmp_path, mode="wb") as f:
+        header = HEADER.pack(MAGIC, VERSION, scale, next_uid, applied_slot, count)
+        f.write(header)
+        f.write(buf)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, fpath)
+
+
+# Accounts backed by a memory-mapped binary snapshot. Records are decoded on
+# first access and from then on live in the overlay, since callers mutate the
+# Account objects they get back.
+class MappedAccounts(MutableMapping):
+    def __init__(self, fpath: Union[str, Path], make_account: Callable):
+        self.make_account = make_account
+        self.overlay = {}
+        self.deleted = set()
+
+        with open(fpath, mode="rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER_V1.size:
+                raise SnapshotError(f"{fpath} is truncated.")
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from("<4sH", self.buf, 0)
+        if magic != MAGIC:
+            raise SnapshotError(f"{fpath} is not a binary ledger snapshot.")
+        if version == 1:
+            self.header_size = HEADER_V1.size
+            _, _, scale, next_uid, count = HEADER_V1.unpack_from(self.buf, 0)
+            applied_slot = -1
+        elif version == VERSION:
+            self.header_size = HEADER.size
+            _, _, scale, next_uid, applied_slot, count = HEADER.unpack_from(self.buf, 0)
+        else:
+            raise SnapshotError(f"Unsupported snapshot version {version}.")
+        if size != self.header_size + count * RECORD.size:
+            raise SnapshotError(f"{fpath} is truncated.")
+
+        self.scale = scale
+        self.next_uid = next_uid
+        self.applied_slot = applied_slot
+        self.count = count
+        # Uids are normally dense, in which case the record index is the uid.
+        self.dense = count == 0 or self._record(count - 1)[0] == count - 1
+
+    def _record(self, idx: int) -> Tuple[int, int]:
+        return RECORD.unpack_from(self.buf, self.header_size + idx * RECORD.size)
+
+    def _find(self, uid: int):
+        if self.dense:
+            if 0 <= uid < self.count:
+                return self._record(uid)[1]
+            return None
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_uid, units = self._record(mid)
+            if mid_uid == uid:
+                return units
+            elif mid_uid < uid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _mapped_uids(self) -> Iterator[int]:
+        if self.dense:
+            return iter(range(self.count))
+        return (self._record(idx)[0] for idx in range(self.count))
+
+    def __getitem__(self, uid: int):
+        if uid in self.overlay:
+            return self.overlay[uid]
+        if uid in self.deleted or not isinstance(uid, int):
+            raise KeyError(uid)
+
+        units = self._find(uid)
+        if units is None:
+            raise KeyError(uid)
+        acct = self.make_account(uid, from_units(units, self.scale))
+        self.overlay[uid] = acct
+        return acct
+
+    def __setitem__(self, uid: int, acct):
+        self.deleted.discard(uid)
+        self.overlay[uid] = acct
+
+    def __delitem__(self, uid: int):
+        self[uid]
+        del self.overlay[uid]
+        self.deleted.add(uid)
+
+    def __contains__(self, uid) -> bool:
+        if uid in self.overlay:
+            return True
+        if uid in self.deleted or not isinstance(uid, int):
+            return False
+        return self._find(uid) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        # Reading accounts while iterating caches them in the overlay, so
+        # only the ones cached beforehand are yielded from there.
+        overlay = list(self.overlay)
+        cached = set(overlay)
+        for uid in self._mapped_uids():
+            if uid not in cached and uid not in self.deleted:
+                yield uid
+        yield from overlay
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def units_array(self) -> Optional[array]:
+        # The balances as an int64 array indexed by uid, if the uids are
+        # dense and nothing has been changed since mapping.
+        if not self.dense or self.overlay or self.deleted:
+            return None
+        records = array("q")
+        records.frombytes(self.buf[self.header_size :])
+        if sys.byteorder != "little":
+            records.byteswap()
+        return records[1::2]
+
+    def frozen_items(self) -> Iterator[Tuple[int, Decimal]]:
+        # A point-in-time view that stays valid while the accounts change:
+        # only what changed since the snapshot was mapped gets copied, and the
+        # mapped file is never written to (checkpoints replace it).
+        buf, header_size, count = self.buf, self.header_size, self.count
+        scale = self.scale
+        overlay = {uid: acct.funds for uid, acct in self.overlay.items()}
+        deleted = set(self.deleted)
+
+        def items():
+            for idx in range(count):
+                uid, units = RECORD.unpack_from(buf, header_size + idx * RECORD.size)
+                if uid not in overlay and uid not in deleted:
+                    yield uid, from_units(units, scale)
+            yield from overlay.items()
+
+        return items()
@@ -0,0 +1,97 @@
+from __future__ import annotations
+from typing import Iterable, Iterator, Optional, Tuple
+from collections.abc import MutableMapping
+from array import array
+from decimal import Decimal
+from .snapshot import INT64_MIN, to_units, from_units
+
+# Balances of dense uids kept in a single int64 array of minor units (funds
+# times 10^scale), indexed by uid: 8 bytes per account instead of an Account
+# object and a Decimal. Uids that do not (or no longer) exist hold MISSING,
+# which is thus not a valid balance.
+MISSING = INT64_MIN
+
+
+class ArrayAccount:
+    # A view of one balance, for code written against Account.
+    __slots__ = ("accounts", "uid")
+
+    def __init__(self, accounts: ArrayAccounts, uid: int):
+        self.accounts = accounts
+        self.uid = uid
+
+    @property
+    def funds(self) -> Decimal:
+        return from_units(self.accounts.units[self.uid], self.accounts.scale)
+
+    @funds.setter
+    def funds(self, funds: Decimal):
+        self.accounts.units[self.uid] = to_units(funds, self.accounts.scale)
+
+
+class ArrayAccounts(MutableMapping):
+    def __init__(self, scale: int, units: Optional[array] = None):
+        self.scale = scale
+        self.units = units if units is not None else array("q")
+        self.count = len(self.units) - self.units.count(MISSING)
+
+    @staticmethod
+    def from_items(scale: int, items: Iterable[Tuple[int, Decimal]]):
+        accounts = ArrayAccounts(scale)
+        for uid, funds in items:
+            accounts.set_units(uid, to_units(funds, scale))
+        return accounts
+
+    def get_units(self, uid: int) -> Optional[int]:
+        if 0 <= uid < len(self.units):
+            units = self.units[uid]
+            if units != MISSING:
+                return units
+        return None
+
+    def set_units(self, uid: int, units: int):
+        if uid >= len(self.units):
+            self.units.extend([MISSING] * (uid + 1 - len(self.units)))
+        if self.units[uid] == MISSING:
+            self.count += 1
+        self.units[uid] = units
+
+    def __getitem__(self, uid: int) -> ArrayAccount:
+        if not isinstance(uid, int) or self.get_units(uid) is None:
+            raise KeyError(uid)
+        return ArrayAccount(self, uid)
+
+    def __setitem__(self, uid: int, acct):
+        self.set_units(uid, to_units(acct.funds, self.scale))
+
+    def __delitem__(self, uid: int):
+        if not isinstance(uid, int) or self.get_units(uid) is None:
+            raise KeyError(uid)
+        self.units[uid] = MISSING
+        self.count -= 1
+        # Rolling back opened accounts deletes them from the end.
+        while self.units and self.units[-1] == MISSING:
+            self.units.pop()
+
+    def __contains__(self, uid) -> bool:
+        return isinstance(uid, int) and self.get_units(uid) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        for uid, units in enumerate(self.units):
+            if units != MISSING:
+                yield uid
+
+    def __len__(self) -> int:
+        return self.count
+
+    def frozen_items(self) -> Iterator[Tuple[int, Decimal]]:
+        # Copying the array is a single memcpy, so it can be done under the
+        # ledger lock; the decoding happens later, lazily.
+        units, scale = array("q", self.units), self.scale
+
+        def items():
+            for uid, value in enumerate(units):
+                if value != MISSING:
+                    yield uid, from_units(value, scale)
+
+        return items()
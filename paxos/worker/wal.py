@@ -0,0 +1,212 @@
+from __future__ import annotations
+from typing import Iterator, List, Union
+from pathlib import Path
+from collections import deque
+import threading
+from threading import Thread
+import time
+import json
+import os
+
+
+class WriteAheadLog:
+    def __init__(self, fpath: Union[str, Path]):
+        self.fpath = Path(fpath)
+        self.num_records = 0
+        self.lsn = 0
+        self.durable_lsn = 0
+        self._file = None
+        # Called with the duration of each fsync, e.g. to export it.
+        self.on_fsync = None
+        self._sync_mtx = threading.Lock()
+
+    def replay(self) -> Iterator[dict]:
+        if not self.fpath.exists():
+            return
+
+        valid_len = 0
+        with open(self.fpath, mode="rb") as f:
+            for line in f:
+                # A torn last line is what a crash mid-append leaves behind.
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                valid_len += len(line)
+                self.num_records += 1
+                yield record
+
+        if valid_len < self.fpath.stat().st_size:
+            os.truncate(self.fpath, valid_len)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.fpath, mode="ab")
+        return self._file
+
+    def _write(self, record: dict):
+        f = self._open()
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        f.write(line.encode())
+        self.num_records += 1
+        self.lsn += 1
+
+    def append(self, record: dict, sync: bool = True) -> int:
+        self._write(record)
+        if sync:
+            self.sync(self.lsn)
+        return self.lsn
+
+    def sync(self, lsn: int):
+        with self._sync_mtx:
+            if lsn > self.durable_lsn:
+                lsn = self.lsn
+                f = self._open()
+                f.flush()
+                start = time.perf_counter()
+                os.fsync(f.fileno())
+                if self.on_fsync is not None:
+                    self.on_fsync(time.perf_counter() - start)
+                self.durable_lsn = max(self.durable_lsn, lsn)
+
+    def truncate(self):
+        f = self._open()
+        f.flush()
+        f.truncate(0)
+        os.fsync(f.fileno())
+        self.num_records = 0
+        self.durable_lsn = self.lsn
+
+    def rewrite(self, records: List[dict]):
+        # Atomically replaces the whole log with `records`, e.g. to drop
+        # entries that a snapshot has made redundant.
+        tmp_path = self.fpath.with_name(self.fpath.name + ".tmp")
+        with open(tmp_path, mode="wb") as f:
+            for record in records:
+                line = json.dumps(record, separators=(",", ":")) + "\n"
+                f.write(line.encode())
+            f.flush()
+            os.fsync(f.fileno())
+        with self._sync_mtx:
+            self.close()
+            os.replace(tmp_path, self.fpath)
+            self.num_records = len(records)
+            self.durable_lsn = self.lsn
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class GroupCommitLog(WriteAheadLog):
+    def __init__(
+        self,
+        fpath: Union[str, Path],
+        window: float,
+        max_batch: int,
+        num_samples: int = 1024,
+    ):
+        super().__init__(fpath)
+        self.window = window
+        self.max_batch = max_batch
+        self.num_batches = 0
+        self.batch_sizes = deque(maxlen=num_samples)
+        self.fsync_times = deque(maxlen=num_samples)
+        self._syncing = False
+
+        self._cv = threading.Condition()
+        self._flusher = Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def append(self, record: dict, sync: bool = True) -> int:
+        with self._cv:
+            self._write(record)
+            self._cv.notify_all()
+            return self.lsn
+
+    def sync(self, lsn: int):
+        with self._cv:
+            self._cv.wait_for(lambda: self.durable_lsn >= lsn)
+
+    def truncate(self):
+        with self._cv:
+            self._open().flush()
+            super().truncate()
+            self.durable_lsn = self.lsn
+            self._cv.notify_all()
+
+    def rewrite(self, records: List[dict]):
+        with self._cv:
+            # The file must not be closed under an fsync in progress.
+            self._cv.wait_for(lambda: not self._syncing)
+            super().rewrite(records)
+            self._cv.notify_all()
+
+    def _flush_loop(self):
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: self.lsn > self.durable_lsn)
+
+                deadline = time.monotonic() + self.window
+                while self.lsn - self.durable_lsn < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cv.wait(remaining)
+                # A rewrite or truncate in the meantime made it all durable
+                # (and may have closed the file).
+                if self.lsn <= self.durable_lsn:
+                    continue
+
+                f = self._open()
+                f.flush()
+                batch_lsn = self.lsn
+                fd = f.fileno()
+                self._syncing = True
+
+            # Appends may keep going into the next batch while we fsync.
+            start = time.perf_counter()
+            os.fsync(fd)
+            fsync_time = time.perf_counter() - start
+            if self.on_fsync is not None:
+                self.on_fsync(fsync_time)
+
+            with self._cv:
+                self._syncing = False
+                if batch_lsn > self.durable_lsn:
+                    self.batch_sizes.append(batch_lsn - self.durable_lsn)
+                    self.fsync_times.append(fsync_time)
+                    self.num_batches += 1
+                    self.durable_lsn = batch_lsn
+                self._cv.notify_all()
+
+    def stats(self) -> dict:
+        with self._cv:
+            batch_sizes = sorted(self.batch_sizes)
+            fsync_times = sorted(self.fsync_times)
+
+        def pct(values, q):
+            if not values:
+                return None
+            return values[min(len(values) - 1, int(q * len(values)))]
+
+        return {
+            "window": self.window,
+            "max_batch": self.max_batch,
+            "num_batches": self.num_batches,
+            "durable_lsn": self.durable_lsn,
+            "batch_size": {
+                "mean": sum(batch_sizes) / len(batch_sizes) if batch_sizes else None,
+                "p50": pct(batch_sizes, 0.5),
+                "p99": pct(batch_sizes, 0.99),
+                "max": pct(batch_sizes, 1.0),
+            },
+            "fsync_ms": {
+                "p50": pct([t * 1e3 for t in fsync_times], 0.5),
+                "p99": pct([t * 1e3 for t in fsync_times], 0.99),
+                "max": pct([t * 1e3 for t in fsync_times], 1.0),
+            },
+        }
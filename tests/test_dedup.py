@@ -0,0 +1,102 @@
+import random
+import pytest
+from paxos.worker.ledger import FileLedger, Ledger, LedgerError, dedup_bucket
+
+# EPaxos replicas execute commands on disjoint accounts in orders of their
+# own; their dedup tables must still end up the same.
+
+NUM_ACCOUNTS = 8
+
+
+def make_ledger(capacity: int, ttl: float) -> Ledger:
+    ledger = Ledger(accounts={}, next_uid=0)
+    ledger.dedup_capacity, ledger.dedup_ttl = capacity, ttl
+    for slot in range(NUM_ACCOUNTS):
+        ledger.apply(slot, {"op": "open_acct"})
+    return ledger
+
+
+def keyed_ops(rng: random.Random, num: int):
+    ops = []
+    for idx in range(num):
+        if ops and rng.random() < 0.2:
+            # A retry of an earlier request, proposed later.
+            retry = dict(rng.choice(ops))
+            retry["ts"] += rng.uniform(0, 50)
+            ops.append(retry)
+            continue
+        op = "withdraw" if idx % 5 == 0 else "deposit"
+        ops.append(
+            {
+                "op": op,
+                "uid": rng.randrange(NUM_ACCOUNTS),
+                "amount": "1",
+                "key": f"k{idx}",
+                "digest": f"d{idx}",
+                "ts": 1000.0 + rng.uniform(0, 100),
+            }
+        )
+    return ops
+
+
+def interferes(first: dict, second: dict) -> bool:
+    return first["uid"] == second["uid"] or dedup_bucket(first["key"]) == dedup_bucket(
+        second["key"]
+    )
+
+
+def interleaving(rng: random.Random, ops):
+    # Another order EPaxos could pick: ops that interfere (on the same
+    # account, or the same dedup bucket) stay in order, the rest are
+    # shuffled.
+    remaining, order = list(ops), []
+    while remaining:
+        ready = [
+            idx
+            for idx, op in enumerate(remaining)
+            if not any(interferes(prev, op) for prev in remaining[:idx])
+        ]
+        order.append(remaining.pop(rng.choice(ready)))
+    return order
+
+
+def run(ledger: Ledger, ops) -> dict:
+    # The outcome of each request, by key and in the order they were applied.
+    outcomes = {}
+    for slot, op in enumerate(ops, start=ledger.applied_slot + 1):
+        try:
+            outcome = (True, ledger.apply(slot, op))
+        except LedgerError as e:
+            outcome = (False, str(e))
+        outcomes.setdefault(op["key"], []).append(outcome)
+    return outcomes
+
+
+@pytest.mark.parametrize(
+    "capacity,ttl", [(64, 3600.0), (1000, 20.0), (128, 20.0), (10000, 3600.0)]
+)
+def test_eviction_does_not_depend_on_order(capacity, ttl):
+    rng = random.Random(capacity + int(ttl))
+    ops = keyed_ops(rng, 400)
+    first, second = make_ledger(capacity, ttl), make_ledger(capacity, ttl)
+    outcomes = run(first, ops)
+
+    assert run(second, interleaving(rng, ops)) == outcomes
+    assert first.accounts == second.accounts
+    assert first.dedup == second.dedup
+    assert first.dedup_order == second.dedup_order
+    for order in first.dedup_order.values():
+        assert len(order) <= -(-capacity // 64)
+        assert order[0][0] >= order[-1][0] - ttl
+
+
+def test_wal_replay_rebuilds_the_index(tmp_path):
+    ledger = FileLedger(tmp_path / "ledger.yml", wal=True)
+    ledger.dedup_capacity = 10
+    for slot in range(NUM_ACCOUNTS):
+        ledger.apply(slot, {"op": "open_acct"})
+    run(ledger, keyed_ops(random.Random(1), 50))
+
+    reloaded = FileLedger(tmp_path / "ledger.yml", wal=True)
+    assert reloaded.dedup == ledger.dedup
+    assert reloaded.dedup_order == ledger.dedup_order
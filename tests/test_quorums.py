@@ -0,0 +1,59 @@
+import pytest
+from paxos.worker.consensus import quorum_sizes
+from paxos.failure_detector import PhiAccrualDetector
+
+
+@pytest.mark.parametrize(
+    "num_nodes,q1,q2,expected",
+    [
+        (3, None, None, (2, 2)),
+        (5, None, None, (3, 3)),
+        (4, None, None, (3, 3)),
+        (5, 4, None, (4, 2)),
+        (5, None, 2, (4, 2)),
+        (5, 5, 1, (5, 1)),
+        (6, 4, 4, (4, 4)),
+    ],
+)
+def test_quorum_sizes(num_nodes, q1, q2, expected):
+    assert quorum_sizes(num_nodes, q1, q2) == expected
+
+
+@pytest.mark.parametrize("q1,q2", [(3, 2), (2, 2), (0, 5), (6, None), (None, 6)])
+def test_quorums_must_intersect(q1, q2):
+    with pytest.raises(ValueError):
+        quorum_sizes(5, q1, q2)
+
+
+def test_phi_grows_with_silence():
+    detector = PhiAccrualDetector(8.0, expected_interval=1.0, min_std=0.1, now=0.0)
+    for beat in range(1, 21):
+        detector.heartbeat(now=float(beat))
+    assert detector.phi(now=20.5) < 1.0
+    assert detector.phi(now=21.0) < detector.phi(now=21.5) < detector.phi(now=22.0)
+    assert not detector.suspected(now=21.2)
+    assert detector.suspected(now=23.0)
+
+
+def test_phi_adapts_to_jitter():
+    # The same delay is suspicious after regular heartbeats, not irregular ones.
+    regular = PhiAccrualDetector(8.0, expected_interval=1.0, min_std=0.2, now=0.0)
+    jittery = PhiAccrualDetector(8.0, expected_interval=1.0, min_std=0.2, now=0.0)
+    now = 0.0
+    for beat in range(40):
+        regular.heartbeat(now=float(beat + 1))
+        now += 0.5 if beat % 2 else 1.5
+        jittery.heartbeat(now=now)
+    assert regular.suspected(now=40.0 + 2.5)
+    assert not jittery.suspected(now=now + 2.5)
+
+
+def test_detector_forgets_downtime():
+    detector = PhiAccrualDetector(8.0, expected_interval=1.0, min_std=0.1, now=0.0)
+    for beat in range(1, 11):
+        detector.heartbeat(now=float(beat))
+    assert detector.suspected(now=100.0)
+    # Back after being declared dead: the gap isn't taken for an interval.
+    detector.heartbeat(now=100.0)
+    assert len(detector.intervals) == 0
+    assert not detector.suspected(now=100.5)
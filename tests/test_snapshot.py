@@ -0,0 +1,97 @@
+import pytest
+from array import array
+from decimal import Decimal
+from paxos.worker import snapshot
+from paxos.worker.snapshot import MappedAccounts, SnapshotError
+from paxos.worker.ledger import Account, FileLedger, LedgerError
+
+FUNDS = {0: Decimal("1.50"), 1: Decimal("0"), 3: Decimal("-2.25"), 7: Decimal("99")}
+
+
+def test_units_round_trip():
+    assert snapshot.to_units(Decimal("1.5"), 2) == 150
+    assert snapshot.from_units(150, 2) == Decimal("1.50")
+    with pytest.raises(SnapshotError):
+        snapshot.to_units(Decimal("0.001"), 2)
+    with pytest.raises(SnapshotError):
+        snapshot.to_units(Decimal("1e20"), 2)
+    with pytest.raises(SnapshotError):
+        snapshot.to_units(Decimal("NaN"), 2)
+
+
+def test_binary_round_trip(tmp_path):
+    fpath = tmp_path / "ledger.bin"
+    snapshot.write_binary(fpath, 8, 41, FUNDS.items(), 2)
+    assert snapshot.is_binary(fpath)
+
+    accounts = MappedAccounts(fpath, make_account=Account)
+    assert (accounts.next_uid, accounts.applied_slot, accounts.scale) == (8, 41, 2)
+    assert sorted(accounts) == sorted(FUNDS)
+    assert {uid: accounts[uid].funds for uid in FUNDS} == FUNDS
+    assert 2 not in accounts
+    # Not dense, so it can't be taken over as an array as it is.
+    assert accounts.units_array() is None
+
+
+def test_dense_units_round_trip(tmp_path):
+    fpath = tmp_path / "ledger.bin"
+    units = array("q", [150, 0, -225])
+    snapshot.write_binary_units(fpath, 3, 2, units, 2)
+
+    accounts = MappedAccounts(fpath, make_account=Account)
+    assert accounts.units_array() == units
+    assert dict(accounts.frozen_items()) == {
+        0: Decimal("1.50"),
+        1: Decimal("0"),
+        2: Decimal("-2.25"),
+    }
+
+
+def test_frozen_items_ignore_later_changes(tmp_path):
+    fpath = tmp_path / "ledger.bin"
+    snapshot.write_binary(fpath, 8, 0, FUNDS.items(), 2)
+    accounts = MappedAccounts(fpath, make_account=Account)
+    accounts[0].funds = Decimal("5")
+    items = accounts.frozen_items()
+    accounts[0].funds = Decimal("6")
+    del accounts[3]
+    assert dict(items) == {**FUNDS, 0: Decimal("5")}
+
+
+@pytest.mark.parametrize("store", ["dict", "array"])
+@pytest.mark.parametrize("snapshot_format", ["yaml", "binary"])
+def test_ledger_persistence(tmp_path, snapshot_format, store):
+    fpath = tmp_path / "ledger"
+    ledger = FileLedger(fpath, snapshot_format=snapshot_format, store=store)
+    for slot in range(4):
+        ledger.apply(slot, {"op": "open_acct"})
+    ledger.apply(4, {"op": "deposit", "uid": 1, "amount": "12.34"})
+    ledger.apply(5, {"op": "withdraw", "uid": 1, "amount": "0.34", "key": "k"})
+    with pytest.raises(LedgerError):
+        ledger.apply(6, {"op": "deposit", "uid": 2, "amount": "0.001"})
+
+    reloaded = FileLedger(fpath, store=store)
+    assert reloaded.snapshot_format == snapshot_format
+    assert (reloaded.next_uid, reloaded.applied_slot) == (4, 6)
+    assert dict(reloaded.snapshot_items()) == {
+        0: Decimal("0"),
+        1: Decimal("12"),
+        2: Decimal("0"),
+        3: Decimal("0"),
+    }
+    assert reloaded.dedup == ledger.dedup
+    assert str(reloaded.account(1).funds) == "12.00"
+
+
+def test_checkpoint_keeps_the_snapshot_mapped(tmp_path):
+    fpath = tmp_path / "ledger.bin"
+    ledger = FileLedger(fpath, snapshot_format="binary")
+    for slot in range(100):
+        ledger.apply(slot, {"op": "open_acct"})
+
+    reloaded = FileLedger(fpath)
+    reloaded.apply(100, {"op": "deposit", "uid": 5, "amount": "1"})
+    with reloaded.exclusive():
+        reloaded.export(tmp_path / "copy.bin", "binary")
+    assert len(reloaded.accounts.overlay) <= 1
+    assert FileLedger(tmp_path / "copy.bin").account(5).funds == Decimal("1")
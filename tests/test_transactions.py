@@ -0,0 +1,276 @@
+import pytest
+from decimal import Decimal
+from paxos.worker.ledger import Ledger, LedgerError
+from paxos.worker.store import ArrayAccounts
+from paxos.worker.shards import ShardMap, TransferCoordinator
+
+
+def make_ledger(store: str, num_accounts: int = 3) -> Ledger:
+    accounts = ArrayAccounts(2) if store == "array" else {}
+    ledger = Ledger(accounts=accounts, next_uid=0)
+    for slot in range(num_accounts):
+        ledger.apply(slot, {"op": "open_acct"})
+    ledger.apply(num_accounts, {"op": "deposit", "uid": 0, "amount": "10"})
+    return ledger
+
+
+def funds(ledger: Ledger) -> dict:
+    return {uid: str(f) for uid, f in ledger.snapshot_items()}
+
+
+@pytest.fixture(params=["dict", "array"])
+def store(request):
+    return request.param
+
+
+def test_batch_rolls_back_failed_ops(store):
+    ledger = make_ledger(store)
+    results = ledger.execute(
+        {
+            "op": "batch",
+            "ops": [
+                {"op": "transfer", "from_uid": 0, "to_uid": 1, "amount": "4"},
+                {"op": "open_acct"},
+                {"op": "withdraw", "uid": 1, "amount": "5"},
+                {"op": "deposit", "uid": 9, "amount": "1"},
+                {"op": "transfer", "from_uid": 1, "to_uid": 2, "amount": "1"},
+            ],
+        }
+    )
+    assert [ok for ok, _ in results] == [True, True, False, False, True]
+    assert funds(ledger) == {0: "6.00", 1: "3.00", 2: "1.00", 3: "0.00"}
+
+
+def test_atomic_batch_rolls_back_everything(store):
+    ledger = make_ledger(store)
+    before = funds(ledger)
+    ops = [
+        {"op": "open_acct"},
+        {"op": "transfer", "from_uid": 0, "to_uid": 1, "amount": "4"},
+        {"op": "withdraw", "uid": 0, "amount": "7"},
+    ]
+    with pytest.raises(LedgerError, match="#2"):
+        ledger.apply(4, {"op": "batch", "ops": ops, "atomic": True})
+    assert funds(ledger) == before
+    assert ledger.next_uid == 3
+    assert ledger.applied_slot == 4
+
+
+def test_nested_savepoints(store):
+    # A failed batch inside a batch only rolls back what it did itself.
+    ledger = make_ledger(store)
+    inner = {
+        "op": "batch",
+        "ops": [
+            {"op": "deposit", "uid": 1, "amount": "2"},
+            {
+                "op": "batch",
+                "atomic": True,
+                "ops": [
+                    {"op": "deposit", "uid": 1, "amount": "4"},
+                    {"op": "withdraw", "uid": 2, "amount": "1"},
+                ],
+            },
+        ],
+    }
+    ops = [{"op": "deposit", "uid": 1, "amount": "1"}, inner]
+    results = ledger.apply(4, {"op": "batch", "ops": ops, "atomic": True})
+    assert [ok for ok, _ in results[1][1]] == [True, False]
+    assert ledger.account(1).funds == Decimal("3")
+
+    ops.append({"op": "withdraw", "uid": 2, "amount": "1"})
+    with pytest.raises(LedgerError):
+        ledger.apply(5, {"op": "batch", "ops": ops, "atomic": True})
+    assert ledger.account(1).funds == Decimal("3")
+
+
+def test_amounts_agree_across_stores():
+    dict_ledger, array_ledger = make_ledger("dict"), make_ledger("array")
+    for ledger in (dict_ledger, array_ledger):
+        ledger.apply(4, {"op": "deposit", "uid": 1, "amount": "5"})
+        with pytest.raises(LedgerError, match="decimal places"):
+            ledger.apply(5, {"op": "deposit", "uid": 1, "amount": "0.001"})
+        with pytest.raises(LedgerError, match="not an amount"):
+            ledger.apply(6, {"op": "deposit", "uid": 1, "amount": "five"})
+    assert funds(dict_ledger) == funds(array_ledger)
+    assert funds(dict_ledger)[1] == "5.00"
+
+
+def test_footprint():
+    ledger = make_ledger("dict")
+    assert ledger.footprint({"op": "deposit", "uid": 2, "amount": "1"}) == (False, [2])
+    assert ledger.footprint(
+        {"op": "transfer", "from_uid": 0, "to_uid": 1, "amount": "1"}
+    ) == (False, [0, 1])
+    batch = {
+        "op": "batch",
+        "ops": [
+            {"op": "open_acct"},
+            {"op": "deposit", "uid": 1, "amount": "1"},
+            {"op": "open_acct"},
+        ],
+    }
+    assert ledger.footprint(batch) == (True, [3, 1, 4])
+    assert ledger.footprint({"op": "noop", "uids": [1, 2]}) == (False, [1, 2])
+
+    ledger.tx_prepare("t", "source", 0, ledger.to_amount("1"), {"ts": 1.0})
+    assert ledger.footprint({"op": "tx_commit", "tx": "t", "role": "source"}) == (
+        True,
+        [0],
+    )
+    assert ledger.footprint({"op": "tx_abort", "tx": "u", "role": "target"}) == (
+        True,
+        [],
+    )
+
+
+def prepare(ledger: Ledger, role: str, ts: float, **kwargs):
+    info = {"ts": ts, "deadline": ts + 10.0}
+    uid = 0 if role == "source" else 1
+    return ledger.tx_prepare("t", role, uid, ledger.to_amount("4"), info, **kwargs)
+
+
+def test_source_transitions(store):
+    ledger = make_ledger(store)
+    assert prepare(ledger, "source", 1.0) == 1.0
+    assert ledger.account(0).funds == Decimal("6")
+    # A retry while the first attempt is going carries on with it.
+    assert prepare(ledger, "source", 2.0) == 1.0
+    assert ledger.account(0).funds == Decimal("6")
+
+    ledger.tx_abort("t", "source", started=1.0)
+    assert ledger.account(0).funds == Decimal("10")
+    with pytest.raises(LedgerError):
+        ledger.tx_commit("t", "source", started=1.0)
+    with pytest.raises(LedgerError):
+        prepare(ledger, "source", 1.0)
+
+    # A later retry starts over, and its outcome sticks.
+    assert prepare(ledger, "source", 3.0) == 3.0
+    ledger.tx_commit("t", "source", started=3.0)
+    assert ledger.account(0).funds == Decimal("6")
+    assert prepare(ledger, "source", 4.0) == 3.0
+    with pytest.raises(LedgerError):
+        ledger.tx_abort("t", "source")
+    ledger.tx_end("t", started=2.0)
+    assert "t" in ledger.txs
+    ledger.tx_end("t", started=3.0)
+    assert "t" not in ledger.txs
+
+
+def test_target_transitions(store):
+    ledger = make_ledger(store)
+    with pytest.raises(LedgerError, match="timed out"):
+        prepare(ledger, "target", 1.0, now=20.0)
+    assert prepare(ledger, "target", 1.0, now=2.0) == 1.0
+    ledger.tx_commit("t", "target", started=1.0)
+    ledger.tx_commit("t", "target", started=1.0)
+    assert ledger.account(1).funds == Decimal("4")
+    assert ledger.txs["t"]["state"] == "committed"
+
+    # An abort that overtook its prepare leaves a tombstone behind.
+    ledger.tx_end("t", started=1.0)
+    ledger.tx_abort("t", "target", started=5.0)
+    with pytest.raises(LedgerError, match="aborted"):
+        prepare(ledger, "target", 5.0, now=6.0)
+    # ...which doesn't stop a later attempt.
+    assert prepare(ledger, "target", 7.0, now=8.0) == 7.0
+    ledger.tx_abort("t", "target", started=7.0)
+    assert ledger.account(1).funds == Decimal("4")
+    ledger.tx_end("t", started=7.0)
+    assert ledger.txs == {}
+
+
+class FakeShards:
+    # Two single-replica shards whose logs are their ledgers.
+    def __init__(self):
+        self.ledgers = [make_ledger("dict"), make_ledger("dict")]
+        self.reachable = True
+
+    def propose(self, shard: int, op: dict):
+        ledger = self.ledgers[shard]
+        return ledger.apply(ledger.applied_slot + 1, op)
+
+    def call(self, shard: int, path: str, payload: dict):
+        if not self.reachable:
+            return None
+        outcome = path.rsplit("/", 1)[1]
+        op = {"op": f"tx_{outcome}", "tx": payload["tx"], "role": "target"}
+        if outcome == "prepare":
+            op["uid"], op["amount"] = payload["uid"], payload["amount"]
+            op["info"] = {"ts": payload["started"], "deadline": payload["deadline"]}
+        else:
+            op["started"] = payload["started"]
+        try:
+            self.propose(shard, op)
+        except LedgerError as e:
+            return FakeResponse(False, {"details": str(e)})
+        return FakeResponse(True, {})
+
+
+class FakeResponse:
+    def __init__(self, ok: bool, body: dict):
+        self.ok, self.body = ok, body
+
+    def json(self):
+        return self.body
+
+
+def make_coordinator(shards: FakeShards) -> TransferCoordinator:
+    coordinator = TransferCoordinator(
+        ShardMap(0, [["a"], ["b"]]),
+        propose=lambda op: shards.propose(0, op),
+        txs=lambda: dict(shards.ledgers[0].txs),
+        is_leader=lambda: False,
+    )
+    coordinator._call = shards.call
+    return coordinator
+
+
+def test_transfer_commits_on_both_shards():
+    shards = FakeShards()
+    make_coordinator(shards).transfer(0, 1, "4")
+    source, target = shards.ledgers
+    assert source.account(0).funds == Decimal("6")
+    assert target.account(1).funds == Decimal("4")
+    assert source.txs == {}
+    assert [r["state"] for r in target.txs.values()] == ["committed"]
+
+
+def test_refused_transfer_is_rolled_back():
+    shards = FakeShards()
+    with pytest.raises(LedgerError, match="does not exist"):
+        make_coordinator(shards).transfer(0, 9, "4")
+    assert shards.ledgers[0].account(0).funds == Decimal("10")
+    assert shards.ledgers[0].txs == {}
+
+
+def test_recovery_finishes_stranded_transfers():
+    shards = FakeShards()
+    coordinator = make_coordinator(shards)
+    source = shards.ledgers[0]
+    # A leader that crashed right after preparing on the source.
+    info = {"target": 1, "to_uid": 1, "ts": 1.0}
+    source.apply(
+        4,
+        {
+            "op": "tx_prepare",
+            "tx": "t",
+            "role": "source",
+            "uid": 0,
+            "amount": "4",
+            "info": info,
+        },
+    )
+    assert source.account(0).funds == Decimal("6")
+
+    shards.reachable = False
+    coordinator._recover("t", source.txs["t"])
+    assert source.account(0).funds == Decimal("10")
+    assert source.txs["t"]["state"] == "aborted"
+
+    # Until the target learns the outcome, the record stays.
+    shards.reachable = True
+    coordinator._recover("t", source.txs["t"])
+    assert source.txs == {}
+    assert shards.ledgers[1].txs["t"]["state"] == "aborted"